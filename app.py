@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, Response, stream_with_context, jsonify, send_from_directory
+from flask import Flask, Request, render_template, request, Response, stream_with_context, jsonify, send_from_directory
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
@@ -7,14 +7,64 @@ import logging
 import random
 import time
 import re
-import markdown
 import html
-import fitz  # PyMuPDF
+import importlib
+import io
 import os
+import tempfile
+import threading
+import select
+import socket
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 import math
-import pytesseract
-from PIL import Image
+import heapq
+import bisect
+import functools
+import unicodedata
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import hashlib
+import sqlite3
+import struct
+import zlib
+from array import array
+import uuid
+
+class LazyModule:
+    """Módulo que se importa la primera vez que se usa uno de sus atributos.
+
+    Las dependencias pesadas se cargan así cuando se necesitan y no al
+    importar app.py, que se importa al iniciar el servidor, en cada worker y
+    en cada proceso de los pools. warm_up() las carga todas de antemano.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return f"<LazyModule {self._name} ({'cargado' if self._module else 'sin cargar'})>"
+
+markdown = LazyModule('markdown')
+fenced_code = LazyModule('markdown.extensions.fenced_code')
+fitz = LazyModule('fitz')  # PyMuPDF
+np = LazyModule('numpy')
+tiktoken = LazyModule('tiktoken')
+pytesseract = LazyModule('pytesseract')
+Image = LazyModule('PIL.Image')
+ImageOps = LazyModule('PIL.ImageOps')
+heavy_modules = [markdown, fenced_code, fitz, np, tiktoken, pytesseract, Image, ImageOps]
 
 app = Flask(__name__, static_folder='static')
 logging.basicConfig(level=logging.INFO)
@@ -22,11 +72,13 @@ logging.basicConfig(level=logging.INFO)
 # Configuración para subida de archivos
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
 STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
+CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, 'cache')
+DOCUMENTS_FOLDER = os.path.join(UPLOAD_FOLDER, 'documents')
 ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp', 'tiff'}
 
 # Crear carpetas necesarias si no existen
 try:
-    for folder in [UPLOAD_FOLDER, STATIC_FOLDER]:
+    for folder in [UPLOAD_FOLDER, STATIC_FOLDER, CACHE_FOLDER, DOCUMENTS_FOLDER]:
         if not os.path.exists(folder):
             os.makedirs(folder)
             app.logger.info(f"Carpeta creada en: {folder}")
@@ -35,76 +87,1704 @@ except Exception as e:
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['STATIC_FOLDER'] = STATIC_FOLDER
+app.config['PDF_MAX_BYTES'] = 64 * 1024 * 1024  # Tamaño máximo de un PDF subido (413 al superarlo)
+app.config['IMAGE_MAX_BYTES'] = 20 * 1024 * 1024  # Tamaño máximo de una imagen subida
+app.config['MAX_CONTENT_LENGTH'] = app.config['PDF_MAX_BYTES'] + 1024 * 1024  # Límite de Flask por solicitud (el archivo más el formulario)
+app.config['UPLOAD_SPOOL_MAX_BYTES'] = 16 * 1024 * 1024  # Las subidas más grandes pasan de memoria a un archivo temporal
+app.config['CACHE_FOLDER'] = CACHE_FOLDER  # Resultados de OCR y de PDFs por contenido del archivo
+app.config['CACHE_MAX_BYTES'] = 256 * 1024 * 1024  # Al superarlo se borran los menos usados
+# Se eligen con variables de entorno, para no editar app.py al cambiar de despliegue
+app.config['STATE_BACKEND'] = os.environ.get('STATE_BACKEND', 'memory')  # 'memory' (un solo proceso) o 'sqlite' (compartido entre workers)
+app.config['STATE_DATABASE'] = os.environ.get('STATE_DATABASE', os.path.join(UPLOAD_FOLDER, 'state.sqlite3'))  # Archivo del estado con 'sqlite'
+app.config['DOCUMENTS_FOLDER'] = DOCUMENTS_FOLDER  # Textos de documentos que no caben en memoria
+app.config['DOCUMENT_STORE_MAX_BYTES'] = 128 * 1024 * 1024  # Memoria para textos de PDFs e imágenes y los índices de los PDFs
+app.config['DOCUMENT_COMPRESS_AFTER'] = 600  # Segundos sin usarse tras los que un documento se comprime
+app.config['DOCUMENT_TTL'] = 6 * 3600  # Segundos sin usarse tras los que un documento pasa a disco
+app.config['DOCUMENT_SPILL_MAX_BYTES'] = 1024 * 1024 * 1024  # Al superarlo se borran los documentos más antiguos en disco
 app.config['MAX_CHUNK_SIZE'] = 10000
-app.config['REQUEST_TIMEOUT'] = 300
+app.config['PDF_EXTRACT_WORKERS'] = min(4, os.cpu_count() or 1)  # Procesos para extraer páginas; 1 = siempre en serie
+app.config['PDF_PARALLEL_MIN_PAGES'] = 64  # PDFs con menos páginas se extraen en serie
+app.config['PDF_OCR_DPI'] = 200  # Resolución para pasar por OCR las páginas escaneadas
+app.config['PDF_OCR_MAX_PAGES'] = 100  # Páginas escaneadas que se pasan por OCR en cada PDF
+app.config['REQUEST_TIMEOUT'] = 300  # Segundos máximos de espera entre datos de Ollama (p. ej. mientras carga un modelo)
+app.config['OLLAMA_CONNECT_TIMEOUT'] = 5  # Segundos para conectar con Ollama
+app.config['OLLAMA_POOL_SIZE'] = 32  # Conexiones con Ollama que se mantienen abiertas
+app.config['OLLAMA_KEEP_ALIVE'] = '30m'  # Tiempo que Ollama mantiene cargado un modelo tras usarlo
+app.config['OLLAMA_MODEL_CONCURRENCY'] = 2  # Respuestas simultáneas por modelo (OLLAMA_NUM_PARALLEL de Ollama)
+app.config['OLLAMA_MAX_LOADED_MODELS'] = 1  # Modelos cargados a la vez (OLLAMA_MAX_LOADED_MODELS de Ollama)
+app.config['OLLAMA_SWITCH_AFTER'] = 30  # Segundos que un pedido espera a los de otros modelos antes de forzar el cambio
+app.config['OLLAMA_QUEUE_LIMIT'] = 64  # Pedidos en espera antes de rechazar los nuevos
+app.config['OLLAMA_QUEUE_TIMEOUT'] = 300  # Segundos máximos de espera en la cola
+app.config['OLLAMA_POLL_INTERVAL'] = 30  # Segundos entre revisiones del estado y los modelos de Ollama
+app.config['OLLAMA_POLL_MAX_BACKOFF'] = 60  # Espera máxima entre reintentos mientras Ollama no responde
+app.config['CANCEL_POLL_INTERVAL'] = 0.5  # Segundos entre revisiones de desconexiones y cancelaciones
+app.config['CANCEL_TTL'] = 120  # Segundos que se recuerda una cancelación (por si llega antes que el pedido)
+app.config['OLLAMA_OPTIONS'] = {}  # Opciones de generación; con {'temperature': 0} (o una 'seed') las respuestas idénticas se reutilizan
+app.config['RESPONSE_CACHE_TTL'] = 3600  # Segundos que se reutiliza una respuesta ya generada
+app.config['RESPONSE_CACHE_MAX_ENTRIES'] = 1000  # Respuestas guardadas como máximo
+app.config['METRICS_ENABLED'] = True  # Medir tiempos para /metrics (con False no se mide nada y /metrics responde 404)
+app.config['WARM_UP'] = False  # Cargar los módulos pesados al importar app.py (con gunicorn --preload los workers los heredan cargados)
+app.config['DOCUMENT_MAP_REDUCE'] = True  # Responder leyendo todo el PDF las preguntas que lo piden ("resume el documento", "en todo el pdf")
+app.config['DOCUMENT_MAP_WORKERS'] = 2  # Pedidos simultáneos a Ollama al leer todo un PDF (además del turno de ollama_scheduler)
+app.config['DOCUMENT_NOTES_TOKENS'] = 512  # Tokens máximos de las notas de cada parte del PDF y de cada combinación
+app.config['RETRIEVAL_TOP_K'] = 3  # Fragmentos del PDF que se envían como contexto
+app.config['RETRIEVAL_MODE'] = 'bm25'  # 'bm25' o 'semantic' (embeddings de Ollama)
+app.config['EMBEDDING_MODEL'] = 'nomic-embed-text'  # Modelo del índice semántico, que solo se crea con RETRIEVAL_MODE 'semantic' (None lo desactiva)
+app.config['EMBEDDING_PASSAGE_SIZE'] = 200  # Palabras por pasaje embebido
+app.config['EMBEDDING_BATCH_SIZE'] = 32  # Pasajes por llamada a Ollama
+app.config['EMBEDDING_WORKERS'] = 2  # Llamadas de embeddings simultáneas
+app.config['DEFAULT_CONTEXT_WINDOW'] = 4096  # num_ctx para modelos sin entrada en MODEL_CONTEXT_WINDOWS
+app.config['MODEL_CONTEXT_WINDOWS'] = {}  # Ventana de contexto por modelo, p. ej. {'llama3.1:8b': 8192}
+app.config['RESPONSE_TOKENS'] = 1024  # Tokens de la ventana reservados para la respuesta
+app.config['CONVERSATION_MODE'] = False  # Conservar el historial de cada chat y usar /api/chat de Ollama (un pedido puede activarlo con 'conversation')
+app.config['CONVERSATION_DOCUMENT_SHARE'] = 0.5  # Parte del presupuesto para el documento en el primer turno (el resto queda para el historial)
+app.config['STREAM_FLUSH_INTERVAL'] = 0.04  # Segundos entre líneas en el modo 'delta'
+app.config['STREAM_FLUSH_TOKENS'] = 32  # Tokens máximos agrupados en una línea del modo 'delta'
+app.config['ASYNC_WORKER_THREADS'] = 32  # Hilos de async_server.py para las demás rutas y el trabajo de CPU
+app.config['ASYNC_UPSTREAM_CONNECTIONS'] = 512  # Conexiones simultáneas con Ollama en async_server.py
+app.config['ASYNC_DOCUMENT_THREADS'] = 8  # Hilos de async_server.py para las preguntas sobre todo el PDF (aparte de los demás)
+app.config['STATUS_POLL_INTERVAL'] = 0.25  # Segundos entre lecturas del estado con ?stream=1
 app.config['last_image_text'] = None
-app.config['image_history'] = {}  # Diccionario para almacenar el historial de imágenes por chat
+app.config['OCR_LANG'] = 'spa+eng'
+app.config['OCR_WORKERS'] = 2  # Procesos de tesseract simultáneos
+app.config['OCR_QUEUE_LIMIT'] = 8  # Trabajos de OCR en espera o en curso antes de responder 429
+app.config['OCR_JOB_TTL'] = 3600  # Segundos que se conserva el resultado de un trabajo terminado
+app.config['OCR_PREPROCESS'] = True  # Escala de grises, binarizado y enderezado antes de tesseract
+app.config['OCR_MAX_SIDE'] = 2400  # Lado mayor (px) al que se reducen las fotos grandes antes del OCR
+app.config['OCR_MIN_SIDE'] = 1200  # Lado mayor (px) al que se amplían las imágenes pequeñas (hasta x3)
+app.config['THUMBNAIL_MAX_SIDE'] = 800  # Lado mayor de la miniatura que se envía al navegador
+app.config['THUMBNAIL_QUALITY'] = 80  # Calidad JPEG de la miniatura
 
 # Configurar Tesseract
-if os.name == 'nt':  # Windows
+TESSERACT_WINDOWS_PATH = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+
+def configure_tesseract():
+    """En Windows apunta pytesseract al tesseract.exe instalado. Se llama antes
+    de cada OCR, porque los procesos del pool 'ocr' tienen su propio pytesseract."""
+    if os.name == 'nt' and os.path.exists(TESSERACT_WINDOWS_PATH):
+        pytesseract.pytesseract.tesseract_cmd = TESSERACT_WINDOWS_PATH
+
+def check_tesseract():
+    """Comprueba que tesseract se pueda ejecutar y lo registra (ver startup_checks)."""
     try:
-        tesseract_path = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
-        if not os.path.exists(tesseract_path):
-            raise Exception(f"Tesseract no encontrado en {tesseract_path}")
-        
-        pytesseract.pytesseract.tesseract_cmd = tesseract_path
+        if os.name == 'nt' and not os.path.exists(TESSERACT_WINDOWS_PATH):
+            raise Exception(f"Tesseract no encontrado en {TESSERACT_WINDOWS_PATH}")
+        configure_tesseract()
         version = pytesseract.get_tesseract_version()
         app.logger.info(f"Tesseract OCR configurado correctamente. Versión: {version}")
+        return True
     except Exception as e:
         app.logger.error(f"Error al configurar Tesseract: {str(e)}")
-        app.logger.error("Por favor, asegúrese de que Tesseract OCR está instalado correctamente")
-        print("\nERROR: Tesseract OCR no está configurado correctamente")
-        print("1. Verifique que Tesseract OCR está instalado en C:\\Program Files\\Tesseract-OCR")
-        print("2. Si está instalado en otra ubicación, actualice la ruta en el código")
-        print("3. Asegúrese de haber instalado los paquetes de idioma necesarios")
-        print(f"Error detallado: {str(e)}\n")
+        app.logger.error("Por favor, asegúrese de que Tesseract OCR está instalado correctamente, "
+                         "con los paquetes de idioma necesarios")
+        if os.name == 'nt':
+            app.logger.error("Si está instalado en otra ubicación, actualice TESSERACT_WINDOWS_PATH")
+        return False
+
+# Métricas en el formato de texto de Prometheus (ver la ruta /metrics)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 131072)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 400)
+
+class Histogram:
+    """Histograma con etiquetas que se exporta en el formato de Prometheus.
+    Registrar un valor es una búsqueda binaria y una suma bajo un lock; con
+    METRICS_ENABLED en False no se hace nada."""
+
+    def __init__(self, name, documentation, buckets, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.series = {}  # valores de las etiquetas -> cuentas por bucket (la última es +Inf) y suma
+
+    def observe(self, value, *label_values):
+        if not app.config['METRICS_ENABLED']:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        """Líneas de texto de Prometheus del histograma."""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = sorted((label_values, list(values)) for label_values, values in self.series.items())
+        for label_values, values in series:
+            labels = ''.join(f'{name}="{value}",' for name, value in zip(self.labels, label_values))
+            count = 0
+            for bound, bucket in zip(self.buckets + (math.inf,), values[:-1]):
+                count += bucket
+                le = '+Inf' if bound == math.inf else f'{bound:g}'
+                lines.append(f'{self.name}_bucket{{{labels}le="{le}"}} {count}')
+            suffix = f'{{{labels.rstrip(",")}}}' if labels else ''
+            lines.append(f'{self.name}_sum{suffix} {values[-1]:.6f}')
+            lines.append(f'{self.name}_count{suffix} {count}')
+        return lines
+
+chat_stage_seconds = Histogram(
+    'libreai_chat_stage_seconds',
+    'Duración de las etapas de /chat: prompt, map y reduce (todo el PDF), queue, connect, first_token, render y total',
+    LATENCY_BUCKETS, ('stage', 'mode'))
+ollama_tokens = Histogram(
+    'libreai_ollama_tokens', 'Tokens de cada respuesta según Ollama (prompt_eval_count y eval_count)',
+    TOKEN_BUCKETS, ('kind', 'mode'))
+ollama_seconds = Histogram(
+    'libreai_ollama_seconds', 'Tiempos que informa Ollama al terminar: load, prompt_eval, eval y total',
+    LATENCY_BUCKETS, ('phase', 'mode'))
+ollama_tokens_per_second = Histogram(
+    'libreai_ollama_tokens_per_second', 'Velocidad de generación (eval_count / eval_duration)',
+    RATE_BUCKETS, ('mode',))
+upload_stage_seconds = Histogram(
+    'libreai_upload_stage_seconds', 'Duración de las subidas, la extracción de PDFs y el OCR',
+    LATENCY_BUCKETS, ('kind', 'stage'))
+histograms = [chat_stage_seconds, ollama_tokens, ollama_seconds, ollama_tokens_per_second, upload_stage_seconds]
+
+def timed_upload(kind):
+    """Decorador de las rutas de subida: registra su duración en upload_stage_seconds."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                upload_stage_seconds.observe(time.perf_counter() - started, kind, 'request')
+        return wrapper
+    return decorator
 
 # Configuración de Ollama
-OLLAMA_API_URL = 'http://localhost:11434/api/generate'
+OLLAMA_BASE_URL = 'http://localhost:11434'
 
-# Verificar conexión con Ollama
-try:
-    response = requests.get('http://localhost:11434/api/tags')
-    if response.status_code == 200:
-        app.logger.info("Conexión con Ollama establecida correctamente")
-    else:
-        app.logger.error(f"Error al conectar con Ollama. Código de estado: {response.status_code}")
-except Exception as e:
-    app.logger.error(f"No se pudo conectar con Ollama: {str(e)}")
+# Cliente de Ollama: pool de conexiones de tamaño fijo y tiempos de espera
+# explícitos. Solo se reintenta al establecer la conexión (antes de enviar
+# nada), así nunca se repite un POST que Ollama ya empezó a responder
+class OllamaClient:
+    def __init__(self, base_url, pool_size, connect_timeout, read_timeout):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        retry_strategy = Retry(total=2, connect=2, read=False, status=0, other=0, backoff_factor=0.5)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry_strategy)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
-# Configurar reintentos y timeout
-retry_strategy = Retry(
-    total=3,
-    backoff_factor=1,
-    status_forcelist=[429, 500, 502, 503, 504],
+    def get(self, path, timeout=None):
+        return self.session.get(self.base_url + path, timeout=timeout or self.timeout)
+
+    def post(self, path, payload, stream=False, timeout=None):
+        return self.session.post(self.base_url + path, json=payload, stream=stream, timeout=timeout or self.timeout)
+
+ollama = OllamaClient(
+    OLLAMA_BASE_URL, app.config['OLLAMA_POOL_SIZE'],
+    app.config['OLLAMA_CONNECT_TIMEOUT'], app.config['REQUEST_TIMEOUT']
 )
-adapter = HTTPAdapter(max_retries=retry_strategy)
-http = requests.Session()
-http.mount("http://", adapter)
-http.mount("https://", adapter)
-http.request = lambda *args, **kwargs: requests.Session.request(http, *args, **{**kwargs, 'timeout': app.config['REQUEST_TIMEOUT']})
+
+class OllamaMonitor:
+    """Estado de Ollama y lista de modelos, revisados en segundo plano.
+
+    Un hilo consulta /api/tags cada interval segundos; si Ollama no responde
+    reintenta antes (1, 2, 4... segundos, hasta max_backoff). Las páginas
+    leen el último estado con snapshot() sin esperar a Ollama. El hilo
+    arranca con el primer uso, así los procesos de los pools no lo crean.
+    """
+
+    def __init__(self, client, interval, max_backoff):
+        self.client = client
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.state = {'healthy': None, 'models': [], 'error': None, 'checked': None}
+        self.failures = 0
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def refresh(self):
+        """Consulta a Ollama ahora y devuelve el estado nuevo."""
+        try:
+            response = self.client.get('/api/tags', timeout=(self.client.timeout[0], 5))
+            if response.status_code != 200:
+                raise requests.exceptions.RequestException(f"Código de estado: {response.status_code}")
+            models = [
+                {'name': model['name'], 'size': model.get('size', 0), 'details': model.get('details', {})}
+                for model in response.json().get('models', [])
+            ]
+            state = {'healthy': True, 'models': models, 'error': None, 'checked': time.time()}
+        except (requests.exceptions.RequestException, ValueError) as e:
+            with self.lock:
+                models = self.state['models']
+            state = {'healthy': False, 'models': models, 'error': str(e), 'checked': time.time()}
+        with self.lock:
+            if state['healthy'] != self.state['healthy']:
+                if state['healthy']:
+                    app.logger.info("Conexión con Ollama establecida correctamente")
+                else:
+                    app.logger.error(f"No se pudo conectar con Ollama: {state['error']}")
+            self.failures = 0 if state['healthy'] else self.failures + 1
+            self.state = state
+            return dict(state)
+
+    def run(self):
+        while True:
+            state = self.refresh()
+            if state['healthy']:
+                delay = self.interval
+            else:
+                delay = min(2 ** (self.failures - 1), self.max_backoff)
+            self.wakeup.wait(delay)
+            self.wakeup.clear()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def wake(self):
+        """Pide una revisión inmediata (p. ej. tras un error de conexión)."""
+        self.wakeup.set()
+
+    def snapshot(self):
+        self.start()
+        with self.lock:
+            return dict(self.state)
+
+ollama_monitor = OllamaMonitor(ollama, app.config['OLLAMA_POLL_INTERVAL'], app.config['OLLAMA_POLL_MAX_BACKOFF'])
+
+class SchedulerTicket:
+    """Turno de un pedido en ModelScheduler."""
+
+    def __init__(self, model):
+        self.model = model
+        self.enqueued = time.time()
+        self.ready = threading.Event()
+        self.callbacks = []
+        self.released = False
+
+class ModelScheduler:
+    """Admisión de pedidos de generación por modelo.
+
+    Cada modelo atiende como máximo per_model pedidos a la vez y Ollama tiene
+    cargados como mucho max_models modelos (los usados más recientemente).
+    Los pedidos en espera se agrupan por modelo: primero pasan los de los
+    modelos ya cargados, aunque hayan llegado después, para no cargar y
+    descargar modelos a cada pedido. Si el pedido más antiguo lleva más de
+    switch_after segundos esperando un modelo que no está cargado, se deja de
+    admitir a los demás hasta que se pueda cargar el suyo. Con queue_limit
+    pedidos en espera, enqueue() devuelve None.
+    """
+
+    def __init__(self, per_model, max_models, switch_after, queue_limit):
+        self.per_model = per_model
+        self.max_models = max_models
+        self.switch_after = switch_after
+        self.queue_limit = queue_limit
+        self.lock = threading.Lock()
+        self.waiting = []  # En orden de llegada
+        self.running = Counter()
+        self.loaded = OrderedDict()  # Modelos cargados, del usado hace más tiempo al más reciente
+
+    def enqueue(self, model):
+        with self.lock:
+            if len(self.waiting) >= self.queue_limit:
+                return None
+            ticket = SchedulerTicket(model)
+            self.waiting.append(ticket)
+            admitted = self.dispatch()
+        self.notify(admitted)
+        return ticket
+
+    def position(self, ticket):
+        """Pedidos que esperan delante (0 si ya fue admitido)."""
+        with self.lock:
+            return self.waiting.index(ticket) + 1 if ticket in self.waiting else 0
+
+    def on_ready(self, ticket, callback):
+        """Llama a callback() cuando se admite el pedido (enseguida si ya lo fue)."""
+        with self.lock:
+            if not ticket.ready.is_set():
+                ticket.callbacks.append(callback)
+                return
+        callback()
+
+    def release(self, ticket):
+        """Libera el turno al terminar el pedido, o lo saca de la cola si aún esperaba."""
+        with self.lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+            else:
+                self.running[ticket.model] -= 1
+            admitted = self.dispatch()
+        self.notify(admitted)
+
+    def dispatch(self):
+        """Admite los pedidos que se puedan; se llama con el lock tomado."""
+        admitted = []
+        oldest = self.waiting[0] if self.waiting else None
+        starving = (oldest is not None and oldest.model not in self.loaded
+                    and time.time() - oldest.enqueued > self.switch_after)
+        # Primero los modelos ya cargados, después los que haya que cargar
+        for loaded_pass in (True, False):
+            for ticket in list(self.waiting):
+                model = ticket.model
+                if self.running[model] >= self.per_model or (model in self.loaded) != loaded_pass:
+                    continue
+                if starving and model != oldest.model:
+                    continue
+                if model not in self.loaded and len(self.loaded) >= self.max_models:
+                    idle = next((name for name in self.loaded if not self.running[name]), None)
+                    if idle is None:
+                        continue
+                    del self.loaded[idle]
+                self.loaded[model] = True
+                self.loaded.move_to_end(model)
+                self.running[model] += 1
+                self.waiting.remove(ticket)
+                admitted.append(ticket)
+        return admitted
+
+    def notify(self, admitted):
+        for ticket in admitted:
+            with self.lock:
+                ticket.ready.set()
+                callbacks, ticket.callbacks = ticket.callbacks, []
+            for callback in callbacks:
+                callback()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'waiting': Counter(ticket.model for ticket in self.waiting),
+                'running': {model: count for model, count in self.running.items() if count},
+                'loaded': list(self.loaded)
+            }
+
+ollama_scheduler = ModelScheduler(
+    app.config['OLLAMA_MODEL_CONCURRENCY'], app.config['OLLAMA_MAX_LOADED_MODELS'],
+    app.config['OLLAMA_SWITCH_AFTER'], app.config['OLLAMA_QUEUE_LIMIT']
+)
+
+def close_upstream(response):
+    """Cierra la respuesta de Ollama aunque otro hilo esté leyendo de ella:
+    close() no despierta a un recv bloqueado, shutdown() sí. Al cerrarse la
+    conexión, Ollama deja de generar."""
+    try:
+        response.raw._connection.sock.shutdown(socket.SHUT_RDWR)
+    except (AttributeError, OSError):
+        pass
+    try:
+        response.close()
+    except Exception:
+        pass
+
+def client_disconnected(sock):
+    """True si el navegador cerró la conexión (el socket se puede leer pero
+    no hay datos)."""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and not sock.recv(1, socket.MSG_PEEK)
+    except OSError:
+        return True
+    except ValueError:
+        # Socket ya cerrado (fileno -1) o con TLS, donde no se puede espiar
+        return sock.fileno() == -1
+
+# Campos de la última línea de Ollama que se pasan a /metrics
+OLLAMA_STAT_FIELDS = ('prompt_eval_count', 'eval_count', 'load_duration', 'prompt_eval_duration',
+                      'eval_duration', 'total_duration')
+
+class Generation:
+    """Respuesta en curso de /chat. cancel() llama a closer, que corta la
+    conexión con Ollama."""
+
+    def __init__(self, request_id, is_disconnected=None):
+        self.request_id = request_id
+        self.is_disconnected = is_disconnected
+        self.cancelled = threading.Event()
+        self.reason = None
+        self.closer = None
+        self.tokens = 0
+        self.answer = []
+        self.mode = 'generate'  # 'generate', 'chat_first', 'chat_followup' o 'document'
+        self.sent = None  # perf_counter al enviar el pedido a Ollama
+        self.first_token = None
+        self.prompt_eval = None  # Tokens del prompt que Ollama tuvo que procesar
+        self.ollama_stats = {}  # Cuentas y tiempos de la última línea de Ollama
+        self.stream = None  # ResponseStream de la respuesta, para su tiempo de render
+        self.started = time.perf_counter()
+        self.last_mark = self.started
+        self.spans = {}
+
+    def mark(self, stage):
+        """Registra la duración de la etapa que termina ahora (desde la anterior)."""
+        now = time.perf_counter()
+        self.spans[stage] = now - self.last_mark
+        self.last_mark = now
+
+    def observe(self, line):
+        """Registra una línea JSON de Ollama y devuelve el texto que trae
+        ('response' en /api/generate, 'message' en /api/chat)."""
+        text = line.get('response') or (line.get('message') or {}).get('content', '')
+        if text:
+            if self.first_token is None:
+                self.first_token = time.perf_counter()
+            self.tokens += 1
+            self.answer.append(text)
+        if 'prompt_eval_count' in line:
+            self.prompt_eval = line['prompt_eval_count']
+        if line.get('done'):
+            self.ollama_stats = {field: line[field] for field in OLLAMA_STAT_FIELDS if field in line}
+        return text
+
+    def record_metrics(self):
+        """Pasa los tiempos de la respuesta a los histogramas de /metrics."""
+        mode = self.mode
+        spans = dict(self.spans)
+        if self.first_token is not None:
+            spans['first_token'] = self.first_token - self.sent
+        if self.stream is not None:
+            spans['render'] = self.stream.render_seconds
+        spans['total'] = time.perf_counter() - self.started
+        for stage, seconds in spans.items():
+            chat_stage_seconds.observe(seconds, stage, mode)
+        stats = self.ollama_stats
+        for kind, field in (('prompt', 'prompt_eval_count'), ('eval', 'eval_count')):
+            if field in stats:
+                ollama_tokens.observe(stats[field], kind, mode)
+        for phase in ('load', 'prompt_eval', 'eval', 'total'):
+            if f'{phase}_duration' in stats:
+                ollama_seconds.observe(stats[f'{phase}_duration'] / 1e9, phase, mode)
+        if stats.get('eval_count') and stats.get('eval_duration'):
+            ollama_tokens_per_second.observe(stats['eval_count'] / (stats['eval_duration'] / 1e9), mode)
+
+    def cancel(self, reason):
+        if self.cancelled.is_set():
+            return
+        self.reason = reason
+        self.cancelled.set()
+        if self.closer:
+            self.closer()
+
+class GenerationRegistry:
+    """Respuestas en curso, para cancelarlas por request_id o cuando el
+    navegador se desconecta.
+
+    Un hilo revisa cada poll_interval segundos los sockets de los clientes y
+    las cancelaciones guardadas en document_store (que pueden venir de otro
+    proceso con STATE_BACKEND 'sqlite'). También lleva la cuenta de los
+    tokens que se dejaron de generar: lo que dura en promedio una respuesta
+    completa menos lo que se llevaba generado al cancelar. Por cada modo
+    (ver Generation.mode) mide el tiempo hasta el primer token y los tokens
+    del prompt que Ollama procesó.
+    """
+
+    def __init__(self, poll_interval):
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.active = {}
+        self.monitor_thread = None
+        self.completed = 0
+        self.completed_tokens = 0
+        self.cancelled = Counter()
+        self.cancelled_tokens = 0
+        self.tokens_saved = 0
+        self.latency = {}  # modo -> [respuestas, segundos hasta el primer token, tokens del prompt procesados]
+
+    def start(self, request_id, is_disconnected=None):
+        generation = Generation(request_id, is_disconnected)
+        with self.lock:
+            self.active[request_id] = generation
+            if self.monitor_thread is None:
+                self.monitor_thread = threading.Thread(target=self.monitor, daemon=True)
+                self.monitor_thread.start()
+        # La cancelación pudo llegar antes que el pedido
+        if document_store.get_value(('cancel', request_id)):
+            generation.cancel('cancel')
+        return generation
+
+    def finish(self, generation):
+        with self.lock:
+            if self.active.get(generation.request_id) is generation:
+                del self.active[generation.request_id]
+            if generation.cancelled.is_set():
+                self.cancelled[generation.reason] += 1
+                self.cancelled_tokens += generation.tokens
+                if self.completed:
+                    expected = self.completed_tokens / self.completed
+                    self.tokens_saved += max(0, round(expected - generation.tokens))
+            else:
+                self.completed += 1
+                self.completed_tokens += generation.tokens
+            generation.record_metrics()
+            if generation.first_token is not None:
+                latency = self.latency.setdefault(generation.mode, [0, 0.0, 0])
+                latency[0] += 1
+                latency[1] += generation.first_token - generation.sent
+                latency[2] += generation.prompt_eval or 0
+        if generation.cancelled.is_set():
+            app.logger.info(f"Generación {generation.request_id} cancelada ({generation.reason}) "
+                            f"tras {generation.tokens} tokens")
+
+    def cancel(self, request_id):
+        """Cancela la respuesta; si está en otro proceso (o aún no empezó), la
+        verá el monitor de ese proceso. Devuelve True si estaba en este."""
+        document_store.set_value(('cancel', request_id), True, ttl=app.config['CANCEL_TTL'])
+        with self.lock:
+            generation = self.active.get(request_id)
+        if generation is None:
+            return False
+        generation.cancel('cancel')
+        return True
+
+    def monitor(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self.lock:
+                generations = list(self.active.values())
+            for generation in generations:
+                try:
+                    if generation.is_disconnected and generation.is_disconnected():
+                        generation.cancel('disconnect')
+                    elif document_store.get_value(('cancel', generation.request_id)):
+                        generation.cancel('cancel')
+                except Exception as e:
+                    app.logger.error(f"Error al revisar la generación {generation.request_id}: {str(e)}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                'active': len(self.active),
+                'completed': self.completed,
+                'cancelled': dict(self.cancelled),
+                'tokens_before_cancel': self.cancelled_tokens,
+                'tokens_saved': self.tokens_saved,
+                'first_token': {
+                    mode: {'count': count, 'mean_ms': round(seconds / count * 1000, 1),
+                           'mean_prompt_eval': round(prompt_eval / count)}
+                    for mode, (count, seconds, prompt_eval) in self.latency.items()
+                }
+            }
+
+generations = GenerationRegistry(app.config['CANCEL_POLL_INTERVAL'])
+
+def response_key(payload):
+    """Clave del pedido para reutilizar la respuesta, o None si el muestreo no
+    es determinista (sin temperatura 0 ni semilla cada respuesta es distinta)."""
+    options = payload.get('options', {})
+    if options.get('temperature') != 0 and 'seed' not in options:
+        return None
+    request = [payload['model'], payload.get('prompt'), payload.get('messages'), options]
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """Respuestas ya generadas, por response_key. Guarda como mucho
+    max_entries (descarta las usadas hace más tiempo) y cada una vale ttl
+    segundos."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # clave -> (respuesta, vencimiento)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            answer, expires = self.entries.get(key, (None, 0))
+            if answer is None or expires <= time.time():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return answer
+
+    def put(self, key, answer):
+        with self.lock:
+            self.entries[key] = (answer, time.time() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+class SharedResponse:
+    """Generación de Ollama que reciben todos los /chat con el mismo pedido.
+
+    Los textos se acumulan en parts; wait() los entrega a los hilos que
+    esperan y las funciones de listeners avisan (desde otro hilo) al servidor
+    asyncio.
+    """
+
+    def __init__(self, key, payload, ticket):
+        self.key = key
+        self.payload = payload
+        self.ticket = ticket
+        self.condition = threading.Condition()
+        self.parts = []
+        self.done = False
+        self.error = None
+        self.prompt_eval = None
+        self.ollama_stats = {}
+        self.sent = None
+        self.subscribers = 0
+        self.listeners = []
+        self.response = None
+        self.cancelled = False
+
+    def wait(self, index, timeout=0):
+        """Textos desde index (esperando hasta timeout segundos si aún no hay)
+        y si la generación terminó."""
+        with self.condition:
+            if timeout and len(self.parts) <= index and not self.done:
+                self.condition.wait(timeout)
+            return self.parts[index:], self.done
+
+    def add_listener(self, listener):
+        with self.condition:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.condition:
+            self.listeners.remove(listener)
+
+    def wake(self):
+        """Despierta a quienes esperan (al publicar, terminar o cancelar)."""
+        with self.condition:
+            self.condition.notify_all()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+
+    def publish(self, text):
+        with self.condition:
+            self.parts.append(text)
+        self.wake()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.error = error
+            self.done = True
+        self.wake()
+
+    def cancel(self):
+        """Nadie espera ya la respuesta: sale de la cola o corta la conexión."""
+        self.cancelled = True
+        ollama_scheduler.release(self.ticket)
+        if self.response is not None:
+            close_upstream(self.response)
+
+class ResponseBroker:
+    """Agrupa los pedidos idénticos en curso: el primero crea la
+    SharedResponse y los siguientes se suman a ella. La generación empieza
+    cuando ollama_scheduler le da turno, en un hilo propio (así sigue aunque
+    se desconecte quien la pidió primero), y se cancela cuando no queda nadie
+    esperándola. Las respuestas completas van a cache."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.coalesced = 0
+
+    def join(self, key, payload):
+        """Devuelve (shared, True si la creó), o (None, False) si la cola está llena."""
+        with self.lock:
+            shared = self.inflight.get(key)
+            created = shared is None
+            if created:
+                ticket = ollama_scheduler.enqueue(payload['model'])
+                if ticket is None:
+                    return None, False
+                shared = SharedResponse(key, payload, ticket)
+                self.inflight[key] = shared
+            else:
+                self.coalesced += 1
+            shared.subscribers += 1
+        if created:
+            ollama_scheduler.on_ready(shared.ticket, lambda: threading.Thread(
+                target=self.run, args=(shared,), daemon=True).start())
+        return shared, created
+
+    def leave(self, shared):
+        with self.lock:
+            shared.subscribers -= 1
+            abandoned = shared.subscribers == 0 and not shared.done
+            if abandoned and self.inflight.get(shared.key) is shared:
+                del self.inflight[shared.key]
+        if abandoned:
+            shared.cancel()
+
+    def run(self, shared):
+        try:
+            if shared.cancelled:
+                return
+            shared.sent = time.perf_counter()
+            shared.response = ollama.post(ollama_path(shared.payload), shared.payload, stream=True)
+            if shared.cancelled:
+                return
+            if shared.response.status_code != 200:
+                shared.finish(f"Error al conectar con Ollama API. Código de estado: {shared.response.status_code}. "
+                              f"Respuesta: {shared.response.text}")
+                return
+            for line in shared.response.iter_lines():
+                if not line:
+                    continue
+                try:
+                    json_response = json.loads(line)
+                except json.JSONDecodeError as e:
+                    app.logger.error(f"Error al decodificar JSON: {str(e)} para la línea: {line}")
+                    continue
+                text = json_response.get('response') or (json_response.get('message') or {}).get('content', '')
+                if text:
+                    shared.publish(text)
+                if 'prompt_eval_count' in json_response:
+                    shared.prompt_eval = json_response['prompt_eval_count']
+                if json_response.get('done'):
+                    shared.ollama_stats = {field: json_response[field] for field in OLLAMA_STAT_FIELDS
+                                           if field in json_response}
+            if not shared.cancelled:
+                # Guardar antes de dejar inflight: un pedido nuevo encuentra una u otra
+                self.cache.put(shared.key, ''.join(shared.parts))
+            shared.finish()
+        except requests.exceptions.Timeout:
+            shared.finish(OLLAMA_TIMEOUT_MESSAGE)
+        except requests.exceptions.ConnectionError:
+            if not shared.cancelled:
+                ollama_monitor.wake()
+            shared.finish(None if shared.cancelled else OLLAMA_CONNECTION_MESSAGE)
+        except Exception as e:
+            shared.finish(None if shared.cancelled else f"Error de conexión: {str(e)}")
+        finally:
+            if not shared.done:
+                shared.finish()
+            if shared.response is not None:
+                shared.response.close()
+            ollama_scheduler.release(shared.ticket)
+            with self.lock:
+                if self.inflight.get(shared.key) is shared:
+                    del self.inflight[shared.key]
+
+    def stats(self):
+        with self.lock:
+            return {'inflight': len(self.inflight), 'coalesced': self.coalesced, 'cache': self.cache.stats()}
+
+response_broker = ResponseBroker(ResponseCache(app.config['RESPONSE_CACHE_MAX_ENTRIES'], app.config['RESPONSE_CACHE_TTL']))
 
 # Emojis simplificados
 THINKING_EMOJI = '🤔'
 RESPONSE_EMOJI = '🤖'
 ERROR_EMOJI = '⚠️'
 
+# Expresiones del formateo de respuestas (ver format_math y prepare_markdown)
+BOXED_TEXT_RE = re.compile(r'\\boxed\{\\text\{([^}]*)\}\}')
+BOXED_RE = re.compile(r'\\boxed\{([^}]*)\}')
+DISPLAY_MATH_RE = re.compile(r'\\\[(.*?)\\\]', re.DOTALL)
+INLINE_MATH_RE = re.compile(r'\\\((.*?)\\\)')
+TEXT_COMMAND_RE = re.compile(r'\\text\{([^}]*)\}')
+CODE_BLOCK_RE = re.compile(r'```(\w*)\n(.*?)```', re.DOTALL)
+MATH_SPAN_RE = re.compile(r'\$\$.*?\$\$|\$.*?\$', re.DOTALL)
+MATH_PLACEHOLDER_RE = re.compile(r'MATH_BLOCK_(\d+)_')
+MATH_CLEANUP_PATTERNS = [
+    (re.compile(r'\\begin\{align\*?\}'), ''),
+    (re.compile(r'\\end\{align\*?\}'), ''),
+    (re.compile(r'\\begin\{equation\*?\}'), ''),
+    (re.compile(r'\\end\{equation\*?\}'), ''),
+    (re.compile(r'\\ '), ' '),  # Reemplazar \\ espacio con un espacio normal
+]
+BLANK_LINES_HTML_RE = re.compile(r'\n\s*\n')
+SENTENCE_BREAK_RE = re.compile(r'([.!?])\s*([A-Z])')
+
+# Todas las construcciones anteriores en una sola expresión, en el orden del texto
+FORMAT_TOKEN_RE = re.compile(r'''
+    \\boxed\{(?:\\text\{(?P<boxed_text>[^}]*)\}\}|(?P<boxed>[^}]*)\})
+  | \\\[(?P<display>.*?)\\\]
+  | \\\((?P<inline>[^\n]*?)\\\)
+  | \\text\{(?P<text>[^}]*)\}
+  | ```(?P<language>\w*)\n(?P<code>.*?)```
+  | (?P<math>\$\$.*?\$\$|\$.*?\$)
+''', re.DOTALL | re.VERBOSE)
+FORMAT_OPENER_RE = re.compile(r'\$|\\\[|\\\(|\\text\{|\\boxed\{|```')
+LATEX_COMMANDS = {'\\text{', '\\boxed{'}
+FENCE_BEFORE_RE = re.compile(r'```\w*$')
+
+# Un convertidor de markdown por hilo, reutilizado con reset()
+markdown_local = threading.local()
+
+# Separación entre bloques y líneas que pueden continuar el bloque anterior
+# después de una línea en blanco (indentación, citas y listas)
+BLANK_LINES_RE = re.compile(r'\n[ \t]*\n(?:[ \t]*\n)*')
+BLOCK_CONTINUATION_RE = re.compile(r'[ \t]|>|[*+-](?:[ \t]|$)|\d+\.(?:[ \t]|$)')
+REFERENCE_DEFINITION_RE = re.compile(r'^ {0,3}\[[^\]\n]+\]:', re.MULTILINE)
+HTML_TAG_RE = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9]*)\b[^>]*?(/?)>')
+
+@functools.lru_cache(maxsize=None)
+def block_level_tags():
+    """Etiquetas HTML de bloque según markdown (crear un Markdown compila
+    sus expresiones, así que se hace al primer uso)."""
+    return frozenset(markdown.Markdown().block_level_elements) - {'hr'}
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def extract_text_from_pdf(file_path):
+def file_sha256(source):
+    """Huella SHA-256 del contenido del archivo (su ruta o sus bytes)."""
+    if not isinstance(source, str):
+        return hashlib.sha256(source).hexdigest()
+    digest = hashlib.sha256()
+    with open(source, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class UploadBuffer:
+    """Archivo subido, escrito a medida que llega la solicitud.
+
+    Se guarda en memoria hasta spool_max_bytes; si crece más pasa a un archivo
+    temporal con nombre único en UPLOAD_FOLDER (así dos subidas con el mismo
+    nombre no se pisan). Al pasar de max_bytes corta la subida con un 413.
+    detach() entrega el contenido (bytes o la ruta del temporal) para
+    procesarlo después de la solicitud; si no se llamó, close() borra el
+    temporal.
+    """
+
+    def __init__(self, max_bytes, spool_max_bytes, folder, suffix=''):
+        self.max_bytes = max_bytes
+        self.spool_max_bytes = spool_max_bytes
+        self.folder = folder
+        self.suffix = suffix
+        self.file = io.BytesIO()
+        self.path = None
+        self.size = 0
+        self.detached = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.close()
+            raise RequestEntityTooLarge(f"El archivo supera el límite de {self.max_bytes // (1024 * 1024)} MB")
+        if self.path is None and self.size > self.spool_max_bytes:
+            fd, self.path = tempfile.mkstemp(suffix=self.suffix, dir=self.folder)
+            spooled = os.fdopen(fd, 'w+b')
+            spooled.write(self.file.getbuffer())
+            self.file = spooled
+        return self.file.write(data)
+
+    def read(self, *args):
+        return self.file.read(*args)
+
+    def readline(self, *args):
+        return self.file.readline(*args)
+
+    def seek(self, *args):
+        return self.file.seek(*args)
+
+    def tell(self):
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
+    def detach(self):
+        """Contenido del archivo: los bytes si está en memoria o la ruta del
+        temporal, que desde ahora borra quien lo procesa (ver discard_upload)."""
+        self.detached = True
+        if self.path is None:
+            return self.file.getvalue()
+        self.file.flush()
+        return self.path
+
+    def close(self):
+        self.file.close()
+        if self.path and not self.detached and os.path.exists(self.path):
+            os.remove(self.path)
+
+class UploadRequest(Request):
+    """Solicitud de Flask que recibe los archivos en un UploadBuffer, con el
+    límite de tamaño según el tipo de archivo."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upload_buffers = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        extension = os.path.splitext(filename or '')[1].lower()
+        max_bytes = app.config['PDF_MAX_BYTES'] if extension == '.pdf' else app.config['IMAGE_MAX_BYTES']
+        upload = UploadBuffer(max_bytes, app.config['UPLOAD_SPOOL_MAX_BYTES'], app.config['UPLOAD_FOLDER'], extension)
+        # Para borrar los temporales aunque la subida se corte a la mitad
+        self.upload_buffers.append(upload)
+        return upload
+
+    def close(self):
+        super().close()
+        for upload in self.upload_buffers:
+            upload.close()
+
+app.request_class = UploadRequest
+
+def discard_upload(source):
+    """Borra el archivo temporal de una subida ya procesada (los bytes en memoria no dejan nada)."""
+    if isinstance(source, str) and os.path.exists(source):
+        os.remove(source)
+
+def open_pdf(source):
+    """Abre un PDF desde su ruta o desde sus bytes."""
+    if isinstance(source, str):
+        return fitz.open(source)
+    return fitz.open(stream=source, filetype='pdf')
+
+def open_image(source):
+    """Abre una imagen desde su ruta o desde sus bytes."""
+    return Image.open(source if isinstance(source, str) else io.BytesIO(source))
+
+class PoolFile:
+    """Ruta de un PDF para los procesos de los pools, que lo abren por su
+    cuenta. Si el PDF está en memoria se escribe a un temporal la primera vez
+    que se pide (así no se copian los bytes a cada tarea) y discard() lo borra."""
+
+    def __init__(self, source):
+        self.source = source
+        self.path = source if isinstance(source, str) else None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.path is None:
+                fd, self.path = tempfile.mkstemp(suffix='.pdf', dir=app.config['UPLOAD_FOLDER'])
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(self.source)
+            return self.path
+
+    def discard(self):
+        if self.path is not None and self.path is not self.source:
+            discard_upload(self.path)
+
+class DiskCache:
+    """Caché persistente de resultados (texto de OCR, fragmentos de PDFs).
+
+    Cada entrada es un archivo JSON cuyo nombre es la huella del contenido del
+    archivo subido más los parámetros de extracción, así que sirve entre chats
+    y tras reiniciar. Cuando el total supera max_bytes se borran las entradas
+    usadas hace más tiempo (la fecha de modificación marca el último uso).
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = None  # clave -> tamaño, de la menos a la más usada
+        self.total_bytes = 0
+        self.hits = Counter()
+        self.misses = Counter()
+
+    @staticmethod
+    def make_key(content_hash, **params):
+        return hashlib.sha256(json.dumps([content_hash, params], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def load_entries(self):
+        """Lee las entradas existentes la primera vez que se usa la caché."""
+        if self.entries is not None:
+            return
+        self.entries = OrderedDict()
+        found = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.json'):
+                stat = os.stat(os.path.join(self.folder, name))
+                found.append((stat.st_mtime, name[:-5], stat.st_size))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.total_bytes += size
+
+    def get(self, kind, key):
+        """Devuelve el valor guardado o None; kind solo separa los contadores."""
+        path = os.path.join(self.folder, f'{key}.json')
+        with self.lock:
+            self.load_entries()
+            try:
+                with open(path, encoding='utf-8') as f:
+                    value = json.load(f)
+                os.utime(path)
+            except (OSError, ValueError):
+                self.misses[kind] += 1
+                return None
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.hits[kind] += 1
+            return value
+
+    def put(self, key, value):
+        data = json.dumps(value).encode('utf-8')
+        path = os.path.join(self.folder, f'{key}.json')
+        with self.lock:
+            self.load_entries()
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+            self.total_bytes += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                old_key, size = self.entries.popitem(last=False)
+                self.total_bytes -= size
+                try:
+                    os.remove(os.path.join(self.folder, f'{old_key}.json'))
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self.lock:
+            self.load_entries()
+            return {
+                'hits': dict(self.hits),
+                'misses': dict(self.misses),
+                'entries': len(self.entries),
+                'bytes': self.total_bytes
+            }
+
+result_cache = DiskCache(app.config['CACHE_FOLDER'], app.config['CACHE_MAX_BYTES'])
+
+class ChunkedText:
+    """Lista de textos guardada de forma compacta: un solo buffer UTF-8 y un
+    arreglo con la posición donde termina cada texto.
+
+    Se usa como una lista de solo agregar (append, len, índices e iteración).
+    compress() comprime el buffer con zlib para los documentos fríos; el
+    siguiente acceso lo descomprime.
+    """
+
+    def __init__(self, texts=()):
+        self.data = bytearray()
+        self.offsets = array('Q', [0])
+        self.compressed = None
+        self.lock = threading.Lock()
+        for text in texts:
+            self.append(text)
+
+    def thaw(self):
+        if self.compressed is not None:
+            self.data = bytearray(zlib.decompress(self.compressed))
+            self.compressed = None
+
+    def append(self, text):
+        with self.lock:
+            self.thaw()
+            self.data += text.encode('utf-8')
+            self.offsets.append(len(self.data))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('índice fuera de rango')
+        with self.lock:
+            self.thaw()
+            return self.data[self.offsets[index]:self.offsets[index + 1]].decode('utf-8')
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    @property
+    def nbytes(self):
+        stored = len(self.compressed) if self.compressed is not None else len(self.data)
+        return stored + self.offsets.itemsize * len(self.offsets)
+
+    def compress(self):
+        with self.lock:
+            if self.compressed is None:
+                self.compressed = zlib.compress(bytes(self.data), 1)
+                self.data = bytearray()
+
+    def to_bytes(self):
+        """Serializa los textos (comprimidos) para guardarlos en disco."""
+        with self.lock:
+            compressed = self.compressed if self.compressed is not None else zlib.compress(bytes(self.data), 1)
+            return struct.pack('<Q', len(self.offsets)) + self.offsets.tobytes() + compressed
+
+    @classmethod
+    def from_bytes(cls, raw):
+        texts = cls()
+        count, = struct.unpack_from('<Q', raw)
+        end = 8 + count * texts.offsets.itemsize
+        texts.offsets = array('Q')
+        texts.offsets.frombytes(raw[8:end])
+        texts.compressed = raw[end:]
+        return texts
+
+class DocumentStore:
+    """Textos de los documentos (fragmentos de PDFs, textos de imágenes por
+    chat) con un presupuesto de memoria.
+
+    Cada documento es un ChunkedText. Los que llevan más de compress_after
+    segundos sin usarse se comprimen; si la memoria supera max_bytes, los menos
+    usados se comprimen y después se pasan a disco, igual que los que llevan
+    más de ttl segundos sin usarse. get() los vuelve a cargar de disco sin que
+    se note. En disco se guardan hasta spill_max_bytes; por encima se borran
+    los más antiguos. on_spill(key) se llama al pasar un documento a disco,
+    para liberar lo que se haya construido a partir de él; charge() anota la
+    memoria de eso (los índices del PDF) en el presupuesto del documento.
+
+    Además guarda valores pequeños (avance de las ingestas, trabajos de OCR)
+    con get_value/set_value. Es el almacén por omisión, válido con un solo
+    proceso; SQLiteDocumentStore ofrece la misma interfaz entre procesos.
+    """
+
+    def __init__(self, folder, max_bytes, ttl, compress_after, spill_max_bytes, on_spill=None):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.compress_after = compress_after
+        self.spill_max_bytes = spill_max_bytes
+        self.on_spill = on_spill
+        self.lock = threading.RLock()
+        self.resident = OrderedDict()  # clave -> (documento, último uso), del menos al más usado
+        self.spilled = OrderedDict()  # clave -> tamaño en disco, del más antiguo al más nuevo
+        self.derived = {}  # clave -> bytes de lo construido a partir del documento
+        self.counters = Counter()
+        self.values = {}  # clave -> (valor, vencimiento o None)
+        # Los documentos en disco de una ejecución anterior ya no tienen clave.
+        # Solo en el proceso principal: los del pool (spawn) vuelven a importar
+        # app.py y borrarían los de este
+        os.makedirs(folder, exist_ok=True)
+        if multiprocessing.parent_process() is None:
+            for name in os.listdir(folder):
+                if name.endswith('.bin'):
+                    os.remove(os.path.join(folder, name))
+
+    def path(self, key):
+        name = hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, f'{name}.bin')
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.resident or key in self.spilled
+
+    def put(self, key, document):
+        """Guarda (o reemplaza) el documento y lo devuelve."""
+        with self.lock:
+            self.discard_spilled(key)
+            self.resident[key] = (document, time.time())
+            self.resident.move_to_end(key)
+            self.enforce(key)
+        return document
+
+    def get(self, key):
+        """Devuelve el documento, cargándolo de disco si hace falta, o None."""
+        with self.lock:
+            if key in self.resident:
+                document, _ = self.resident[key]
+                self.resident[key] = (document, time.time())
+                self.resident.move_to_end(key)
+            elif key in self.spilled:
+                try:
+                    with open(self.path(key), 'rb') as f:
+                        document = ChunkedText.from_bytes(f.read())
+                except OSError as e:
+                    # Alguien borró el archivo: el documento se perdió
+                    app.logger.warning(f"No se pudo leer de disco el documento {key}: {str(e)}")
+                    self.spilled.pop(key)
+                    self.counters['lost'] += 1
+                    return None
+                self.discard_spilled(key)
+                self.resident[key] = (document, time.time())
+                self.counters['reloads'] += 1
+            else:
+                return None
+            with document.lock:
+                document.thaw()
+            self.enforce(key)
+        return document
+
+    def append(self, key, text, create=True, fence=None):
+        """Agrega un texto al documento (creándolo si no existe) y lo devuelve.
+        Con fence (ver fenced) devuelve None sin agregar nada si ya no vale."""
+        with self.lock:
+            if fence and self.fenced(fence):
+                return None
+            document = self.get(key)
+            if document is None:
+                if not create:
+                    return None
+                document = self.put(key, ChunkedText())
+            document.append(text)
+            self.enforce(key)
+        return document
+
+    def pop(self, key):
+        with self.lock:
+            self.resident.pop(key, None)
+            self.derived.pop(key, None)
+            self.discard_spilled(key)
+
+    def charge(self, key, nbytes):
+        """Anota los bytes de lo construido a partir del documento (p. ej. sus
+        índices), que cuentan para max_bytes hasta que el documento pasa a disco."""
+        with self.lock:
+            if key not in self.resident:
+                return
+            self.derived[key] = nbytes
+            self.enforce(key)
+
+    def discard_spilled(self, key):
+        if self.spilled.pop(key, None) is not None:
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def spill(self, key):
+        """Pasa el documento a disco y lo saca de la memoria."""
+        document, _ = self.resident.pop(key)
+        data = document.to_bytes()
+        with open(self.path(key) + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(self.path(key) + '.tmp', self.path(key))
+        self.spilled[key] = len(data)
+        self.derived.pop(key, None)
+        self.counters['spills'] += 1
+        if self.on_spill:
+            self.on_spill(key)
+        while sum(self.spilled.values()) > self.spill_max_bytes and len(self.spilled) > 1:
+            old_key = next(iter(self.spilled))
+            app.logger.warning(f"Documento descartado por falta de espacio en disco: {old_key}")
+            self.discard_spilled(old_key)
+
+    def enforce(self, current=None):
+        """Aplica el TTL, la compresión de documentos fríos y el presupuesto de
+        memoria. El documento current (el que se está usando) no se toca."""
+        now = time.time()
+        for key, (document, last_used) in list(self.resident.items()):
+            if key == current:
+                continue
+            if now - last_used > self.ttl:
+                self.spill(key)
+            elif now - last_used > self.compress_after and document.compressed is None:
+                document.compress()
+        for key in list(self.resident):
+            if self.memory_bytes() <= self.max_bytes:
+                break
+            if key == current:
+                continue
+            document, _ = self.resident[key]
+            if document.compressed is None:
+                document.compress()
+                if self.memory_bytes() <= self.max_bytes:
+                    break
+            self.spill(key)
+
+    def memory_bytes(self):
+        return sum(document.nbytes for document, _ in self.resident.values()) + sum(self.derived.values())
+
+    def get_value(self, key):
+        with self.lock:
+            value, expires = self.values.get(key, (None, None))
+            if expires is not None and expires <= time.time():
+                del self.values[key]
+                return None
+            return value
+
+    def fenced(self, fence):
+        """fence es (clave de un valor, upload_id): True si el valor guardado
+        ya no tiene ese upload_id, p. ej. porque el mismo archivo se subió de
+        nuevo y la ingesta anterior no debe escribir más."""
+        value_key, upload_id = fence
+        value = self.get_value(value_key)
+        return value is None or value.get('upload_id') != upload_id
+
+    def set_value(self, key, value, ttl=None, fence=None):
+        """Guarda un valor; con ttl (segundos) deja de existir pasado ese tiempo.
+        Con fence (ver fenced) devuelve False sin guardar nada si ya no vale."""
+        with self.lock:
+            if fence and self.fenced(fence):
+                return False
+            now = time.time()
+            for old_key, (_, expires) in list(self.values.items()):
+                if expires is not None and expires <= now:
+                    del self.values[old_key]
+            self.values[key] = (value, now + ttl if ttl else None)
+        return True
+
+    def pop_value(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'backend': 'memory',
+                'resident': len(self.resident),
+                'compressed': sum(1 for document, _ in self.resident.values() if document.compressed is not None),
+                'spilled': len(self.spilled),
+                'bytes': self.memory_bytes(),
+                'derived_bytes': sum(self.derived.values()),
+                'spilled_bytes': sum(self.spilled.values()),
+                **self.counters
+            }
+
+class SQLiteDocument:
+    """Documento de SQLiteDocumentStore: se usa como un ChunkedText, pero cada
+    acceso lee de la base de datos, así ve lo que agregan otros procesos."""
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+
+    def __len__(self):
+        row = self.store.connection().execute(
+            'SELECT COUNT(*) FROM chunks WHERE key = ?', (self.store.encode(self.key),)).fetchone()
+        return row[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        row = self.store.connection().execute(
+            'SELECT text FROM chunks WHERE key = ? AND position = ?', (self.store.encode(self.key), index)).fetchone()
+        if row is None:
+            raise IndexError('índice fuera de rango')
+        return row[0]
+
+    def __iter__(self):
+        rows = self.store.connection().execute(
+            'SELECT text FROM chunks WHERE key = ? ORDER BY position', (self.store.encode(self.key),))
+        for row in rows:
+            yield row[0]
+
+class SQLiteDocumentStore:
+    """Misma interfaz que DocumentStore, guardada en un archivo SQLite en modo
+    WAL que pueden compartir varios procesos (p. ej. los workers de gunicorn).
+
+    Cada hilo usa su propia conexión. Los documentos no ocupan memoria del
+    proceso: get() devuelve un SQLiteDocument que lee los textos al usarlo.
+    Lo que cada proceso construye a partir de ellos (charge()) sí la ocupa: si
+    supera max_bytes se llama a on_spill(key) con los menos usados.
+    """
+
+    def __init__(self, path, max_bytes=None, on_spill=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.on_spill = on_spill
+        self.derived = OrderedDict()  # clave -> bytes, del menos al más usado
+        self.derived_lock = threading.Lock()
+        self.local = threading.local()
+        with self.connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS documents (key TEXT PRIMARY KEY)')
+            connection.execute('CREATE TABLE IF NOT EXISTS chunks (key TEXT, position INTEGER, text TEXT, '
+                               'PRIMARY KEY (key, position)) WITHOUT ROWID')
+            connection.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+
+    def connection(self):
+        # Una conexión por hilo y por proceso (no se heredan tras un fork)
+        if getattr(self.local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    @staticmethod
+    def encode(key):
+        return json.dumps(key)
+
+    def __contains__(self, key):
+        row = self.connection().execute('SELECT 1 FROM documents WHERE key = ?', (self.encode(key),)).fetchone()
+        return row is not None
+
+    def put(self, key, document):
+        """Guarda (o reemplaza) el documento y lo devuelve."""
+        connection = self.connection()
+        encoded = self.encode(key)
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('DELETE FROM chunks WHERE key = ?', (encoded,))
+            connection.execute('INSERT OR IGNORE INTO documents (key) VALUES (?)', (encoded,))
+            connection.executemany('INSERT INTO chunks (key, position, text) VALUES (?, ?, ?)',
+                                   [(encoded, position, text) for position, text in enumerate(document)])
+        return SQLiteDocument(self, key)
+
+    def get(self, key):
+        """Devuelve el documento o None."""
+        return SQLiteDocument(self, key) if key in self else None
+
+    def append(self, key, text, create=True, fence=None):
+        """Agrega un texto al documento (creándolo si no existe) y lo devuelve.
+        Con fence (ver DocumentStore.fenced) devuelve None sin agregar nada si ya no vale."""
+        connection = self.connection()
+        encoded = self.encode(key)
+        with connection:
+            # BEGIN IMMEDIATE toma el bloqueo de escritura, así dos procesos no
+            # pueden calcular la misma posición
+            connection.execute('BEGIN IMMEDIATE')
+            if fence and self.fenced(fence, connection):
+                return None
+            if create:
+                connection.execute('INSERT OR IGNORE INTO documents (key) VALUES (?)', (encoded,))
+            elif connection.execute('SELECT 1 FROM documents WHERE key = ?', (encoded,)).fetchone() is None:
+                return None
+            connection.execute('INSERT INTO chunks (key, position, text) SELECT ?, COUNT(*), ? FROM chunks WHERE key = ?',
+                               (encoded, text, encoded))
+        return SQLiteDocument(self, key)
+
+    def pop(self, key):
+        connection = self.connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('DELETE FROM chunks WHERE key = ?', (self.encode(key),))
+            connection.execute('DELETE FROM documents WHERE key = ?', (self.encode(key),))
+        with self.derived_lock:
+            self.derived.pop(key, None)
+
+    def derived_bytes(self):
+        with self.derived_lock:
+            return sum(self.derived.values())
+
+    def charge(self, key, nbytes):
+        """Anota los bytes de lo construido a partir del documento en este
+        proceso y libera lo de los documentos menos usados si pasa de max_bytes."""
+        with self.derived_lock:
+            self.derived[key] = nbytes
+            self.derived.move_to_end(key)
+            released = []
+            while self.max_bytes is not None and sum(self.derived.values()) > self.max_bytes and len(self.derived) > 1:
+                released.append(self.derived.popitem(last=False)[0])
+        for old_key in released:
+            if self.on_spill:
+                self.on_spill(old_key)
+
+    def get_value(self, key):
+        row = self.connection().execute(
+            'SELECT value FROM state WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (self.encode(key), time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def fenced(self, fence, connection=None):
+        """Como DocumentStore.fenced; con connection, dentro de su transacción."""
+        value_key, upload_id = fence
+        row = (connection or self.connection()).execute('SELECT value FROM state WHERE key = ?', (self.encode(value_key),)).fetchone()
+        return row is None or json.loads(row[0]).get('upload_id') != upload_id
+
+    def set_value(self, key, value, ttl=None, fence=None):
+        connection = self.connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            if fence and self.fenced(fence, connection):
+                return False
+            connection.execute('DELETE FROM state WHERE expires IS NOT NULL AND expires <= ?', (time.time(),))
+            connection.execute('INSERT OR REPLACE INTO state (key, value, expires) VALUES (?, ?, ?)',
+                               (self.encode(key), json.dumps(value), time.time() + ttl if ttl else None))
+        return True
+
+    def pop_value(self, key):
+        connection = self.connection()
+        with connection:
+            connection.execute('DELETE FROM state WHERE key = ?', (self.encode(key),))
+
+    def stats(self):
+        # Sin COUNT(*): recorrería las tablas enteras en cada /health y /metrics
+        return {
+            'backend': 'sqlite',
+            'file_bytes': os.path.getsize(self.path),
+            'derived_bytes': self.derived_bytes()
+        }
+
+def drop_derived_data(key):
+    """Libera los índices de un PDF que pasa a disco; se reconstruyen (o se
+    vuelven a abrir de disco) al usarlos."""
+    if key[0] == 'pdf':
+        app.config.get('pdf_index', {}).pop(key[1], None)
+        # Un índice semántico que se está creando se conserva para no repetir los embeddings
+        vectors = app.config.get('pdf_vectors', {})
+        if vectors.get(key[1]) is not None and vectors[key[1]].ready.is_set():
+            vectors.pop(key[1], None)
+
+# Estado de las sesiones: fragmentos de cada PDF con la clave ('pdf', nombre),
+# textos de las imágenes de cada chat en orden de subida con la clave
+# ('images', id del chat), y como valores el avance de cada ingesta
+# ('ingestion', nombre) y los trabajos de OCR ('ocr_job', id)
+if app.config['STATE_BACKEND'] == 'sqlite':
+    document_store = SQLiteDocumentStore(
+        app.config['STATE_DATABASE'], app.config['DOCUMENT_STORE_MAX_BYTES'], on_spill=drop_derived_data
+    )
+elif app.config['STATE_BACKEND'] == 'memory':
+    document_store = DocumentStore(
+        app.config['DOCUMENTS_FOLDER'], app.config['DOCUMENT_STORE_MAX_BYTES'], app.config['DOCUMENT_TTL'],
+        app.config['DOCUMENT_COMPRESS_AFTER'], app.config['DOCUMENT_SPILL_MAX_BYTES'], on_spill=drop_derived_data
+    )
+else:
+    raise ValueError(f"STATE_BACKEND desconocido: {app.config['STATE_BACKEND']!r} (debe ser 'memory' o 'sqlite')")
+
+# Pools de procesos ('pdf' para extraer PDFs grandes, 'ocr' para tesseract),
+# creados la primera vez que se usan
+process_pools = {}
+process_pools_lock = threading.Lock()
+
+def get_process_pool(name, max_workers):
+    with process_pools_lock:
+        if name not in process_pools:
+            # 'spawn' también en Linux: hacer fork de un servidor con hilos puede bloquearse
+            process_pools[name] = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return process_pools[name]
+
+def discard_process_pool(name):
+    """Descarta el pool (p. ej. si un proceso murió) para crear uno nuevo la próxima vez."""
+    with process_pools_lock:
+        pool = process_pools.pop(name, None)
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def extract_page_range(file_path, start, end):
+    """Extrae el texto de las páginas [start, end) abriendo su propio documento."""
+    doc = fitz.open(file_path)
+    try:
+        return [doc[page_num].get_text() for page_num in range(start, end)]
+    finally:
+        doc.close()
+
+def ocr_pdf_page(file_path, page_num, dpi, lang):
+    """Renderiza una página sin capa de texto y la pasa por tesseract (se
+    ejecuta en el pool 'ocr'). Devuelve el texto y los segundos que tomó."""
+    start_time = time.time()
     try:
+        configure_tesseract()
         doc = fitz.open(file_path)
-        text = ""
+        try:
+            pixmap = doc[page_num].get_pixmap(dpi=dpi)
+        finally:
+            doc.close()
+        image = Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+        text = pytesseract.image_to_string(image, lang=lang)
+    except Exception as e:
+        # Igual que en ocr_image: no todas las excepciones llegan al proceso principal
+        raise RuntimeError(str(e)) from None
+    return text, time.time() - start_time
+
+def iter_pdf_pages(source, pool_file):
+    """Genera el texto de la capa de texto de cada página, en orden. Los PDFs
+    grandes se extraen por rangos de páginas en paralelo (los procesos abren
+    el archivo de pool_file)."""
+    doc = open_pdf(source)
+    try:
         total_pages = doc.page_count
         logging.info(f"Procesando PDF con {total_pages} páginas")
+        pages_done = 0
         
-        for page_num, page in enumerate(doc, 1):
-            page_text = page.get_text()
-            text += page_text
-            logging.debug(f"Página {page_num}/{total_pages} procesada")
+        workers = app.config['PDF_EXTRACT_WORKERS']
+        if workers > 1 and total_pages >= app.config['PDF_PARALLEL_MIN_PAGES']:
+            # Varios rangos por proceso para repartir mejor las páginas lentas, y
+            # no demasiado grandes para que el texto empiece a llegar pronto
+            range_size = max(1, min(32, math.ceil(total_pages / (workers * 4))))
+            starts = list(range(0, total_pages, range_size))
+            ends = [min(start + range_size, total_pages) for start in starts]
+            try:
+                parts = get_process_pool('pdf', workers).map(extract_page_range, [pool_file.get()] * len(starts), starts, ends)
+                for part in parts:
+                    for page_text in part:
+                        yield page_text
+                        pages_done += 1
+                logging.info(f"Páginas extraídas en paralelo con {workers} procesos")
+            except Exception as e:
+                logging.error(f"Error en la extracción en paralelo, se continúa en serie: {str(e)}")
+                discard_process_pool('pdf')
         
+        for page_num in range(pages_done, total_pages):
+            yield doc[page_num].get_text()
+            logging.debug(f"Página {page_num + 1}/{total_pages} procesada")
+    finally:
         doc.close()
+
+def iter_pdf_text(source, ocr_stats=None):
+    """Genera el texto del PDF en orden como pares (páginas procesadas, texto).
+
+    Las páginas sin capa de texto (escaneadas) se renderizan y se pasan por OCR
+    en el pool 'ocr', hasta PDF_OCR_MAX_PAGES por documento; mientras tanto se
+    sigue leyendo el resto, y el texto se entrega siempre en orden de página.
+    Cada PDF tiene a lo sumo OCR_WORKERS páginas en el pool a la vez, así las
+    imágenes subidas no esperan detrás de todo un PDF escaneado.
+    En ocr_stats quedan las páginas pasadas por OCR, las omitidas por el límite
+    y el tiempo de cada una. source es la ruta del PDF o sus bytes.
+    """
+    if ocr_stats is None:
+        ocr_stats = {}
+    ocr_stats.update({'pages': 0, 'skipped': 0, 'seconds': 0.0, 'timings': []})
+    pending = deque()  # (número de página, texto o Future del OCR)
+    in_flight = 0  # Futures de pending, páginas enviadas al pool
+    pool_file = PoolFile(source)
+    
+    def resolve(page_num, item):
+        if not isinstance(item, Future):
+            return item
+        try:
+            text, seconds = item.result()
+        except Exception as e:
+            logging.error(f"Error en el OCR de la página {page_num + 1}: {str(e)}")
+            if isinstance(e, BrokenProcessPool):
+                discard_process_pool('ocr')
+            return ''
+        ocr_stats['seconds'] += seconds
+        ocr_stats['timings'].append({'page': page_num + 1, 'seconds': round(seconds, 3)})
+        upload_stage_seconds.observe(seconds, 'pdf', 'ocr_page')
+        logging.info(f"OCR de la página {page_num + 1}: {len(text.strip())} caracteres en {seconds:.2f}s")
+        return text.strip() + '\n' if text.strip() else ''
+    
+    try:
+        for page_num, text in enumerate(iter_pdf_pages(source, pool_file)):
+            if not text.strip():
+                if ocr_stats['pages'] < app.config['PDF_OCR_MAX_PAGES']:
+                    ocr_stats['pages'] += 1
+                    # Con el cupo lleno, esperar (en orden) a las páginas ya enviadas
+                    while in_flight >= app.config['OCR_WORKERS']:
+                        done_page, item = pending.popleft()
+                        in_flight -= isinstance(item, Future)
+                        yield done_page + 1, resolve(done_page, item)
+                    in_flight += 1
+                    try:
+                        text = get_process_pool('ocr', app.config['OCR_WORKERS']).submit(
+                            ocr_pdf_page, pool_file.get(), page_num, app.config['PDF_OCR_DPI'], app.config['OCR_LANG'])
+                    except BrokenProcessPool as e:
+                        discard_process_pool('ocr')
+                        text = Future()
+                        text.set_exception(e)
+                else:
+                    ocr_stats['skipped'] += 1
+            pending.append((page_num, text))
+            # Entregar en orden todo lo que ya está listo
+            while pending and (not isinstance(pending[0][1], Future) or pending[0][1].done()):
+                page_num, item = pending.popleft()
+                in_flight -= isinstance(item, Future)
+                yield page_num + 1, resolve(page_num, item)
+        
+        while pending:
+            page_num, item = pending.popleft()
+            yield page_num + 1, resolve(page_num, item)
+    finally:
+        pool_file.discard()
+    
+    if ocr_stats['skipped']:
+        logging.warning(f"{ocr_stats['skipped']} páginas escaneadas quedaron sin OCR por el límite de {app.config['PDF_OCR_MAX_PAGES']}")
+
+def extract_text_from_pdf(source):
+    try:
+        text = ''.join(part for _, part in iter_pdf_text(source))
         logging.info(f"PDF procesado completamente. Texto extraído: {len(text)} caracteres")
         return text
     except Exception as e:
@@ -147,17 +1827,290 @@ def chunk_text(text, chunk_size):
     
     return chunks
 
+def iter_chunks(texts, chunk_size):
+    """Versión incremental de chunk_text: recibe el texto por partes y genera
+    cada fragmento en cuanto se completa. El resultado es el mismo que el de
+    chunk_text sobre el texto unido."""
+    current_chunk = []
+    pending = ''  # Palabra que puede continuar en la parte siguiente
+    for text in texts:
+        text = pending + text
+        words = text.split()
+        pending = ''
+        if words and not text[-1].isspace():
+            pending = words.pop()
+        for word in words:
+            if len(current_chunk) >= chunk_size and current_chunk:
+                yield ' '.join(current_chunk)
+                current_chunk = []
+            current_chunk.append(word)
+    if pending:
+        if len(current_chunk) >= chunk_size and current_chunk:
+            yield ' '.join(current_chunk)
+            current_chunk = []
+        current_chunk.append(pending)
+    if current_chunk:
+        yield ' '.join(current_chunk)
+
+# Palabras vacías en español e inglés, ya sin tildes (ver normalize_terms)
+STOPWORDS = set('''
+a al algo algun alguna algunas alguno algunos ante antes aqui asi aun bajo bien cada casi como con contra cual
+cuales cuando de del desde donde dos el ella ellas ello ellos en entre era eran es esa esas ese eso esos esta
+estaba estan estar este esto estos fue fueron ha habia han hasta hay la las le les lo los mas me mi mientras
+mismo mucho muy nada ni no nos nosotros o os otra otras otro otros para pero poco por porque que quien se sea
+ser si sido sin sobre solo son su sus tambien tan tanto te tiene tienen todo todos tu un una uno unos usted ya
+yo about above after again all also am an and any are as at be because been before being between both but by
+can could did do does doing down during each few for from further had has have having he her here hers him his
+how i if in into is it its itself just more most my no nor not of off on once only or other our out over own
+same she should so some such than that the their them then there these they this those through to too under
+until up very was we were what when where which while who whom why will with would you your
+'''.split())
+TERM_RE = re.compile(r'\w+')
+
+@functools.lru_cache(maxsize=100000)
+def normalize_term(word):
+    """Quita las tildes y reduce los plurales simples (casos -> caso).
+    Devuelve None para las palabras vacías."""
+    if not word.isascii():
+        word = ''.join(char for char in unicodedata.normalize('NFKD', word) if not unicodedata.combining(char))
+    if len(word) < 2 or word in STOPWORDS:
+        return None
+    if len(word) > 4 and word.endswith('s') and not word.endswith('ss'):
+        word = word[:-1]
+    return word
+
+def normalize_terms(text):
+    """Convierte el texto en la lista de términos de búsqueda del índice BM25."""
+    terms = map(normalize_term, TERM_RE.findall(text.lower()))
+    return [term for term in terms if term]
+
+class BM25Index:
+    """Índice invertido BM25 sobre los fragmentos de un documento.
+
+    Los fragmentos se agregan con add() a medida que se procesa el PDF, así
+    que se puede buscar antes de que termine la ingesta. Cada término guarda
+    los fragmentos donde aparece con su frecuencia; la normalización por
+    longitud de cada fragmento se recalcula solo cuando llegan fragmentos
+    nuevos, de modo que una búsqueda solo recorre los términos de la pregunta.
+    """
+
+    def __init__(self, chunks=(), k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.lengths = []
+        self.total_length = 0
+        self.norms = []
+        self.nbytes = 0  # Estimación de la memoria que ocupa
+        self.lock = threading.Lock()
+        for chunk in chunks:
+            self.add(chunk)
+
+    def add(self, chunk):
+        """Agrega el siguiente fragmento del documento al índice."""
+        counts = Counter(normalize_terms(chunk))
+        with self.lock:
+            chunk_id = len(self.lengths)
+            for term, tf in counts.items():
+                if term not in self.postings:
+                    self.postings[term] = []
+                    self.nbytes += 160 + len(term)  # Cadena, lista vacía y entrada del diccionario
+                self.postings[term].append((chunk_id, tf))
+            # Cada aparición: tupla, entero y puntero en la lista; cada fragmento: largo y norma
+            self.nbytes += 100 * len(counts) + 80
+            length = sum(counts.values())
+            self.lengths.append(length)
+            self.total_length += length
+
+    def search(self, query, top_k):
+        """Devuelve los índices de los top_k fragmentos más relevantes, del más al menos relevante."""
+        k1 = self.k1
+        scores = {}
+        with self.lock:
+            num_chunks = len(self.lengths)
+            if len(self.norms) != num_chunks:
+                average_length = (self.total_length / num_chunks) if self.total_length else 1.0
+                self.norms = [k1 * (1 - self.b + self.b * length / average_length) for length in self.lengths]
+            norms = self.norms
+            for term in set(normalize_terms(query)):
+                postings = self.postings.get(term, ())
+                idf = math.log(1 + (num_chunks - len(postings) + 0.5) / (len(postings) + 0.5))
+                for chunk_id, tf in postings:
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (k1 + 1) / (tf + norms[chunk_id])
+        return [chunk_id for chunk_id, _ in heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])]
+
+# Las llamadas de embeddings de todos los documentos comparten este pool
+embedding_executor = ThreadPoolExecutor(max_workers=app.config['EMBEDDING_WORKERS'], thread_name_prefix='embeddings')
+
+def embed_texts(texts):
+    """Obtiene de Ollama un embedding por cada texto de la lista."""
+    response = ollama.post('/api/embed', {
+        'model': app.config['EMBEDDING_MODEL'],
+        'input': texts,
+        'keep_alive': app.config['OLLAMA_KEEP_ALIVE']
+    })
+    response.raise_for_status()
+    return response.json()['embeddings']
+
+def split_passages(chunks, passage_size):
+    """Divide cada fragmento en pasajes de passage_size palabras.
+    Devuelve los pasajes y la posición donde empieza cada fragmento."""
+    passages = []
+    starts = []
+    for chunk in chunks:
+        words = chunk.split()
+        starts.append(len(passages))
+        for i in range(0, max(len(words), 1), passage_size):
+            passages.append(' '.join(words[i:i + passage_size]))
+    return passages, starts
+
+class VectorIndex:
+    """Índice semántico de un PDF guardado en disco junto al documento.
+
+    Los embeddings normalizados de los pasajes se guardan en <ruta>.npy y los
+    metadatos (modelo, huella del texto y dónde empieza cada fragmento) en
+    <ruta>.json. La matriz se abre con memory-map, así que tras reiniciar el
+    servidor un PDF ya indexado no se vuelve a embeber.
+    """
+
+    def __init__(self, path, chunks, embed=embed_texts):
+        self.path = path
+        self.chunks = chunks
+        self.embed = embed
+        self.digest = hashlib.sha256('\0'.join(chunks).encode('utf-8')).hexdigest()
+        self.matrix = None
+        self.starts = None
+        self.error = None
+        self.ready = threading.Event()
+
+    @property
+    def nbytes(self):
+        return self.matrix.nbytes + self.starts.nbytes if self.ready.is_set() else 0
+
+    def metadata(self):
+        return {
+            'model': app.config['EMBEDDING_MODEL'],
+            'passage_size': app.config['EMBEDDING_PASSAGE_SIZE'],
+            'digest': self.digest
+        }
+
+    def load(self):
+        """Abre el índice guardado si corresponde al mismo texto y modelo."""
+        try:
+            with open(self.path + '.json', encoding='utf-8') as f:
+                saved = json.load(f)
+            if {key: saved.get(key) for key in self.metadata()} != self.metadata():
+                return False
+            self.matrix = np.load(self.path + '.npy', mmap_mode='r')
+            self.starts = np.asarray(saved['starts'], dtype=np.intp)
+        except (OSError, ValueError, KeyError):
+            return False
+        self.ready.set()
+        return True
+
+    def build(self):
+        """Embebe los pasajes por lotes y guarda la matriz en disco."""
+        try:
+            start_time = time.time()
+            passages, starts = split_passages(self.chunks, app.config['EMBEDDING_PASSAGE_SIZE'])
+            batch_size = app.config['EMBEDDING_BATCH_SIZE']
+            batches = [passages[i:i + batch_size] for i in range(0, len(passages), batch_size)]
+            vectors = []
+            for batch_vectors in embedding_executor.map(self.embed, batches):
+                vectors.extend(batch_vectors)
+
+            matrix = np.asarray(vectors, dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            matrix /= norms
+
+            # Escribir en archivos temporales y renombrar, para no dejar un índice a medias
+            with open(self.path + '.npy.tmp', 'wb') as f:
+                np.save(f, matrix)
+            with open(self.path + '.json.tmp', 'w', encoding='utf-8') as f:
+                json.dump({**self.metadata(), 'starts': starts}, f)
+            os.replace(self.path + '.npy.tmp', self.path + '.npy')
+            os.replace(self.path + '.json.tmp', self.path + '.json')
+
+            self.matrix = np.load(self.path + '.npy', mmap_mode='r')
+            self.starts = np.asarray(starts, dtype=np.intp)
+            self.chunks = None  # El texto ya no hace falta y así no queda retenido en memoria
+            self.ready.set()
+            app.logger.info(f"Índice semántico creado: {len(passages)} pasajes en {time.time() - start_time:.1f}s")
+        except Exception as e:
+            self.error = str(e)
+            app.logger.error(f"Error al crear el índice semántico: {str(e)}")
+
+    def search(self, query_vector, top_k):
+        """Devuelve los índices de los top_k fragmentos cuyo mejor pasaje se parece más a la consulta."""
+        query = np.array(query_vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1
+        # Un producto matriz-vector y la mejor puntuación de pasaje de cada fragmento
+        chunk_scores = np.maximum.reduceat(self.matrix @ query, self.starts)
+        top_k = min(top_k, len(chunk_scores))
+        best = np.argpartition(-chunk_scores, top_k - 1)[:top_k]
+        return [int(i) for i in best[np.argsort(-chunk_scores[best])]]
+
+# Índices BM25 de este proceso, por PDF: (id de la subida, índice). Se
+# construyen a partir de document_store, así que cada worker tiene los suyos
+app.config['pdf_index'] = {}
+pdf_index_lock = threading.Lock()
+
+def charge_pdf_indexes(filename):
+    """Anota la memoria de los índices del PDF en el presupuesto de document_store."""
+    _, bm25 = app.config['pdf_index'].get(filename, (None, None))
+    vectors = app.config.get('pdf_vectors', {}).get(filename)
+    document_store.charge(('pdf', filename), (bm25.nbytes if bm25 else 0) + (vectors.nbytes if vectors else 0))
+
+def get_pdf_index(filename, chunks, upload_id=None):
+    """Índice BM25 del PDF al día con chunks. Se vuelve a construir si se
+    descartó porque el documento pasó a disco, si el PDF se subió de nuevo o
+    si otro proceso lo agregó al estado compartido."""
+    with pdf_index_lock:
+        saved_id, index = app.config['pdf_index'].get(filename, (None, None))
+        if index is None or saved_id != upload_id:
+            index = BM25Index()
+            app.config['pdf_index'][filename] = (upload_id, index)
+        added = len(chunks) - len(index.lengths)
+        for i in range(len(index.lengths), len(chunks)):
+            index.add(chunks[i])
+    if added:
+        charge_pdf_indexes(filename)
+    return index
+
+def start_vector_index(filename, chunks):
+    """Abre el índice semántico guardado del PDF o empieza a crearlo en segundo plano."""
+    index = VectorIndex(os.path.join(app.config['UPLOAD_FOLDER'], f'{filename}.vectors'), chunks)
+    if not index.load():
+        threading.Thread(target=index.build, daemon=True).start()
+    return index
+
+def semantic_search(filename, query, top_k):
+    """Busca con el índice semántico del PDF; devuelve None si aún no está listo o falla."""
+    if not app.config['EMBEDDING_MODEL']:
+        return None
+    index = app.config.get('pdf_vectors', {}).get(filename)
+    if index is None and ('pdf', filename) in document_store:
+        # Otro proceso hizo la ingesta, o el pedido eligió 'semantic' sin que
+        # fuera el RETRIEVAL_MODE: abrir el índice guardado o empezar a crearlo
+        index = start_vector_index(filename, document_store.get(('pdf', filename)))
+        app.config.setdefault('pdf_vectors', {})[filename] = index
+    if not index or not index.ready.is_set():
+        app.logger.info("El índice semántico no está listo, se usa BM25")
+        return None
+    charge_pdf_indexes(filename)
+    try:
+        return index.search(embed_texts([query])[0], top_k)
+    except Exception as e:
+        app.logger.error(f"Error en la búsqueda semántica: {str(e)}")
+        return None
+
 @app.route('/')
 def home():
     try:
-        # Verificar que Ollama esté funcionando
-        try:
-            response = requests.get('http://localhost:11434/api/tags', timeout=5)
-            if response.status_code != 200:
-                app.logger.error("Ollama no está respondiendo correctamente")
-                return render_template('error.html', error="Ollama no está respondiendo. Por favor, asegúrate de que Ollama esté corriendo.")
-        except requests.exceptions.RequestException as e:
-            app.logger.error(f"No se puede conectar con Ollama: {str(e)}")
+        # Verificar que Ollama esté funcionando (último estado conocido; si
+        # aún no se revisó, se muestra la página)
+        if ollama_monitor.snapshot()['healthy'] is False:
             return render_template('error.html', error="No se puede conectar con Ollama. Por favor, asegúrate de que Ollama esté corriendo.")
         
         return render_template('index.html')
@@ -165,7 +2118,15 @@ def home():
         app.logger.error(f"Error en la ruta principal: {str(e)}")
         return render_template('error.html', error="Error interno del servidor")
 
+@app.route('/models', methods=['GET'])
+def list_models():
+    """Modelos instalados en Ollama, de la última revisión de ollama_monitor.
+    Antes de la primera revisión responde pending y la página vuelve a pedirlos."""
+    state = ollama_monitor.snapshot()
+    return jsonify({'success': state['healthy'] is not False, 'pending': state['healthy'] is None, **state})
+
 @app.route('/upload', methods=['POST'])
+@timed_upload('pdf')
 def upload_file():
     try:
         if 'file' not in request.files:
@@ -181,61 +2142,193 @@ def upload_file():
             app.logger.error(f"Tipo de archivo no permitido: {file.filename}")
             return jsonify({'success': False, 'error': 'Tipo de archivo no permitido'}), 400
         
+        filename = secure_filename(file.filename)
+        source = None
         try:
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
-            app.logger.info(f"Archivo guardado exitosamente: {file_path}")
-            
             if filename.lower().endswith('.pdf'):
-                # Procesar PDF
-                text = extract_text_from_pdf(file_path)
-                if not text:
-                    raise Exception("No se pudo extraer texto del PDF")
+                # El PDF se procesa desde donde quedó al recibirlo: en memoria, o
+                # en un temporal si es grande (ver UploadBuffer)
+                source = file.stream.detach()
+                app.logger.info(f"PDF recibido: {filename} ({file.stream.size} bytes"
+                                f"{', en disco' if isinstance(source, str) else ''})")
                 
-                chunks = chunk_text(text, app.config['MAX_CHUNK_SIZE'])
-                if not chunks:
-                    raise Exception("No se pudo dividir el texto en fragmentos")
+                # Validar el PDF y procesarlo en segundo plano; se puede preguntar
+                # sobre los fragmentos que ya estén listos
+                doc = open_pdf(source)
+                total_pages = doc.page_count
+                doc.close()
                 
-                if 'pdf_chunks' not in app.config:
-                    app.config['pdf_chunks'] = {}
-                app.config['pdf_chunks'][filename] = chunks
+                # Si ya se procesó un PDF idéntico, reutilizar sus fragmentos
+                cache_key = DiskCache.make_key(
+                    file_sha256(source), kind='pdf', chunk_size=app.config['MAX_CHUNK_SIZE'],
+                    ocr_lang=app.config['OCR_LANG'], ocr_dpi=app.config['PDF_OCR_DPI'],
+                    ocr_max_pages=app.config['PDF_OCR_MAX_PAGES']
+                )
+                cached = result_cache.get('pdf', cache_key)
+                cached_chunks = cached['chunks'] if cached else None
                 
-                os.remove(file_path)  # Limpiar archivo temporal
-                app.logger.info(f"PDF procesado exitosamente: {len(chunks)} fragmentos")
+                # Primero el upload_id nuevo y después el documento vacío: una
+                # ingesta anterior del mismo nombre ya no puede escribir en él
+                upload_id = uuid.uuid4().hex
+                document_store.set_value(('ingestion', filename), {
+                    'upload_id': upload_id,
+                    'status': 'running',
+                    'pages_total': total_pages,
+                    'pages_processed': total_pages if cached else 0,
+                    'chunks': 0,
+                    'semantic_index': None,
+                    'error': None
+                })
+                document_store.put(('pdf', filename), ChunkedText())
+                app.config.get('pdf_vectors', {}).pop(filename, None)
+                threading.Thread(target=ingest_pdf, args=(filename, source, cache_key, upload_id, cached_chunks),
+                                 daemon=True).start()
                 
                 return jsonify({
                     'success': True,
-                    'message': f'PDF procesado exitosamente',
+                    'message': 'PDF recibido, procesando en segundo plano',
                     'filename': filename,
-                    'num_chunks': len(chunks)
+                    'num_chunks': len(cached_chunks) if cached else 0,
+                    'total_pages': total_pages,
+                    'ingesting': True,
+                    'cached': bool(cached)
                 })
             
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            file.save(file_path)
+            app.logger.info(f"Archivo guardado exitosamente: {file_path}")
             return jsonify({'success': True, 'filename': filename})
             
         except Exception as e:
             app.logger.error(f"Error procesando archivo: {str(e)}")
-            if os.path.exists(file_path):
-                os.remove(file_path)  # Limpiar en caso de error
+            discard_upload(source)  # Limpiar en caso de error
             return jsonify({'success': False, 'error': str(e)}), 500
         
+    except RequestEntityTooLarge as e:
+        app.logger.error(f"Archivo demasiado grande: {e.description}")
+        return jsonify({'success': False, 'error': e.description}), 413
     except Exception as e:
         app.logger.error(f"Error en upload_file: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+class IngestionSuperseded(Exception):
+    """El mismo archivo se volvió a subir mientras se procesaba."""
+
+def ingest_pdf(filename, pdf_source, cache_key, upload_id, cached_chunks=None):
+    """Procesa el PDF subido (su ruta o sus bytes) en segundo plano.
+
+    Las páginas pasan al fragmentador a medida que se extraen y cada fragmento
+    terminado se publica en document_store y en el índice BM25, así /chat puede
+    usarlo enseguida. El avance se publica como ('ingestion', filename) en
+    document_store. Con cached_chunks (de la caché) no se extrae nada: solo se
+    indexan. Si el archivo se vuelve a subir, cada escritura lleva el
+    upload_id de esta subida y la ingesta se detiene en la primera rechazada.
+    """
+    fence = (('ingestion', filename), upload_id)
+    progress = document_store.get_value(('ingestion', filename))
+    if document_store.fenced(fence):
+        discard_upload(pdf_source)
+        return
+    start_time = time.time()
+    
+    def publish():
+        if not document_store.set_value(('ingestion', filename), progress, fence=fence):
+            raise IngestionSuperseded()
+    
+    def pages():
+        progress['ocr'] = {}
+        for pages_processed, text in iter_pdf_text(pdf_source, progress['ocr']):
+            progress['pages_processed'] = pages_processed
+            publish()
+            yield text
+    
+    try:
+        if cached_chunks is None:
+            source = iter_chunks(pages(), app.config['MAX_CHUNK_SIZE'])
+        else:
+            source = cached_chunks
+        chunks = document_store.get(('pdf', filename))
+        for chunk in source:
+            chunks = document_store.append(('pdf', filename), chunk, fence=fence)
+            if chunks is None:
+                raise IngestionSuperseded()
+            get_pdf_index(filename, chunks, progress['upload_id'])
+            progress['chunks'] = len(chunks)
+            publish()
+        if not chunks:
+            raise Exception("No se pudo extraer texto del PDF")
+        if cached_chunks is None:
+            texts = list(chunks)
+            # Si el upload_id sigue siendo el de esta subida después de leerlos,
+            # el documento no se reemplazó mientras tanto
+            if document_store.fenced(fence):
+                raise IngestionSuperseded()
+            result_cache.put(cache_key, {'chunks': texts, 'pages': progress['pages_total']})
+            upload_stage_seconds.observe(time.time() - start_time, 'pdf', 'extraction')
+        
+        # Índice semántico, una vez que están todos los fragmentos (solo si se
+        # usa: cada embedding es un pedido a Ollama y puede obligarlo a cambiar de modelo)
+        if app.config['EMBEDDING_MODEL'] and app.config['RETRIEVAL_MODE'] == 'semantic':
+            if document_store.fenced(fence):
+                raise IngestionSuperseded()
+            if 'pdf_vectors' not in app.config:
+                app.config['pdf_vectors'] = {}
+            vector_index = start_vector_index(filename, chunks)
+            app.config['pdf_vectors'][filename] = vector_index
+            progress['semantic_index'] = 'ready' if vector_index.ready.is_set() else 'building'
+        
+        progress['status'] = 'done'
+        app.logger.info(f"PDF procesado exitosamente: {len(chunks)} fragmentos en {time.time() - start_time:.1f}s")
+    except IngestionSuperseded:
+        app.logger.info(f"Ingesta de {filename} detenida: el archivo se volvió a subir")
+    except Exception as e:
+        progress['status'] = 'error'
+        progress['error'] = str(e)
+        app.logger.error(f"Error procesando PDF: {str(e)}")
+    finally:
+        try:
+            publish()
+        except IngestionSuperseded:
+            pass  # El estado ya es el de la subida nueva
+        discard_upload(pdf_source)  # Limpiar archivo temporal
+
+@app.route('/upload_progress/<filename>', methods=['GET'])
+def upload_progress(filename):
+    """Avance de la ingesta de un PDF. Con ?stream=1 envía una línea NDJSON
+    por cada cambio hasta que la ingesta termina."""
+    key = ('ingestion', secure_filename(filename))
+    progress = document_store.get_value(key)
+    if progress is None:
+        return jsonify({'success': False, 'error': 'PDF no encontrado'}), 404
+    
+    if not request.args.get('stream'):
+        return jsonify({'success': True, **progress})
+    return stream_status(key)
+
+def stream_status(key):
+    """Envía el valor de document_store como NDJSON, una línea por cada
+    cambio, hasta que deja de estar 'queued' o 'running'."""
+    def generate():
+        last = None
+        while True:
+            state = document_store.get_value(key)
+            if state is None:
+                return
+            current = dict(state)
+            if current != last:
+                yield json.dumps(current) + '\n'
+                last = current
+            if current['status'] not in ('queued', 'running'):
+                return
+            time.sleep(app.config['STATUS_POLL_INTERVAL'])
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 def clean_math_expressions(text):
     """Limpia y formatea expresiones matemáticas."""
     # No eliminar los backslashes necesarios para LaTeX
-    replacements = {
-        r'\\begin\{align\*?\}': '',
-        r'\\end\{align\*?\}': '',
-        r'\\begin\{equation\*?\}': '',
-        r'\\end\{equation\*?\}': '',
-        r'\\ ': ' '  # Reemplazar \\ espacio con un espacio normal
-    }
-    
-    for pattern, replacement in replacements.items():
-        text = re.sub(pattern, replacement, text)
+    for pattern, replacement in MATH_CLEANUP_PATTERNS:
+        text = pattern.sub(replacement, text)
     
     return text
 
@@ -247,19 +2340,15 @@ def format_math(text):
         return f'$${content}$$'
 
     # Procesar comandos especiales de LaTeX antes de los bloques matemáticos
-    text = re.sub(r'\\boxed\{\\text\{([^}]*)\}\}', r'<div class="boxed">\1</div>', text)
-    text = re.sub(r'\\boxed\{([^}]*)\}', r'<div class="boxed">\1</div>', text)
+    text = BOXED_TEXT_RE.sub(r'<div class="boxed">\1</div>', text)
+    text = BOXED_RE.sub(r'<div class="boxed">\1</div>', text)
     
-    # Procesar bloques matemáticos inline y display
-    text = re.sub(r'\$\$(.*?)\$\$', lambda m: f'$${m.group(1)}$$', text, flags=re.DOTALL)
-    text = re.sub(r'\$(.*?)\$', lambda m: f'${m.group(1)}$', text)
-    text = re.sub(r'\\\[(.*?)\\\]', process_math_content, text, flags=re.DOTALL)
-    text = re.sub(r'\\\((.*?)\\\)', lambda m: f'${m.group(1)}$', text)
+    # Procesar bloques matemáticos display e inline
+    text = DISPLAY_MATH_RE.sub(process_math_content, text)
+    text = INLINE_MATH_RE.sub(lambda m: f'${m.group(1)}$', text)
     
-    # Preservar comandos LaTeX específicos
-    text = re.sub(r'\\times(?![a-zA-Z])', r'\\times', text)  # Preservar \times
-    text = re.sub(r'\\frac\{([^}]*)\}\{([^}]*)\}', r'\\frac{\1}{\2}', text)  # Preservar fracciones
-    text = re.sub(r'\\text\{([^}]*)\}', r'\1', text)  # Manejar \text correctamente
+    # Manejar \text correctamente (\times y \frac se dejan tal cual)
+    text = TEXT_COMMAND_RE.sub(r'\1', text)
     
     return text
 
@@ -270,42 +2359,168 @@ def format_code_blocks(text):
         code = match.group(2).strip()
         return f'```{language}\n{code}\n```'
 
-    # Procesar bloques de código
-    text = re.sub(r'```(\w*)\n(.*?)```', replace_code_block, text, flags=re.DOTALL)
-    return text
+    # Procesar bloques de código
+    text = CODE_BLOCK_RE.sub(replace_code_block, text)
+    return text
+
+def rewrite_latex_commands(text):
+    """Aplica \\boxed{} y \\text{} dentro de una expresión; None si alguno queda abierto."""
+    text = BOXED_TEXT_RE.sub(r'<div class="boxed">\1</div>', text)
+    text = BOXED_RE.sub(r'<div class="boxed">\1</div>', text)
+    if '\\boxed{' in text:
+        return None
+    text = TEXT_COMMAND_RE.sub(r'\1', text)
+    if '\\text{' in text:
+        return None
+    return text
+
+def joins_code_fence(text, start, end, content):
+    """Indica si quitar un comando podría formar o completar un bloque de código."""
+    return ('`' in content or text[start - 1:start] == '`' or text[end:end + 1] == '`'
+            or FENCE_BEFORE_RE.search(text, max(0, start - 64), start) is not None)
+
+def prepare_markdown(text):
+    """Protege matemáticas y código y reescribe LaTeX en una sola pasada.
+
+    Devuelve el texto listo para markdown y las expresiones matemáticas que se
+    sustituyeron por MATH_BLOCK_n_. Devuelve None cuando las construcciones se
+    solapan (por ejemplo un $ dentro de \\[...\\] o un \\text{ sin cerrar dentro
+    de un \\boxed{}) y el resultado depende del orden de la cascada de
+    format_math y format_code_blocks.
+    """
+    parts = []
+    math_blocks = []
+    pos = 0
+    lone_dollar = False
+
+    def protect(expression):
+        math_blocks.append(expression)
+        return f'MATH_BLOCK_{len(math_blocks)-1}_'
+
+    for match in FORMAT_TOKEN_RE.finditer(text):
+        start, end = match.span()
+        if text.find('$', pos, start) != -1:
+            # Un $ sin pareja: el $ que añadan \\[ o \\( más adelante lo cerraría
+            lone_dollar = True
+        parts.append(text[pos:start])
+        pos = end
+        kind = match.lastgroup
+        content = match.group(kind)
+        openers = set(FORMAT_OPENER_RE.findall(content))
+
+        if kind == 'boxed' and '\\text{' in openers:
+            # \\boxed{x \\text{ o } y}: el \\text{ que queda dentro del recuadro se
+            # cierra con la siguiente llave del texto, como en format_math
+            head, _, rest = content.partition('\\text{')
+            close = text.find('}', end)
+            following = text[end:close] if close != -1 else ''
+            if (FORMAT_OPENER_RE.search(head + rest + following)
+                    or joins_code_fence(text, start, close + 1 if close != -1 else end, content + following)):
+                return None
+            if close == -1:
+                parts.append(f'<div class="boxed">{content}</div>')
+            else:
+                parts.append(f'<div class="boxed">{head}{rest}</div>{following}')
+                pos = close + 1
+
+        elif kind in ('boxed_text', 'boxed', 'text'):
+            if openers or joins_code_fence(text, start, end, content):
+                return None
+            parts.append(content if kind == 'text' else f'<div class="boxed">{content}</div>')
+
+        elif kind == 'display':
+            if lone_dollar or not LATEX_COMMANDS.issuperset(openers):
+                return None
+            content = BOXED_RE.sub(r'<div class="boxed">\1</div>', BOXED_TEXT_RE.sub(r'<div class="boxed">\1</div>', content))
+            if '\\boxed{' in content:
+                return None
+            content = TEXT_COMMAND_RE.sub(r'\1', clean_math_expressions(content.strip()))
+            if '\\text{' in content:
+                return None
+            parts.append(protect(f'$${content}$$'))
 
-def format_response(text):
-    """Formatea la respuesta completa con soporte para markdown, código y matemáticas."""
-    # Primero formatear expresiones matemáticas
-    text = format_math(text)
-    
-    # Formatear bloques de código
-    text = format_code_blocks(text)
-    
-    # Convertir markdown a HTML preservando las expresiones matemáticas
-    # Escapar temporalmente las expresiones matemáticas
+        elif kind == 'inline':
+            if lone_dollar or not (LATEX_COMMANDS | {'\\('}).issuperset(openers):
+                return None
+            if openers & LATEX_COMMANDS:
+                content = rewrite_latex_commands(content)
+            if not content:
+                return None
+            parts.append(protect(f'${content}$'))
+
+        elif kind == 'code':
+            if openers - {'$'}:
+                return None
+            language = match.group('language') or 'plaintext'
+            code = f'```{language}\n{content.strip()}\n```'
+            if openers:
+                # Los $ del código se emparejan entre sí, igual que en la cascada
+                spans = list(MATH_SPAN_RE.finditer(code))
+                last_end = spans[-1].end() if spans else 0
+                if '$' in code[last_end:] or any(span.group(0) == '$$' for span in spans):
+                    return None
+                code = MATH_SPAN_RE.sub(lambda span: protect(span.group(0)), code)
+            parts.append(code)
+
+        else:
+            if content == '$$' or openers - LATEX_COMMANDS - {'$'}:
+                return None
+            if openers & LATEX_COMMANDS:
+                content = rewrite_latex_commands(content)
+                if content is None:
+                    return None
+            parts.append(protect(content))
+
+    parts.append(text[pos:])
+    return ''.join(parts), math_blocks
+
+def prepare_markdown_cascade(text):
+    """Prepara el texto para markdown aplicando las expresiones una tras otra."""
+    text = format_code_blocks(format_math(text))
     math_blocks = []
     def math_replace(match):
         math_blocks.append(match.group(0))
-        return f'MATH_BLOCK_{len(math_blocks)-1}'
+        return f'MATH_BLOCK_{len(math_blocks)-1}_'
+
+    return MATH_SPAN_RE.sub(math_replace, text), math_blocks
+
+def get_markdown():
+    """Devuelve el convertidor de markdown del hilo actual, listo para reutilizar."""
+    md = getattr(markdown_local, 'md', None)
+    if md is None:
+        md = markdown_local.md = markdown.Markdown(extensions=['fenced_code', 'tables'])
+    return md.reset()
+
+def format_response(text):
+    """Formatea la respuesta completa con soporte para markdown, código y matemáticas."""
+    return render_html(text).strip()
 
-    # Guardar expresiones matemáticas
-    text = re.sub(r'\$\$.*?\$\$|\$.*?\$', math_replace, text, flags=re.DOTALL)
+def render_html(text):
+    """Convierte el texto a HTML sin recortar los espacios de los extremos."""
+    # Formatear matemáticas y código y escapar temporalmente las expresiones
+    # matemáticas para que markdown no las modifique
+    prepared = prepare_markdown(text)
+    if prepared is None:
+        prepared = prepare_markdown_cascade(text)
+    text, math_blocks = prepared
     
     # Convertir markdown a HTML
-    md = markdown.Markdown(extensions=['fenced_code', 'tables'])
-    text = md.convert(text)
+    text = get_markdown().convert(text)
     
-    # Restaurar expresiones matemáticas
-    for i, block in enumerate(math_blocks):
-        text = text.replace(f'MATH_BLOCK_{i}', block)
+    # Restaurar expresiones matemáticas (el _ final evita que MATH_BLOCK_1
+    # coincida con el prefijo de MATH_BLOCK_10 o con dígitos del texto)
+    if math_blocks:
+        text = MATH_PLACEHOLDER_RE.sub(
+            lambda m: math_blocks[int(m.group(1))] if int(m.group(1)) < len(math_blocks) else m.group(0),
+            text
+        )
     
     # Limpiar y formatear el texto
     text = text.replace('</think>', '').replace('<think>', '')
-    text = re.sub(r'\n\s*\n', '\n\n', text)
-    text = re.sub(r'([.!?])\s*([A-Z])', r'\1\n\2', text)
+    text = BLANK_LINES_HTML_RE.sub('\n\n', text)
+    text = SENTENCE_BREAK_RE.sub(r'\1\n\2', text)
     
-    return text.strip()
+    return text
 
 def decorate_message(message, is_error=False):
     """Decora el mensaje con emojis y formato apropiado."""
@@ -316,6 +2531,285 @@ def decorate_message(message, is_error=False):
     formatted_message = format_response(message)
     return f"{emoji} {formatted_message}"
 
+def last_match_end(pattern, text):
+    """Devuelve la posición donde termina la última coincidencia del patrón."""
+    end = 0
+    for match in pattern.finditer(text):
+        end = match.end()
+    return end
+
+def has_unclosed_brace(text, command):
+    """Indica si la última aparición de un comando como \\boxed{ no tiene llave de cierre."""
+    start = text.rfind(command)
+    return start != -1 and '}' not in text[start + len(command):]
+
+def html_blocks_closed(text):
+    """Comprueba que las etiquetas HTML de bloque del texto estén balanceadas."""
+    depth = {}
+    for closing, tag, self_closing in HTML_TAG_RE.findall(text):
+        tag = tag.lower()
+        if tag not in block_level_tags() or self_closing:
+            continue
+        depth[tag] = max(0, depth.get(tag, 0) + (-1 if closing else 1))
+    return not any(depth.values())
+
+def segment_is_closed(segment):
+    """Indica si un segmento se renderiza igual solo que seguido de más bloques.
+
+    Ninguna construcción que pueda abarcar líneas en blanco (\\boxed{}, \\text{},
+    \\[ \\], bloques de código, expresiones $...$ o HTML de bloque) puede quedar
+    abierta al final del segmento.
+    """
+    text = format_math(segment)
+    for command in ('\\boxed{', '\\text{'):
+        if has_unclosed_brace(segment, command) or has_unclosed_brace(text, command):
+            return False
+    if '\\[' in text:
+        return False
+    if '```' in text[last_match_end(CODE_BLOCK_RE, text):]:
+        return False
+    text = format_code_blocks(text)
+    if '$' in text[last_match_end(MATH_SPAN_RE, text):]:
+        return False
+    # Un $$ sin cierre se toma como $...$ vacío, pero podría cerrarse más adelante
+    if any(match.group(0) == '$$' for match in MATH_SPAN_RE.finditer(text)):
+        return False
+    text = MATH_SPAN_RE.sub('MATH_BLOCK_', text)
+    fences = [match.span() for match in fenced_code.FencedBlockPreprocessor.FENCED_BLOCK_RE.finditer(text)]
+    for fence in re.finditer(r'^(?:~{3,}|`{3,})', text, re.MULTILINE):
+        if not any(start <= fence.start() < end for start, end in fences):
+            return False
+    return html_blocks_closed(text)
+
+class IncrementalRenderer:
+    """Renderiza una respuesta en streaming sin volver a procesar los bloques terminados.
+
+    El texto se divide en bloques separados por líneas en blanco. Un bloque queda
+    terminado cuando todo lo que abre está cerrado y la primera línea del bloque
+    siguiente no puede continuarlo (listas, citas, indentación); a partir de ahí
+    su HTML se conserva y en cada token solo se vuelve a renderizar el final
+    abierto. El HTML resultante es el mismo que format_response(texto completo)
+    y siempre comienza por done_html, que solo crece mientras el renderizado es
+    incremental.
+    """
+
+    def __init__(self):
+        self.text = ''
+        self.html = ''
+        self.done_html = ''     # HTML de los bloques terminados
+        self.done_length = 0    # Caracteres del texto incluidos en done_html
+        self.separator = '\n'   # Lo que markdown pone entre done_html y el bloque siguiente
+        self._scan_pos = 0      # Desde dónde buscar el siguiente límite de bloque
+        self._incremental = True
+
+    def feed(self, chunk):
+        """Agrega un fragmento de la respuesta y devuelve el HTML completo actualizado."""
+        line_start = self.text.rfind('\n') + 1
+        self.text += chunk
+
+        # Las definiciones de referencias ([id]: url) afectan a todo el documento,
+        # así que a partir de ahí se renderiza siempre el texto completo
+        if self._incremental and REFERENCE_DEFINITION_RE.search(self.text, line_start):
+            self._incremental = False
+            self.done_html = ''
+            self.done_length = 0
+
+        if not self._incremental:
+            self.html = format_response(self.text)
+            return self.html
+
+        self._close_blocks()
+
+        tail_html = render_html(self.text[self.done_length:])
+        if not self.done_html:
+            self.html = tail_html.strip()
+        elif not tail_html.strip():
+            self.html = self.done_html
+        elif tail_html[0].isspace() or not self.joins_cleanly(tail_html):
+            # Caso poco frecuente: el límite se normaliza junto al bloque anterior
+            self.html = format_response(self.text)
+        else:
+            self.html = f"{self.done_html}{self.separator}{tail_html.rstrip()}"
+        return self.html
+
+    def joins_cleanly(self, html):
+        """Indica si unir done_html con el HTML siguiente no cambia el formateo final.
+
+        Con un separador de varias líneas (tras un bloque HTML) la separación de
+        oraciones de render_html uniría un punto final con una mayúscula inicial.
+        """
+        return self.separator == '\n' or not (self.done_html[-1:] in '.!?' and html[:1].isupper())
+
+    def _close_blocks(self):
+        """Marca como terminados los bloques cuyo final ya es definitivo."""
+        while True:
+            separator = BLANK_LINES_RE.search(self.text, self._scan_pos)
+            if not separator:
+                return
+            next_start = separator.end()
+            line_end = self.text.find('\n', next_start)
+            if line_end == -1:
+                # Aún no se sabe si la siguiente línea continúa el bloque
+                return
+            self._scan_pos = next_start
+
+            if BLOCK_CONTINUATION_RE.match(self.text[next_start:line_end]):
+                continue
+            segment = self.text[self.done_length:separator.start()]
+            if not segment_is_closed(segment):
+                continue
+            segment_html = render_html(segment)
+            if segment_html != segment_html.strip():
+                continue
+            if segment_html:
+                # Averiguar el separador que markdown usa tras este bloque
+                probe_html = render_html(f"{segment}\n\nx")
+                if not (probe_html.startswith(segment_html) and probe_html.endswith('<p>x</p>')):
+                    continue
+                if self.done_html and not self.joins_cleanly(segment_html):
+                    continue
+                separator = probe_html[len(segment_html):-len('<p>x</p>')]
+                if separator.strip():
+                    continue
+                self.done_html = f"{self.done_html}{self.separator}{segment_html}" if self.done_html else segment_html
+                self.separator = separator
+            self.done_length = next_start
+
+class ResponseStream:
+    """Convierte los tokens de Ollama en las líneas NDJSON que recibe el navegador.
+
+    En modo 'snapshot' cada token produce una línea con todo el HTML decorado
+    ({'response': ...}), como esperan los clientes antiguos. En modo 'delta' los
+    tokens se agrupan durante flush_interval segundos (o hasta flush_tokens) y
+    cada línea lleva un número de secuencia, el HTML de los bloques terminados
+    desde la línea anterior ('append') y el HTML del bloque abierto ('tail'),
+    que sustituye al anterior. Con 'reset' el cliente descarta lo recibido antes.
+
+    push() solo envía lo agrupado al llegar un token. Para que el último token
+    antes de una pausa de Ollama no quede retenido, quien espera los tokens
+    usa flush_due() como tiempo máximo de espera y llama a flush() al
+    vencer. Lo hacen async_server.py y las respuestas compartidas; la ruta
+    /chat de Flask sin respuesta compartida lee de Ollama sin tiempo de
+    espera, así que ahí lo agrupado sale con el token siguiente o al terminar.
+    """
+
+    def __init__(self, mode='snapshot', flush_interval=0.04, flush_tokens=32):
+        self.mode = mode
+        self.flush_interval = flush_interval
+        self.flush_tokens = flush_tokens
+        self.renderer = IncrementalRenderer()
+        self.seq = 0
+        self.pending = []
+        self.sent_stable = 0
+        self.last_flush = 0.0
+        self.render_seconds = 0.0  # Tiempo total dedicado a renderizar el HTML
+
+    def render(self, text):
+        started = time.perf_counter()
+        html = self.renderer.feed(text)
+        self.render_seconds += time.perf_counter() - started
+        return html
+
+    def push(self, token):
+        """Agrega un token y devuelve la línea a enviar, o None si se sigue agrupando."""
+        if self.mode != 'delta':
+            decorated_response = f"{RESPONSE_EMOJI} {self.render(token)}"
+            return json.dumps({'response': decorated_response}) + '\n'
+
+        self.pending.append(token)
+        if (len(self.pending) >= self.flush_tokens
+                or time.monotonic() - self.last_flush >= self.flush_interval):
+            return self.flush()
+        return None
+
+    def flush_due(self):
+        """Segundos hasta que lo agrupado deba enviarse (0 si ya venció), o
+        None si no hay nada pendiente."""
+        if not self.pending:
+            return None
+        return max(0.0, self.last_flush + self.flush_interval - time.monotonic())
+
+    def flush(self):
+        """Envía los tokens agrupados pendientes, si los hay."""
+        if not self.pending:
+            return None
+        html = self.render(''.join(self.pending))
+        self.pending = []
+        self.last_flush = time.monotonic()
+
+        decorated_response = f"{RESPONSE_EMOJI} {html}"
+        stable = len(decorated_response) - len(html) + len(self.renderer.done_html)
+        self.seq += 1
+        frame = {'seq': self.seq}
+        if stable < self.sent_stable:
+            frame['reset'] = True
+            self.sent_stable = 0
+        if stable > self.sent_stable:
+            frame['append'] = decorated_response[self.sent_stable:stable]
+        frame['tail'] = decorated_response[stable:]
+        self.sent_stable = stable
+        return json.dumps(frame) + '\n'
+
+# Codificación de tiktoken, cargada la primera vez que se cuentan tokens
+token_encoding = None
+token_encoding_loaded = False
+
+def get_token_encoding():
+    """Devuelve la codificación cl100k_base, o None si no se pudo cargar
+    (tiktoken la descarga la primera vez y puede no haber conexión)."""
+    global token_encoding, token_encoding_loaded
+    if not token_encoding_loaded:
+        token_encoding_loaded = True
+        try:
+            token_encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception as e:
+            app.logger.warning(f"No se pudo cargar tiktoken, se estimarán los tokens: {str(e)}")
+    return token_encoding
+
+def count_tokens(text):
+    """Cuenta los tokens del texto. cl100k_base no es el tokenizador de los
+    modelos de Ollama, pero se acerca lo suficiente para repartir el presupuesto."""
+    encoding = get_token_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text, max_tokens):
+    """Recorta el texto a sus primeros max_tokens tokens."""
+    encoding = get_token_encoding()
+    if encoding is None:
+        return text[:max_tokens * 4]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+def fit_context(items, budget, min_tokens=64):
+    """Elige los textos de contexto que caben en budget tokens.
+
+    items son pares (posición, texto) en orden de prioridad. Se incluyen
+    enteros mientras quepan; el primero que no cabe se recorta si quedan al
+    menos min_tokens, y el resto se descarta. Devuelve los pares incluidos y
+    la cuenta de tokens.
+    """
+    kept = []
+    used = 0
+    truncated = 0
+    for position, text in items:
+        cost = count_tokens(text) + 1  # Más la línea en blanco que los separa
+        if used + cost <= budget:
+            kept.append((position, text))
+            used += cost
+        elif not truncated and budget - used >= min_tokens:
+            text = truncate_to_tokens(text, budget - used - 1)
+            kept.append((position, text))
+            used += count_tokens(text) + 1
+            truncated = 1
+    accounting = {
+        'context': used,
+        'included': len(kept),
+        'truncated': truncated,
+        'dropped': len(items) - len(kept)
+    }
+    return kept, accounting
+
 def get_thinking_message():
     """Genera un mensaje de 'pensando' aleatorio."""
     messages = [
@@ -327,179 +2821,1160 @@ def get_thinking_message():
     ]
     return f"{THINKING_EMOJI} {random.choice(messages)}"
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    data = request.json
+OLLAMA_TIMEOUT_MESSAGE = "La solicitud está tomando más tiempo de lo esperado. Por favor, intenta con un mensaje más corto o espera un momento."
+OLLAMA_CONNECTION_MESSAGE = "No se pudo conectar con Ollama. Por favor, verifica que Ollama esté corriendo."
+OLLAMA_BUSY_MESSAGE = "Hay demasiadas solicitudes en espera. Por favor, intenta de nuevo en unos momentos."
+
+# Modo conversación: el documento va en el mensaje de sistema (que no cambia
+# en toda la conversación) y lo que aparece después, en el turno del usuario
+CONVERSATION_SYSTEM = {
+    'pdf': """Responde las preguntas del usuario basándote en el contenido proporcionado del PDF.
+Si la respuesta podría estar en otros fragmentos no incluidos, indícalo y sugiere revisar otros fragmentos.
+
+Fragmentos del PDF:
+
+{context}""",
+    'images': """Responde las preguntas del usuario basándote en el contenido de las imágenes del chat.
+
+Las imágenes contienen este texto:
+
+{context}"""
+}
+CONVERSATION_TURN = {
+    'pdf': """Fragmentos adicionales del PDF:
+
+{context}
+
+Pregunta del usuario:
+{question}""",
+    'images': """Imágenes nuevas:
+
+{context}
+
+Pregunta del usuario:
+{question}"""
+}
+# Turno que pregunta por una imagen en particular ("esta imagen"): va de
+# nuevo en el mensaje del usuario aunque ya esté en la conversación
+CONVERSATION_FOCUS = {
+    'images': """La pregunta se refiere a esta imagen:
+
+{context}
+
+Pregunta del usuario:
+{question}
+
+Por favor, responde la pregunta basándote en el contenido de la imagen mencionada."""
+}
+
+def build_conversation(chat_id, question, source, items, budget, focus=None):
+    """Arma los mensajes de /api/chat para un turno del chat.
+
+    El historial se guarda como ('conversation', chat_id) en document_store y
+    solo crece al final, así Ollama reutiliza el prompt ya procesado (su caché
+    KV) y en cada turno solo lee lo nuevo. El mensaje de sistema con el
+    contexto del documento se arma en el primer turno y no se vuelve a tocar;
+    los fragmentos (o imágenes) que aparecen después van en el mensaje del
+    usuario de ese turno. Si no caben el historial y los fragmentos nuevos
+    (hasta la mitad de lo que deja el sistema), se descartan los turnos más
+    antiguos. Cambiar de documento empieza una conversación nueva. focus
+    (pares como items) reemplaza a los textos nuevos del turno: son los que la
+    pregunta menciona, y se repiten aunque ya estén en la conversación.
+    Devuelve (mensajes, turn, cuenta de tokens); turn se completa con la
+    respuesta en save_turn.
+    """
+    state = document_store.get_value(('conversation', chat_id))
+    if state is None or (state['source'] and source and state['source'] != source):
+        state = {'source': None, 'system': None, 'system_tokens': 0, 'system_positions': [], 'messages': []}
+    messages = list(state['messages'])
+    system, system_tokens, system_positions = state['system'], state['system_tokens'], state['system_positions']
+    kind = source[0] if source else None
+    turn_template = CONVERSATION_FOCUS[kind] if focus else CONVERSATION_TURN.get(kind)
+    question_tokens = count_tokens(question)
+    
+    if system is None and items:
+        template = CONVERSATION_SYSTEM[kind]
+        history_tokens = sum(message['tokens'] for message in messages)
+        overhead = count_tokens(template.format(context=''))
+        share = int(budget * app.config['CONVERSATION_DOCUMENT_SHARE'])
+        kept, _ = fit_context(items, min(share, budget - question_tokens - history_tokens) - overhead)
+        kept.sort()
+        if kept:
+            system = template.format(context="\n\n".join(text for _, text in kept))
+            system_tokens = count_tokens(system)
+            system_positions = [position for position, _ in kept]
+    
+    while True:
+        history_tokens = sum(message['tokens'] for message in messages)
+        known = set(system_positions)
+        for message in messages:
+            known.update(message.get('positions', ()))
+        new_items = focus or [(position, text) for position, text in items if position not in known]
+        room = budget - system_tokens - history_tokens
+        if new_items:
+            overhead = count_tokens(turn_template.format(context='', question=question))
+            wanted = overhead + min(sum(count_tokens(text) + 1 for _, text in new_items),
+                                    (budget - system_tokens) // 2)
+        else:
+            overhead = wanted = question_tokens
+        # Descartar el turno más antiguo (pregunta y respuesta) si falta lugar
+        if messages and wanted > room:
+            del messages[:2]
+            continue
+        break
+    
+    kept = fit_context(new_items, room - overhead)[0] if new_items else []
+    kept.sort()
+    if kept:
+        content = turn_template.format(context="\n\n".join(text for _, text in kept), question=question)
+    else:
+        content = question
+    user = {'role': 'user', 'content': content, 'tokens': count_tokens(content),
+            'positions': [position for position, _ in kept]}
+    
+    chat_messages = [{'role': 'system', 'content': system}] if system else []
+    chat_messages += [{'role': message['role'], 'content': message['content']} for message in messages + [user]]
+    accounting = {
+        'history': len(messages) // 2,
+        'included': len(system_positions) + len(kept),
+        'prompt': system_tokens + history_tokens + user['tokens']
+    }
+    turn = {
+        'chat_id': chat_id,
+        'mode': 'chat_followup' if messages else 'chat_first',
+        'state': {'source': source or state['source'], 'system': system, 'system_tokens': system_tokens,
+                  'system_positions': system_positions, 'messages': messages},
+        'user': user
+    }
+    return chat_messages, turn, accounting
+
+def save_turn(turn, answer):
+    """Agrega la pregunta y la respuesta al historial del chat."""
+    state = dict(turn['state'])
+    state['messages'] = state['messages'] + [
+        turn['user'], {'role': 'assistant', 'content': answer, 'tokens': count_tokens(answer)}
+    ]
+    document_store.set_value(('conversation', turn['chat_id']), state, ttl=app.config['DOCUMENT_TTL'])
+
+def prepare_chat(data):
+    """Arma el pedido a Ollama para un mensaje de /chat: elige el contexto
+    (imágenes del chat o fragmentos del PDF) y lo ajusta a la ventana del
+    modelo. Con chat_id y CONVERSATION_MODE (o 'conversation' en data) el
+    pedido es para /api/chat, con el historial del chat (ver build_conversation). Devuelve (payload,
+    thinking_frame, ingestion, turn), con turn None fuera del modo
+    conversación. La usan la ruta de Flask y el servidor asyncio
+    (async_server.py)."""
     user_message = data.get('message', '')
     model = data.get('model', 'deepseek-r1:7b')
     filename = data.get('pdf_file', None)
-    chunk_index = data.get('chunk_index', 0)
+    chunk_index = data.get('chunk_index')  # Opcional: fija el fragmento en lugar de buscarlo
     chat_id = data.get('chat_id', None)
     
     app.logger.debug(f"Mensaje recibido: {user_message}")
     app.logger.debug(f"Modelo seleccionado: {model}")
-
-    def generate():
-        try:
-            # Enviar mensaje inicial de "pensando"
-            thinking_msg = get_thinking_message()
-            yield json.dumps({
-                'thinking': thinking_msg
-            }) + '\n'
-            
-            # Preparar el prompt base
-            prompt = user_message
-            
-            # Si hay historial de imágenes para este chat
-            if chat_id and chat_id in app.config['image_history']:
-                image_texts = app.config['image_history'][chat_id]
+    
+    # Presupuesto del prompt: la ventana del modelo menos lo reservado para la respuesta
+    context_window = app.config['MODEL_CONTEXT_WINDOWS'].get(model, app.config['DEFAULT_CONTEXT_WINDOW'])
+    budget = context_window - app.config['RESPONSE_TOKENS']
+    
+    # Preparar el prompt base
+    prompt = user_message
+    # Textos de contexto como (posición, texto), del más al menos prioritario,
+    # y la función que arma el prompt con los que quepan (ordenados por posición)
+    context_items = []
+    build_prompt = None
+    ingestion = None  # Avance de la ingesta si el PDF aún se está procesando
+    
+    # Documento del chat para el modo conversación: su identidad, sus textos y
+    # los que menciona la pregunta
+    source = None
+    document_items = []
+    focus = None
+    
+    # Si hay historial de imágenes para este chat
+    image_texts = document_store.get(('images', chat_id)) if chat_id else None
+    if image_texts is not None:
+        source = ['images']
+        # Todas las imágenes, dando prioridad a las más recientes
+        document_items = [(idx, f"Imagen {idx}:\n{img_text}") for idx, img_text in enumerate(image_texts, 1)][::-1]
+        
+        # Detectar si el usuario se refiere específicamente a "esta imagen" o "esta otra imagen"
+        if any(phrase in user_message.lower() for phrase in ["esta imagen", "esta otra imagen", "la imagen"]):
+            # Usar solo la última imagen
+            if image_texts:
+                last_image_text = image_texts[-1]
+                context_items = [(0, f"La imagen contiene este texto:\n\n{last_image_text}")]
+                focus = [(len(image_texts), f"Imagen {len(image_texts)}:\n{last_image_text}")]
                 
-                # Detectar si el usuario se refiere específicamente a "esta imagen" o "esta otra imagen"
-                if any(phrase in user_message.lower() for phrase in ["esta imagen", "esta otra imagen", "la imagen"]):
-                    # Usar solo la última imagen
-                    if image_texts:
-                        last_image_text = image_texts[-1]
-                        context = f"La imagen contiene este texto:\n\n{last_image_text}"
-                        prompt = f"""Contexto: {context}
+                def build_prompt(context, included=()):
+                    return f"""Contexto: {context}
 
 Pregunta del usuario: {user_message}
 
 Por favor, responde la pregunta basándote en el contenido de la imagen mencionada."""
-                else:
-                    # Si no hay referencia específica, usar todas las imágenes
-                    image_contexts = []
-                    for idx, img_text in enumerate(image_texts, 1):
-                        image_contexts.append(f"Imagen {idx}:\n{img_text}")
-                    
-                    if image_contexts:
-                        context = "\n\n".join(image_contexts)
-                        prompt = f"""Contexto: Las siguientes imágenes contienen este texto:
+        else:
+            # Si no hay referencia específica, usar todas las imágenes
+            context_items = document_items
+            
+            if context_items:
+                def build_prompt(context, included=()):
+                    return f"""Contexto: Las siguientes imágenes contienen este texto:
 
 {context}
 
 Pregunta del usuario: {user_message}
 
 Por favor, responde la pregunta basándote en el contenido de todas las imágenes mostradas."""
-            
-            # Solo incluir contexto del PDF si hay un archivo activo Y está en el mismo chat
-            elif filename and filename in app.config.get('pdf_chunks', {}) and data.get('isPdfChat', False):
-                chunks = app.config['pdf_chunks'][filename]
-                
-                # Construir el contexto combinando fragmentos relevantes
-                context_chunks = []
-                
-                # Siempre incluir el fragmento actual
-                current_chunk = chunks[chunk_index]
-                context_chunks.append(f"Fragmento {chunk_index + 1}:\n{current_chunk}")
-                
-                # Incluir fragmentos adyacentes si están disponibles
-                if chunk_index > 0:
-                    prev_chunk = chunks[chunk_index - 1]
-                    context_chunks.insert(0, f"Fragmento {chunk_index}:\n{prev_chunk}")
-                
-                if chunk_index < len(chunks) - 1:
-                    next_chunk = chunks[chunk_index + 1]
-                    context_chunks.append(f"Fragmento {chunk_index + 2}:\n{next_chunk}")
-                
-                # Combinar los fragmentos en un solo contexto
-                combined_context = "\n\n".join(context_chunks)
-                
-                prompt = f"""Contexto del PDF (fragmentos {chunk_index + 1} y adyacentes de {len(chunks)} totales):
+    
+    # Solo incluir contexto del PDF si hay un archivo activo Y está en el mismo chat
+    elif filename and ('pdf', filename) in document_store and data.get('isPdfChat', False):
+        chunks = document_store.get(('pdf', filename))
+        progress = document_store.get_value(('ingestion', filename))
+        if progress and progress['status'] == 'running':
+            ingestion = dict(progress)
+            total_description = f"{len(chunks)} disponibles; el documento aún se está procesando"
+        else:
+            total_description = f"{len(chunks)} totales"
+        
+        if chunk_index is not None:
+            # Fragmento elegido por el usuario y después sus adyacentes
+            pinned = int(chunk_index)
+            selected = [i for i in (pinned, pinned - 1, pinned + 1) if 0 <= i < len(chunks)]
+        else:
+            # Fragmentos más relevantes para la pregunta (BM25 o semántico)
+            top_k = app.config['RETRIEVAL_TOP_K']
+            selected = None
+            if data.get('retrieval', app.config['RETRIEVAL_MODE']) == 'semantic':
+                selected = semantic_search(filename, user_message, top_k)
+            if not selected:
+                selected = get_pdf_index(filename, chunks, progress and progress.get('upload_id')).search(user_message, top_k)
+            if not selected:
+                selected = list(range(min(top_k, len(chunks))))
+            app.logger.info(f"Fragmentos seleccionados para la pregunta: {[i + 1 for i in selected]}")
+        
+        context_items = [(i, f"Fragmento {i + 1}:\n{chunks[i]}") for i in selected]
+        source = ['pdf', filename, progress and progress.get('upload_id')]
+        document_items = context_items
+        
+        def build_prompt(context, included=()):
+            if chunk_index is not None and len(included) > 1:
+                description = f"fragmentos {int(chunk_index) + 1} y adyacentes"
+            elif chunk_index is not None:
+                description = f"fragmento {int(chunk_index) + 1}"
+            else:
+                description = f"fragmentos más relevantes: {', '.join(str(i + 1) for i in included)}"
+            return f"""Contexto del PDF ({description} de {total_description}):
 
-{combined_context}
+{context}
 
 Pregunta del usuario:
 {user_message}
 
 Por favor, responde la pregunta basándote en el contenido proporcionado del PDF.
 Si la respuesta podría estar en otros fragmentos no incluidos, indícalo y sugiere revisar otros fragmentos."""
+    
+    # Llenar el presupuesto por prioridad: la pregunta (siempre entera),
+    # el contexto más relevante y después el resto
+    tokens = {'context_window': context_window, 'budget': budget}
+    turn = None
+    if chat_id and data.get('conversation', app.config['CONVERSATION_MODE']):
+        messages, turn, accounting = build_conversation(chat_id, user_message, source, document_items, budget, focus)
+        tokens.update(accounting)
+    elif build_prompt:
+        overhead = count_tokens(build_prompt(''))
+        kept, accounting = fit_context(context_items, budget - overhead)
+        kept.sort()
+        prompt = build_prompt("\n\n".join(text for _, text in kept), [position for position, _ in kept])
+        tokens.update(accounting)
+    if turn is None:
+        tokens['prompt'] = count_tokens(prompt)
+    if tokens['prompt'] > budget:
+        app.logger.warning(f"El prompt ({tokens['prompt']} tokens) supera el presupuesto de {budget} tokens")
+    
+    # Mensaje inicial de "pensando" con la cuenta de tokens
+    thinking_msg = get_thinking_message()
+    thinking_frame = {'thinking': thinking_msg, 'tokens': tokens}
+    if ingestion:
+        thinking_frame['ingestion'] = ingestion
+    
+    payload = {
+        'model': model,
+        'stream': True,
+        'options': {'num_ctx': context_window, **app.config['OLLAMA_OPTIONS']},
+        'keep_alive': app.config['OLLAMA_KEEP_ALIVE']
+    }
+    if turn:
+        payload['messages'] = messages
+    else:
+        payload['prompt'] = prompt
+    return payload, thinking_frame, ingestion, turn
+
+# Preguntas que piden de forma explícita todo el PDF ("resume el documento",
+# "en todo el pdf", "summarize the document"): no alcanza con los fragmentos
+# más relevantes, hay que leerlo entero. Solo las que nombran al documento;
+# "todos los alumnos" o "el resumen ejecutivo" se responden con la búsqueda
+WHOLE_DOCUMENT_RE = re.compile(
+    r'\b((res[uú]m|sintetiz)\w*\s+(de\s+)?(todo\s+)?(el|este|del)\s+(documento|pdf|archivo|texto)'
+    r'|todo\s+el\s+(documento|pdf|archivo)|(documento|pdf|archivo)\s+(completo|entero)'
+    r'|summar\w*\s+(of\s+)?(the\s+|this\s+)?(whole\s+|entire\s+)?(document|pdf|file)'
+    r'|(whole|entire)\s+(document|pdf|file))\b',
+    re.IGNORECASE)
+THINK_BLOCK_RE = re.compile(r'<think>.*?</think>', re.DOTALL)
+
+DOCUMENT_MAP_PROMPT = """Toma notas de esta parte de un documento.
+Resume lo que dice y copia tal cual las fechas, plazos, cifras, nombres y obligaciones que aparezcan. No agregues nada que no esté en el texto.
+
+Texto:
+{text}
+
+Notas:"""
+DOCUMENT_REDUCE_PROMPT = """Estas son notas de partes consecutivas de un documento.
+Combínalas en un solo conjunto de notas sin perder fechas, plazos, cifras ni nombres, en especial lo que sirva para responder esta pregunta: {question}
+
+{notes}
+
+Notas combinadas:"""
+DOCUMENT_ANSWER_PROMPT = """Contexto del PDF ({description}):
+
+{context}
+
+Pregunta del usuario:
+{question}
+
+Por favor, responde la pregunta basándote en el contenido de todo el documento."""
+
+document_executor = ThreadPoolExecutor(max_workers=app.config['DOCUMENT_MAP_WORKERS'], thread_name_prefix='document-map')
+
+def split_for_budget(text, max_tokens):
+    """Divide el texto en piezas parejas de a lo sumo unos max_tokens tokens,
+    cortando entre palabras."""
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return [text]
+    words = text.split()
+    # Un margen porque las palabras no tienen todas los mismos tokens
+    size = math.ceil(len(words) / math.ceil(tokens / (max_tokens * 0.9)))
+    return [' '.join(words[i:i + size]) for i in range(0, len(words), size)]
+
+class DocumentMapReduce:
+    """Respuesta a una pregunta sobre todo un PDF.
+
+    Si el documento entero cabe en el prompt se envía tal cual. Si no, se
+    parte en piezas que caben en la ventana del modelo y cada una se resume en
+    notas (paso map), con hasta DOCUMENT_MAP_WORKERS pedidos a Ollama a la vez
+    y el turno de ollama_scheduler como cualquier /chat. Las notas no dependen
+    de la pregunta: se guardan en result_cache por el contenido de la pieza y
+    el modelo, así las preguntas siguientes sobre el mismo archivo solo pagan
+    la combinación. Las notas se combinan de a grupos que caben en un prompt
+    (paso reduce), nivel por nivel, hasta que todas entran en el prompt de la
+    respuesta, que se genera como la de cualquier otro mensaje.
+    """
+
+    def __init__(self, filename, chunks, question, model, context_window, ingestion=None):
+        self.filename = filename
+        self.question = question
+        self.model = model
+        self.context_window = context_window
+        self.ingestion = ingestion
+        self.notes_tokens = app.config['DOCUMENT_NOTES_TOKENS']
+        self.workers = app.config['DOCUMENT_MAP_WORKERS']
+        self.budget = context_window - app.config['RESPONSE_TOKENS']
+        self.chunks = list(chunks)
+        self.total_tokens = sum(count_tokens(chunk) + 1 for chunk in self.chunks)
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.responses = set()  # Respuestas de Ollama en curso, para cortarlas al cancelar
+        self.futures = set()
+        self.payload = None
+        self.error = None
+        
+        answer_overhead = count_tokens(DOCUMENT_ANSWER_PROMPT.format(description='', context='', question=question))
+        self.answer_budget = self.budget - answer_overhead
+        if self.total_tokens <= self.answer_budget:
+            self.pieces = []
+        else:
+            map_budget = context_window - self.notes_tokens - count_tokens(DOCUMENT_MAP_PROMPT.format(text=''))
+            self.pieces = [piece for chunk in self.chunks for piece in split_for_budget(chunk, map_budget)]
+        self.thinking_frame = {
+            'thinking': get_thinking_message(),
+            'tokens': {'context_window': context_window, 'budget': self.budget, 'document': self.total_tokens},
+            'document': {'stage': 'map' if self.pieces else 'answer', 'done': 0, 'total': len(self.pieces)}
+        }
+        if ingestion:
+            self.thinking_frame['ingestion'] = ingestion
+
+    def request(self, prompt, max_tokens=None, stream=True):
+        """Pedido a Ollama (a /api/generate) con las opciones de /chat."""
+        options = {'num_ctx': self.context_window, **app.config['OLLAMA_OPTIONS']}
+        if max_tokens:
+            options['num_predict'] = max_tokens
+        return {'model': self.model, 'prompt': prompt, 'stream': stream, 'options': options,
+                'keep_alive': app.config['OLLAMA_KEEP_ALIVE']}
+
+    def complete(self, prompt, mode):
+        """Texto de las notas para un prompt del map o del reduce, o None si se canceló."""
+        if self.cancelled.is_set():
+            return None
+        ticket = ollama_scheduler.enqueue(self.model)
+        if ticket is None:
+            raise RuntimeError(OLLAMA_BUSY_MESSAGE)
+        response = None
+        try:
+            deadline = time.time() + app.config['OLLAMA_QUEUE_TIMEOUT']
+            while not ticket.ready.wait(1):
+                if self.cancelled.is_set():
+                    return None
+                if time.time() > deadline:
+                    raise RuntimeError(OLLAMA_BUSY_MESSAGE)
+            # Con stream=True de requests la conexión se puede cortar desde cancel()
+            response = ollama.post('/api/generate', self.request(prompt, self.notes_tokens, stream=False), stream=True)
+            with self.lock:
+                self.responses.add(response)
+            if self.cancelled.is_set():
+                return None
+            if response.status_code != 200:
+                raise RuntimeError(f"Error al conectar con Ollama API. Código de estado: {response.status_code}. "
+                                   f"Respuesta: {response.text}")
+            result = response.json()
+            for kind, field in (('prompt', 'prompt_eval_count'), ('eval', 'eval_count')):
+                if field in result:
+                    ollama_tokens.observe(result[field], kind, mode)
+            return THINK_BLOCK_RE.sub('', result.get('response', '')).strip()
+        finally:
+            if response is not None:
+                with self.lock:
+                    self.responses.discard(response)
+                response.close()
+            ollama_scheduler.release(ticket)
+
+    def cancel(self):
+        """Deja de pedir notas y corta las que se están generando (es el
+        closer de la Generation mientras dura el map y el reduce)."""
+        self.cancelled.set()
+        with self.lock:
+            futures = list(self.futures)
+            responses = list(self.responses)
+        for future in futures:
+            future.cancel()
+        for response in responses:
+            close_upstream(response)
+
+    def progress(self, stage, done, total, **extra):
+        """Línea NDJSON del avance (el navegador la muestra como el mensaje de "pensando")."""
+        self.thinking_frame['document'] = {'stage': stage, 'done': done, 'total': total, **extra}
+        return json.dumps({'thinking': self.thinking_frame['thinking'], 'document': self.thinking_frame['document']}) + '\n'
+
+    def fail(self, error):
+        if isinstance(error, requests.exceptions.Timeout):
+            self.error = OLLAMA_TIMEOUT_MESSAGE
+        elif isinstance(error, requests.exceptions.ConnectionError):
+            ollama_monitor.wake()
+            self.error = OLLAMA_CONNECTION_MESSAGE
+        else:
+            self.error = f"Error al leer el documento: {str(error)}"
+
+    def complete_all(self, prompts, mode, on_result, progress):
+        """Pide las notas de todos los prompts, con hasta self.workers pedidos
+        a la vez, y llama a on_result(posición, notas) a medida que llegan.
+        Genera una línea de avance por cada una y devuelve False si hubo un
+        error o se canceló."""
+        waiting = deque(enumerate(prompts))
+        pending = {}
+        try:
+            while waiting or pending:
+                while waiting and len(pending) < self.workers:
+                    position, prompt = waiting.popleft()
+                    future = document_executor.submit(self.complete, prompt, mode)
+                    pending[future] = position
+                    with self.lock:
+                        self.futures.add(future)
+                done, _ = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    position = pending.pop(future)
+                    with self.lock:
+                        self.futures.discard(future)
+                    if self.cancelled.is_set():
+                        return False
+                    try:
+                        notes = future.result()
+                    except Exception as e:
+                        self.fail(e)
+                        return False
+                    on_result(position, notes)
+                    yield progress()
+                if self.cancelled.is_set():
+                    return False
+            return True
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def map_pieces(self):
+        """Notas de cada pieza (de result_cache o de Ollama). Genera las líneas
+        de avance y devuelve las notas, o None."""
+        notes = [None] * len(self.pieces)
+        keys = [DiskCache.make_key(hashlib.sha256(piece.encode('utf-8')).hexdigest(), kind='document_notes',
+                                   model=self.model, prompt=DOCUMENT_MAP_PROMPT, max_tokens=self.notes_tokens,
+                                   options=app.config['OLLAMA_OPTIONS'])
+                for piece in self.pieces]
+        for position, key in enumerate(keys):
+            cached = result_cache.get('document_notes', key)
+            if cached is not None:
+                notes[position] = cached['notes']
+        missing = [position for position, note in enumerate(notes) if note is None]
+        cached = len(notes) - len(missing)
+        app.logger.info(f"Leyendo todo el PDF {self.filename}: {len(notes)} partes, {cached} con notas en caché")
+        counter = {'done': cached}
+        # La primera línea lleva además la cuenta de tokens y el request_id
+        self.progress('map', cached, len(notes), cached=cached)
+        yield json.dumps(self.thinking_frame) + '\n'
+        
+        def on_result(index, text):
+            position = missing[index]
+            notes[position] = text
+            result_cache.put(keys[position], {'notes': text})
+            counter['done'] += 1
+        
+        prompts = [DOCUMENT_MAP_PROMPT.format(text=self.pieces[position]) for position in missing]
+        completed = yield from self.complete_all(
+            prompts, 'document_map', on_result,
+            lambda: self.progress('map', counter['done'], len(notes), cached=cached))
+        return notes if completed else None
+
+    def reduce_notes(self, notes):
+        """Combina las notas de a grupos hasta que caben en el prompt de la
+        respuesta. notes son (primera parte, última parte, texto). Genera las
+        líneas de avance y devuelve las notas finales, o None."""
+        reduce_budget = (self.context_window - self.notes_tokens
+                         - count_tokens(DOCUMENT_REDUCE_PROMPT.format(question=self.question, notes='')))
+        level = 0
+        # Cada nota cuesta su texto más el título de label() (unos 8 tokens)
+        while sum(count_tokens(text) + 8 for _, _, text in notes) > self.answer_budget:
+            level += 1
+            # Grupos de notas consecutivas que caben en un prompt (al menos dos,
+            # para que cada nivel achique la lista)
+            groups = []
+            used = 0
+            for note in notes:
+                cost = count_tokens(note[2]) + 8
+                if groups and (used + cost <= reduce_budget or len(groups[-1]) < 2):
+                    groups[-1].append(note)
+                    used += cost
+                else:
+                    groups.append([note])
+                    used = cost
+            if len(groups) > 1 and len(groups[-1]) == 1:
+                groups[-2].extend(groups.pop())
             
-            payload = {
-                'model': model,
-                'prompt': prompt,
-                'stream': True
-            }
+            reduced = [None] * len(groups)
+            counter = {'done': 0}
+            
+            def on_result(position, text):
+                group = groups[position]
+                reduced[position] = (group[0][0], group[-1][1], text)
+                counter['done'] += 1
+            
+            prompts = [DOCUMENT_REDUCE_PROMPT.format(question=self.question,
+                                                     notes="\n\n".join(self.label(note) for note in group))
+                       for group in groups]
+            yield self.progress('reduce', 0, len(groups), level=level)
+            completed = yield from self.complete_all(
+                prompts, 'document_reduce', on_result,
+                lambda: self.progress('reduce', counter['done'], len(groups), level=level))
+            if not completed:
+                return None
+            notes = reduced
+        return notes
+
+    @staticmethod
+    def label(note):
+        first, last, text = note
+        return f"Notas de la parte {first}:\n{text}" if first == last else f"Notas de las partes {first} a {last}:\n{text}"
+
+    def run(self, generation):
+        """Lee el documento: genera las líneas NDJSON del avance y al terminar
+        deja en self.payload el pedido de la respuesta (o en self.error el
+        mensaje para el chat)."""
+        if not self.pieces:
+            context = "\n\n".join(f"Fragmento {i + 1}:\n{chunk}" for i, chunk in enumerate(self.chunks))
+            description = f"documento completo, {len(self.chunks)} fragmentos"
+        else:
+            notes = yield from self.map_pieces()
+            generation.mark('map')
+            if notes is None:
+                return
+            notes = yield from self.reduce_notes([(i, i, text) for i, text in enumerate(notes, 1)])
+            generation.mark('reduce')
+            if notes is None:
+                return
+            context = "\n\n".join(self.label(note) for note in notes)
+            description = f"notas de las {len(self.pieces)} partes del documento"
+        prompt = DOCUMENT_ANSWER_PROMPT.format(description=description, context=context, question=self.question)
+        self.thinking_frame['tokens']['prompt'] = count_tokens(prompt)
+        self.thinking_frame['document'] = {'stage': 'answer', 'done': len(self.pieces), 'total': len(self.pieces)}
+        if self.pieces:
+            yield self.progress('answer', len(self.pieces), len(self.pieces))
+        self.payload = self.request(prompt)
+
+def prepare_document_chat(data):
+    """DocumentMapReduce para un mensaje de /chat que pregunta por todo el PDF
+    del chat, o None para responderlo con prepare_chat. whole_document en el
+    pedido lo fuerza o lo impide; si no viene, se decide por el texto de la
+    pregunta (WHOLE_DOCUMENT_RE). No se usa con un fragmento elegido
+    (chunk_index) ni en los chats con imágenes."""
+    user_message = data.get('message', '')
+    filename = data.get('pdf_file', None)
+    chat_id = data.get('chat_id', None)
+    if not filename or not data.get('isPdfChat', False) or data.get('chunk_index') is not None:
+        return None
+    whole_document = data.get('whole_document')
+    if whole_document is None:
+        whole_document = app.config['DOCUMENT_MAP_REDUCE'] and bool(WHOLE_DOCUMENT_RE.search(user_message))
+    if not whole_document or ('pdf', filename) not in document_store:
+        return None
+    if chat_id and ('images', chat_id) in document_store:
+        return None
+    
+    model = data.get('model', 'deepseek-r1:7b')
+    progress = document_store.get_value(('ingestion', filename))
+    ingestion = dict(progress) if progress and progress['status'] == 'running' else None
+    context_window = app.config['MODEL_CONTEXT_WINDOWS'].get(model, app.config['DEFAULT_CONTEXT_WINDOW'])
+    return DocumentMapReduce(filename, document_store.get(('pdf', filename)), user_message, model,
+                             context_window, ingestion)
+
+def ollama_path(payload):
+    """Endpoint de Ollama para el payload de prepare_chat."""
+    return '/api/chat' if 'messages' in payload else '/api/generate'
+
+def wait_for_turn(ticket, thinking_frame, generation):
+    """Envía el mensaje de "pensando" y espera el turno de ollama_scheduler,
+    avisando de los cambios de posición en la cola. Genera las líneas NDJSON y
+    devuelve False si se agotó OLLAMA_QUEUE_TIMEOUT o se canceló el pedido."""
+    position = ollama_scheduler.position(ticket)
+    if position:
+        thinking_frame['queue'] = {'position': position, 'model': ticket.model}
+    yield json.dumps(thinking_frame) + '\n'
+    deadline = time.time() + app.config['OLLAMA_QUEUE_TIMEOUT']
+    while not ticket.ready.wait(1):
+        if time.time() > deadline or generation.cancelled.is_set():
+            return False
+        current = ollama_scheduler.position(ticket)
+        if current != position:
+            position = current
+            yield json.dumps({'thinking': thinking_frame['thinking'],
+                              'queue': {'position': position, 'model': ticket.model}}) + '\n'
+    return True
+
+def stream_shared(key, payload, thinking_frame, ingestion, generation, stream_mode):
+    """Respuesta de /chat para un pedido determinista (ver response_key): la
+    toma de response_broker, de su caché o de la generación idéntica en curso.
+    Genera las líneas NDJSON."""
+    stream = ResponseStream(
+        stream_mode,
+        flush_interval=app.config['STREAM_FLUSH_INTERVAL'],
+        flush_tokens=app.config['STREAM_FLUSH_TOKENS']
+    )
+    generation.stream = stream
+    notice = ingestion_notice(ingestion) if ingestion else ''
+    
+    answer = response_broker.cache.get(key)
+    if answer is not None:
+        generation.mode = 'cached'
+        generation.sent = time.perf_counter()
+        generation.observe({'response': answer})
+        yield json.dumps(thinking_frame) + '\n'
+        yield json.dumps({'clear_thinking': True}) + '\n'
+        for frame in (stream.push(notice + answer), stream.flush()):
+            if frame:
+                yield frame
+        return
+    
+    shared, created = response_broker.join(key, payload)
+    if shared is None:
+        yield error_frame(OLLAMA_BUSY_MESSAGE)
+        return
+    if not created:
+        generation.mode = 'coalesced'
+    generation.closer = shared.wake
+    joined = time.perf_counter()
+    try:
+        admitted = yield from wait_for_turn(shared.ticket, thinking_frame, generation)
+        generation.mark('queue')
+        if generation.cancelled.is_set():
+            return
+        if not admitted:
+            yield error_frame(OLLAMA_BUSY_MESSAGE)
+            return
+        
+        index = 0
+        started = False
+        while True:
+            # Sin tokens nuevos, esperar como mucho hasta que venza lo agrupado
+            due = stream.flush_due()
+            parts, done = shared.wait(index, timeout=1 if due is None else max(due, 0.001))
+            if generation.cancelled.is_set():
+                return
+            if not parts and stream.flush_due() == 0:
+                frame = stream.flush()
+                if frame:
+                    yield frame
+            if not started and parts:
+                # Limpiar mensaje de "pensando" y comenzar a mostrar la respuesta
+                started = True
+                generation.sent = max(shared.sent or joined, joined)
+                yield json.dumps({'clear_thinking': True}) + '\n'
+                if notice:
+                    frame = stream.push(notice)
+                    if frame:
+                        yield frame
+            for text in parts:
+                generation.observe({'response': text})
+                frame = stream.push(text)
+                if frame:
+                    yield frame
+            index += len(parts)
+            if done:
+                break
+        
+        generation.prompt_eval = shared.prompt_eval if created else 0
+        if created:
+            generation.ollama_stats = shared.ollama_stats
+        if shared.error:
+            yield error_frame(shared.error)
+            return
+        # Enviar los tokens que quedaron agrupados
+        frame = stream.flush()
+        if frame:
+            yield frame
+    finally:
+        response_broker.leave(shared)
+
+def ingestion_notice(ingestion):
+    """Aviso de que la respuesta solo usa los fragmentos del PDF ya procesados."""
+    return (f"*El PDF aún se está procesando ({ingestion['pages_processed']} de "
+            f"{ingestion['pages_total']} páginas); esta respuesta usa solo los fragmentos disponibles.*\n\n")
+
+def error_frame(error_msg):
+    """Registra el error y devuelve la línea NDJSON que lo muestra en el chat."""
+    app.logger.error(error_msg)
+    return json.dumps({
+        'error': decorate_message(error_msg, is_error=True)
+    }) + '\n'
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    data = request.json
+    stream_mode = data.get('stream_mode', 'snapshot')
+
+    request_id = str(data.get('request_id') or uuid.uuid4())[:64]
+    # Socket del navegador, para notar que se desconectó aunque no se le esté
+    # escribiendo (p. ej. mientras Ollama lee el prompt)
+    client_socket = request.environ.get('werkzeug.socket') or request.environ.get('gunicorn.socket')
+
+    def generate():
+        ticket = None
+        response = None
+        turn = None
+        generation = generations.start(
+            request_id, functools.partial(client_disconnected, client_socket) if client_socket else None
+        )
+        try:
+            job = prepare_document_chat(data)
+            if job is None:
+                payload, thinking_frame, ingestion, turn = prepare_chat(data)
+            else:
+                thinking_frame, ingestion = job.thinking_frame, job.ingestion
+            generation.mark('prompt')
+            thinking_frame['request_id'] = request_id
+            if turn:
+                generation.mode = turn['mode']
+            if job is not None:
+                # Pregunta sobre todo el PDF: primero las notas de cada parte
+                generation.mode = 'document'
+                generation.closer = job.cancel
+                yield from job.run(generation)
+                if generation.cancelled.is_set():
+                    return
+                if job.error:
+                    yield error_frame(job.error)
+                    return
+                payload = job.payload
+            # Pedidos deterministas: respuesta de la caché o compartida con los
+            # pedidos idénticos en curso
+            key = response_key(payload)
+            if key:
+                yield from stream_shared(key, payload, thinking_frame, ingestion, generation, stream_mode)
+                return
+            # Turno para el modelo: los pedidos se agrupan por modelo para que
+            # Ollama no tenga que cambiar de modelo a cada pedido
+            ticket = ollama_scheduler.enqueue(payload['model'])
+            if ticket is None:
+                yield error_frame(OLLAMA_BUSY_MESSAGE)
+                return
+            # Enviar mensaje inicial de "pensando" con la cuenta de tokens (y la
+            # posición en la cola mientras se espera)
+            admitted = yield from wait_for_turn(ticket, thinking_frame, generation)
+            generation.mark('queue')
+            if generation.cancelled.is_set():
+                return
+            if not admitted:
+                yield error_frame(OLLAMA_BUSY_MESSAGE)
+                return
             
             app.logger.debug(f"Enviando solicitud a Ollama API con payload: {payload}")
             
             try:
-                response = http.post(
-                    OLLAMA_API_URL,
-                    json=payload,
-                    stream=True,
-                    timeout=60  # Aumentar timeout a 60 segundos
-                )
+                generation.sent = time.perf_counter()
+                response = ollama.post(ollama_path(payload), payload, stream=True)
+                generation.mark('connect')
+                # Al cancelar (botón de detener o desconexión) se corta la
+                # conexión y Ollama deja de generar
+                generation.closer = functools.partial(close_upstream, response)
+                if generation.cancelled.is_set():
+                    close_upstream(response)
+                    return
             except requests.exceptions.Timeout:
-                error_msg = "La solicitud está tomando más tiempo de lo esperado. Por favor, intenta con un mensaje más corto o espera un momento."
-                app.logger.error(error_msg)
-                yield json.dumps({
-                    'error': decorate_message(error_msg, is_error=True)
-                }) + '\n'
+                yield error_frame(OLLAMA_TIMEOUT_MESSAGE)
                 return
             except requests.exceptions.ConnectionError:
-                error_msg = "No se pudo conectar con Ollama. Por favor, verifica que Ollama esté corriendo."
-                app.logger.error(error_msg)
-                yield json.dumps({
-                    'error': decorate_message(error_msg, is_error=True)
-                }) + '\n'
+                ollama_monitor.wake()
+                yield error_frame(OLLAMA_CONNECTION_MESSAGE)
                 return
             
             app.logger.debug(f"Estado de respuesta de Ollama API: {response.status_code}")
             if response.status_code != 200:
-                error_msg = f"Error al conectar con Ollama API. Código de estado: {response.status_code}. Respuesta: {response.text}"
-                app.logger.error(error_msg)
-                yield json.dumps({
-                    'error': decorate_message(error_msg, is_error=True)
-                }) + '\n'
+                yield error_frame(f"Error al conectar con Ollama API. Código de estado: {response.status_code}. Respuesta: {response.text}")
                 return
 
             # Limpiar mensaje de "pensando" y comenzar a mostrar la respuesta
             yield json.dumps({'clear_thinking': True}) + '\n'
             
-            # Inicializar acumulador de respuesta
-            full_response = ""
+            # Renderizador que conserva los bloques ya terminados entre tokens
+            stream = ResponseStream(
+                stream_mode,
+                flush_interval=app.config['STREAM_FLUSH_INTERVAL'],
+                flush_tokens=app.config['STREAM_FLUSH_TOKENS']
+            )
+            generation.stream = stream
+            
+            # Avisar que la respuesta solo usa los fragmentos ya procesados
+            if ingestion:
+                frame = stream.push(ingestion_notice(ingestion))
+                if frame:
+                    yield frame
             
             for line in response.iter_lines():
                 if line:
-                    # Verificar si la conexión fue cerrada por el cliente
-                    if request.environ.get('werkzeug.socket') and hasattr(request.environ['werkzeug.socket'], 'closed') and request.environ['werkzeug.socket'].closed:
-                        app.logger.info("El cliente canceló la solicitud")
-                        return
-                        
                     try:
                         json_response = json.loads(line)
                         app.logger.debug(f"Fragmento de respuesta recibido: {json_response}")
-                        ai_response = json_response.get('response', '')
+                        ai_response = generation.observe(json_response)
                         if ai_response:
-                            full_response += ai_response
-                            # Formatear y enviar la respuesta completa hasta el momento
-                            decorated_response = decorate_message(full_response)
-                            yield json.dumps({'response': decorated_response}) + '\n'
+                            # Formatear y enviar la respuesta (o el cambio) hasta el momento
+                            frame = stream.push(ai_response)
+                            if frame:
+                                yield frame
                         
                     except json.JSONDecodeError as e:
                         app.logger.error(f"Error al decodificar JSON: {str(e)} para la línea: {line}")
                         continue
 
+            if generation.cancelled.is_set():
+                return
+
+            # Enviar los tokens que quedaron agrupados
+            frame = stream.flush()
+            if frame:
+                yield frame
+
+        except GeneratorExit:
+            # El servidor no pudo escribir al navegador
+            generation.cancel('disconnect')
+            raise
         except Exception as e:
-            error_msg = f"Error de conexión: {str(e)}"
-            app.logger.error(error_msg)
-            yield json.dumps({
-                'error': decorate_message(error_msg, is_error=True)
-            }) + '\n'
+            # Al cancelar, leer de la conexión cortada falla: no es un error
+            if not generation.cancelled.is_set():
+                yield error_frame(f"Error de conexión: {str(e)}")
+        finally:
+            # Devolver la conexión al pool y el turno al planificador
+            if response is not None:
+                response.close()
+            if ticket is not None:
+                ollama_scheduler.release(ticket)
+            if turn and generation.answer:
+                # Lo que llegó a verse queda en el historial, aunque se haya cancelado
+                save_turn(turn, ''.join(generation.answer))
+            generations.finish(generation)
 
     return Response(stream_with_context(generate()), mimetype='text/event-stream')
 
+@app.route('/cancel_chat/<request_id>', methods=['POST'])
+def cancel_chat(request_id):
+    """Detiene la respuesta en curso con ese request_id (el botón de detener)."""
+    found = generations.cancel(request_id)
+    return jsonify({'success': True, 'active': found})
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Endpoint de verificación de salud"""
     status = {
         'status': 'healthy',
         'message': "Servidor en funcionamiento",
-        'timestamp': time.time()
+        'timestamp': time.time(),
+        'cache': result_cache.stats(),
+        'documents': document_store.stats(),
+        'scheduler': ollama_scheduler.stats(),
+        'generations': generations.stats(),
+        'responses': response_broker.stats(),
+        'ollama': {key: value for key, value in ollama_monitor.snapshot().items() if key != 'models'}
     }
     return json.dumps(status)
 
+def metric_line(name, value, **labels):
+    label_text = ','.join(f'{key}="{label}"' for key, label in labels.items())
+    return f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}'
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Histogramas de tiempos y tokens y el estado actual, en el formato de
+    texto de Prometheus. Cada proceso exporta solo lo que midió él."""
+    if not app.config['METRICS_ENABLED']:
+        return jsonify({'success': False, 'error': 'Métricas desactivadas'}), 404
+    lines = []
+    for histogram in histograms:
+        lines.extend(histogram.render())
+    
+    healthy = ollama_monitor.snapshot()['healthy']
+    scheduler = ollama_scheduler.stats()
+    generation_stats = generations.stats()
+    response_stats = response_broker.stats()
+    gauges = [
+        ('process_cpu_seconds_total', 'counter', 'Tiempo de CPU (usuario y sistema) del proceso',
+         [metric_line('process_cpu_seconds_total', f'{time.process_time():.6f}')]),
+        ('libreai_ollama_up', 'gauge', 'Si Ollama respondió en la última revisión (-1 si aún no se revisó)',
+         [metric_line('libreai_ollama_up', -1 if healthy is None else int(healthy))]),
+        ('libreai_scheduler_waiting', 'gauge', 'Pedidos en la cola de ollama_scheduler por modelo',
+         [metric_line('libreai_scheduler_waiting', count, model=model) for model, count in scheduler['waiting'].items()]),
+        ('libreai_scheduler_running', 'gauge', 'Pedidos que Ollama está atendiendo por modelo',
+         [metric_line('libreai_scheduler_running', count, model=model) for model, count in scheduler['running'].items()]),
+        ('libreai_generations_active', 'gauge', 'Respuestas de /chat en curso',
+         [metric_line('libreai_generations_active', generation_stats['active'])]),
+        ('libreai_generations_completed_total', 'counter', 'Respuestas de /chat terminadas',
+         [metric_line('libreai_generations_completed_total', generation_stats['completed'])]),
+        ('libreai_generations_cancelled_total', 'counter', 'Respuestas de /chat canceladas por motivo',
+         [metric_line('libreai_generations_cancelled_total', count, reason=reason)
+          for reason, count in generation_stats['cancelled'].items()]),
+        ('libreai_response_cache_hits_total', 'counter', 'Respuestas deterministas servidas desde la caché',
+         [metric_line('libreai_response_cache_hits_total', response_stats['cache']['hits'])]),
+        ('libreai_responses_coalesced_total', 'counter', 'Pedidos que compartieron una generación en curso',
+         [metric_line('libreai_responses_coalesced_total', response_stats['coalesced'])]),
+    ]
+    for name, kind, documentation, samples in gauges:
+        lines.extend([f'# HELP {name} {documentation}', f'# TYPE {name} {kind}', *samples])
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+# Trabajos de OCR de este proceso por id y, por chat, los trabajos en orden de
+# subida cuyo texto aún no se agregó al historial de imágenes del chat. El
+# estado de cada trabajo se publica como ('ocr_job', id) en document_store
+ocr_jobs = {}
+ocr_pending = {}
+ocr_lock = threading.Lock()
+
+def otsu_threshold(pixels):
+    """Umbral de Otsu para un arreglo de grises de 8 bits."""
+    hist = np.bincount(pixels.ravel(), minlength=256).astype(np.float64)
+    weight = np.cumsum(hist)
+    total = weight[-1]
+    mean = np.cumsum(hist * np.arange(256))
+    background = weight
+    foreground = total - weight
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = (mean[-1] * background - mean * total) ** 2 / (background * foreground)
+    # Sin varianza (imagen de un solo tono) todos los valores son NaN
+    return int(np.argmax(np.nan_to_num(between[:-1], nan=-1.0)))
+
+def estimate_skew(binary, max_angle=5.0, step=0.5):
+    """Ángulo (grados) que endereza las líneas de texto: el que maximiza la
+    varianza del perfil horizontal de tinta en una versión reducida."""
+    small = binary.copy()
+    small.thumbnail((800, 800))
+    ink = ImageOps.invert(small)  # Tinta en blanco para que el relleno de la rotación sea 0
+    best_angle, best_score = 0.0, -1.0
+    for angle in np.arange(-max_angle, max_angle + step / 2, step):
+        profile = np.asarray(ink.rotate(float(angle), resample=Image.NEAREST), dtype=np.float32).sum(axis=1)
+        score = float(np.var(profile))
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+    return best_angle
+
+def preprocess_for_ocr(image, max_side=2400, min_side=1200):
+    """Prepara una imagen para tesseract: orientación EXIF, escala de grises,
+    tamaño entre min_side y max_side (lado mayor), binarizado de Otsu y
+    enderezado de hasta ±5 grados."""
+    image = ImageOps.exif_transpose(image)
+    image = image.convert('L')
+    longest = max(image.size)
+    if longest > max_side:
+        scale = max_side / longest
+    elif longest < min_side:
+        scale = min(min_side / longest, 3.0)
+    else:
+        scale = 1.0
+    if scale != 1.0:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.LANCZOS)
+    image = ImageOps.autocontrast(image)
+    pixels = np.asarray(image)
+    binary = Image.fromarray(np.where(pixels > otsu_threshold(pixels), 255, 0).astype(np.uint8))
+    angle = estimate_skew(binary)
+    if abs(angle) >= 0.5:
+        binary = binary.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+        binary = binary.point(lambda value: 255 if value > 127 else 0)
+    return binary
+
+def ocr_image(source, lang, max_side=None, min_side=None):
+    """Extrae el texto de la imagen con tesseract (se ejecuta en el pool 'ocr').
+    source es la ruta de la imagen o sus bytes. Con max_side la imagen pasa
+    antes por preprocess_for_ocr."""
+    try:
+        configure_tesseract()
+        image = open_image(source)
+        if max_side:
+            # En JPEG, decodificar directamente a una escala reducida
+            image.draft('L', (max_side, max_side))
+            image = preprocess_for_ocr(image, max_side, min_side or 0)
+        elif image.mode in ('RGBA', 'P'):
+            image = image.convert('RGB')
+        return pytesseract.image_to_string(image, lang=lang).strip()
+    except Exception as e:
+        # Algunas excepciones de pytesseract no se pueden enviar de vuelta al
+        # proceso principal y romperían el pool
+        raise RuntimeError(str(e)) from None
+
+def ocr_preprocess_options():
+    """Argumentos de preprocesado para ocr_image según la configuración."""
+    if not app.config['OCR_PREPROCESS']:
+        return {}
+    return {'max_side': app.config['OCR_MAX_SIDE'], 'min_side': app.config['OCR_MIN_SIDE']}
+
+def thumbnail_name(filename, job_id):
+    """Nombre de la miniatura JPEG de una imagen subida. Lleva el id del
+    trabajo de OCR, así no chocan a.png y a.jpg ni dos subidas de la misma imagen."""
+    return f"thumb_{os.path.splitext(filename)[0]}_{job_id}.jpg"
+
+def save_thumbnail(source, thumb_path, max_side, quality):
+    """Guarda una miniatura JPEG comprimida para mostrar en el chat."""
+    with open_image(source) as image:
+        image.draft('RGB', (max_side, max_side))
+        image = ImageOps.exif_transpose(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        image.save(thumb_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+
+def submit_ocr_job(job_id, chat_id, source, filename, image_url, cache_key, cached_text=None):
+    """Encola el OCR de la imagen y devuelve el trabajo, o None si la cola está llena.
+    Con cached_text (de la caché) el trabajo termina enseguida sin usar el pool."""
+    with ocr_lock:
+        now = time.time()
+        for old_id, old_job in list(ocr_jobs.items()):
+            if old_job['status'] in ('done', 'error') and now - old_job['finished'] > app.config['OCR_JOB_TTL']:
+                del ocr_jobs[old_id]
+        active = sum(1 for job in ocr_jobs.values() if job['status'] in ('queued', 'running'))
+        if cached_text is None and active >= app.config['OCR_QUEUE_LIMIT']:
+            return None
+        
+        job = {
+            'job_id': job_id,
+            'status': 'queued',
+            'chat_id': chat_id,
+            'filename': filename,
+            'image_url': image_url,
+            'text': None,
+            'error': None,
+            'created': now,
+            'finished': None,
+            'cached': cached_text is not None
+        }
+        ocr_jobs[job['job_id']] = job
+        ocr_pending.setdefault(chat_id, []).append(job)
+    document_store.set_value(('ocr_job', job['job_id']), job, ttl=app.config['OCR_JOB_TTL'])
+    
+    if cached_text is not None:
+        future = Future()
+        future.set_result(cached_text)
+        future.add_done_callback(lambda future: finish_ocr_job(job, future, source))
+        return job
+    
+    for attempt in range(2):
+        try:
+            future = get_process_pool('ocr', app.config['OCR_WORKERS']).submit(
+                ocr_image, source, app.config['OCR_LANG'], **ocr_preprocess_options())
+            break
+        except BrokenProcessPool as e:
+            # Un proceso del pool murió: se crea uno nuevo y se reintenta una vez
+            discard_process_pool('ocr')
+            future = Future()
+            future.set_exception(e)
+    future.add_done_callback(lambda future: finish_ocr_job(job, future, source, cache_key))
+    return job
+
+def finish_ocr_job(job, future, source, cache_key=None):
+    """Guarda el resultado del trabajo y pasa al historial de imágenes los textos de ese
+    chat que ya están listos, en el orden en que se subieron las imágenes."""
+    try:
+        text = future.result()
+        if cache_key:
+            result_cache.put(cache_key, {'text': text})
+        if not text:
+            app.logger.warning(f"No se pudo extraer texto de la imagen: {job['filename']}")
+            text = "No se pudo extraer texto de esta imagen. Asegúrate de que la imagen contenga texto claro y legible."
+        job['text'] = text
+        job['status'] = 'done'
+        app.logger.info(f"Imagen procesada exitosamente: {len(text)} caracteres extraídos")
+    except Exception as e:
+        if isinstance(e, BrokenProcessPool):
+            discard_process_pool('ocr')
+        job['error'] = f'Error al procesar la imagen: {str(e)}'
+        job['status'] = 'error'
+        app.logger.error(f"Error procesando imagen: {str(e)}")
+        static_filepath = os.path.join(app.config['STATIC_FOLDER'], thumbnail_name(job['filename'], job['job_id']))
+        if os.path.exists(static_filepath):
+            os.remove(static_filepath)
+    finally:
+        job['finished'] = time.time()
+        if not job['cached']:
+            upload_stage_seconds.observe(job['finished'] - job['created'], 'image', 'ocr')
+        discard_upload(source)  # Limpiar archivo temporal original
+    
+    with ocr_lock:
+        pending = ocr_pending.get(job['chat_id'], [])
+        while pending and pending[0]['status'] in ('done', 'error'):
+            finished = pending.pop(0)
+            if finished['status'] == 'done':
+                # Historial de imágenes del chat (se crea con la primera)
+                document_store.append(('images', finished['chat_id']), finished['text'])
+                # También mantener la última imagen para compatibilidad
+                app.config['last_image_text'] = finished['text']
+        if not pending:
+            ocr_pending.pop(job['chat_id'], None)
+    document_store.set_value(('ocr_job', job['job_id']), job, ttl=app.config['OCR_JOB_TTL'])
+
+@app.route('/ocr_status/<job_id>', methods=['GET'])
+def ocr_status(job_id):
+    """Estado y resultado de un trabajo de OCR. Con ?stream=1 envía una línea
+    NDJSON por cada cambio hasta que termina."""
+    key = ('ocr_job', job_id)
+    job = document_store.get_value(key)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Trabajo de OCR no encontrado'}), 404
+    
+    if not request.args.get('stream'):
+        return jsonify({'success': True, **job})
+    return stream_status(key)
+
 @app.route('/upload_image', methods=['POST'])
+@timed_upload('image')
 def upload_image():
     try:
         if 'file' not in request.files:
@@ -522,53 +3997,53 @@ def upload_image():
         
         try:
             filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            static_filepath = os.path.join(app.config['STATIC_FOLDER'], filename)
+            job_id = uuid.uuid4().hex
+            static_filepath = os.path.join(app.config['STATIC_FOLDER'], thumbnail_name(filename, job_id))
+            image_url = f'/static/uploads/{thumbnail_name(filename, job_id)}'
             
-            # Guardar el archivo original
-            file.save(filepath)
-            app.logger.info(f"Imagen guardada exitosamente: {filepath}")
+            # El original se procesa desde donde quedó al recibirlo: en memoria,
+            # o en un temporal si es grande (ver UploadBuffer)
+            source = file.stream.detach()
+            app.logger.info(f"Imagen recibida: {filename} ({file.stream.size} bytes"
+                            f"{', en disco' if isinstance(source, str) else ''})")
             
             try:
-                # Procesar la imagen para OCR
-                image = Image.open(filepath)
-                if image.mode in ('RGBA', 'P'):
-                    image = image.convert('RGB')
-                
-                # Guardar una copia en la carpeta estática
-                image.save(static_filepath)
+                # Guardar una miniatura comprimida en la carpeta estática; el
+                # original solo se usa para el OCR
+                save_thumbnail(source, static_filepath, app.config['THUMBNAIL_MAX_SIDE'],
+                               app.config['THUMBNAIL_QUALITY'])
                 
-                text = pytesseract.image_to_string(image, lang='spa+eng')
-                text = text.strip()
-                
-                if not text:
-                    app.logger.warning(f"No se pudo extraer texto de la imagen: {filename}")
-                    text = "No se pudo extraer texto de esta imagen. Asegúrate de que la imagen contenga texto claro y legible."
-                
-                os.remove(filepath)  # Limpiar archivo temporal original
-                app.logger.info(f"Imagen procesada exitosamente: {len(text)} caracteres extraídos")
-                
-                # Inicializar el historial de imágenes para este chat si no existe
-                if chat_id not in app.config['image_history']:
-                    app.config['image_history'][chat_id] = []
-                
-                # Agregar el texto de la imagen al historial
-                app.config['image_history'][chat_id].append(text)
-                
-                # También mantener la última imagen para compatibilidad
-                app.config['last_image_text'] = text
+                # El OCR se hace en segundo plano; el texto se agrega al historial
+                # de imágenes del chat cuando termina
+                # Si ya se procesó una imagen idéntica, reutilizar su texto
+                cache_key = DiskCache.make_key(file_sha256(source), kind='ocr', lang=app.config['OCR_LANG'],
+                                               **ocr_preprocess_options())
+                cached = result_cache.get('ocr', cache_key)
+                job = submit_ocr_job(job_id, chat_id, source, filename, image_url,
+                                     cache_key, cached['text'] if cached else None)
+                if job is None:
+                    app.logger.warning("Cola de OCR llena, se rechaza la imagen")
+                    discard_upload(source)
+                    os.remove(static_filepath)
+                    response = jsonify({
+                        'success': False,
+                        'error': 'Hay demasiadas imágenes en proceso. Intenta de nuevo en unos segundos.'
+                    })
+                    response.headers['Retry-After'] = '5'
+                    return response, 429
                 
                 return jsonify({
                     'success': True,
-                    'message': '¡Imagen procesada exitosamente! Ahora puedes hacer preguntas sobre su contenido.',
+                    'message': 'Imagen recibida. Extrayendo el texto...',
                     'filename': filename,
-                    'image_url': f'/static/uploads/{filename}'
-                })
+                    'image_url': image_url,
+                    'job_id': job['job_id'],
+                    'status': job['status']
+                }), 202
                 
             except Exception as e:
                 app.logger.error(f"Error procesando imagen: {str(e)}")
-                if os.path.exists(filepath):
-                    os.remove(filepath)
+                discard_upload(source)
                 if os.path.exists(static_filepath):
                     os.remove(static_filepath)
                 return jsonify({
@@ -583,6 +4058,9 @@ def upload_image():
                 'error': f'Error al guardar la imagen: {str(e)}'
             })
             
+    except RequestEntityTooLarge as e:
+        app.logger.error(f"Imagen demasiado grande: {e.description}")
+        return jsonify({'success': False, 'error': e.description}), 413
     except Exception as e:
         app.logger.error(f"Error en upload_image: {str(e)}")
         return jsonify({
@@ -595,6 +4073,33 @@ def upload_image():
 def serve_upload(filename):
     return send_from_directory(app.config['STATIC_FOLDER'], filename)
 
+def warm_up():
+    """Carga lo que de otro modo se carga con el primer pedido: los módulos
+    pesados, el convertidor de markdown del hilo y la codificación de tiktoken."""
+    started = time.perf_counter()
+    for module in heavy_modules:
+        module._load()
+    block_level_tags()
+    format_response('**Libre AI**')
+    get_token_encoding()
+    app.logger.info(f"Módulos cargados en {time.perf_counter() - started:.2f}s")
+
+def startup_checks():
+    """Revisiones al iniciar el servidor, sin bloquearlo: ollama_monitor
+    consulta Ollama en su hilo (y avisa en el log si no responde), y en otro
+    hilo se cargan los módulos pesados y se comprueba tesseract."""
+    ollama_monitor.start()
+    
+    def run():
+        warm_up()
+        check_tesseract()
+    threading.Thread(target=run, daemon=True).start()
+
+# Con WARM_UP todo se carga al importar, antes de que gunicorn --preload cree
+# los workers (no en los procesos de los pools, que también importan app.py)
+if app.config['WARM_UP'] and multiprocessing.parent_process() is None:
+    warm_up()
+
 if __name__ == '__main__':
     try:
         # Configurar el logger para mostrar más información
@@ -628,21 +4133,10 @@ if __name__ == '__main__':
                 print(f"ERROR: No se pudo crear la carpeta de uploads: {str(e)}")
                 exit(1)
 
-        # Verificar conexión con Ollama
-        try:
-            response = requests.get('http://localhost:11434/api/tags', timeout=5)
-            if response.status_code == 200:
-                print("✓ Conexión con Ollama establecida")
-            else:
-                print("ERROR: Ollama no está respondiendo correctamente")
-                print("Por favor, asegúrese de que Ollama esté en ejecución")
-                exit(1)
-        except requests.exceptions.RequestException as e:
-            print("ERROR: No se puede conectar con Ollama")
-            print("1. Asegúrese de que Ollama esté instalado")
-            print("2. Ejecute Ollama antes de iniciar esta aplicación")
-            print(f"Error detallado: {str(e)}")
-            exit(1)
+        # Ollama y tesseract se revisan en segundo plano: el servidor inicia
+        # aunque Ollama tarde más en estar listo
+        startup_checks()
+        print("✓ Conexión con Ollama: se revisa en segundo plano (ver el log o /models)")
 
         print("\n=== Iniciando Servidor de Chat IA ===")
         print("✓ Todas las verificaciones completadas")
@@ -0,0 +1,519 @@
+"""Servidor asyncio (aiohttp) para muchos chats simultáneos.
+
+Con app.run cada /chat ocupa un hilo durante toda la respuesta, esperando a
+Ollama. Aquí /chat se atiende con asyncio: mientras Ollama genera, la
+conexión no ocupa ningún hilo, así que un proceso sostiene cientos de
+respuestas a la vez. Armar el prompt (búsqueda en el PDF, embeddings, cuenta
+de tokens) y renderizar las respuestas a HTML se hace en un pool de hilos.
+
+El resto de las rutas (subidas, OCR, estado, archivos estáticos) son las de
+Flask, que se ejecutan en el mismo pool de hilos y leen el cuerpo de la
+solicitud a medida que llega; el trabajo pesado de PDFs y OCR sigue yendo a
+los pools de procesos de app.py. Lo que dura mucho no pasa por ese pool: el
+avance con ?stream=1 se lee aquí con asyncio, y las preguntas sobre todo el
+PDF tienen su propio pool.
+
+Uso:
+    python async_server.py [--host 0.0.0.0] [--port 5000]
+"""
+import argparse
+import asyncio
+import io
+import json
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from aiohttp import web
+from werkzeug.utils import secure_filename
+
+from app import (app, OLLAMA_BASE_URL, OLLAMA_TIMEOUT_MESSAGE, OLLAMA_CONNECTION_MESSAGE,
+                 OLLAMA_BUSY_MESSAGE, ResponseStream, ollama_scheduler, ollama_monitor, generations,
+                 response_broker, document_store, prepare_chat, prepare_document_chat, ollama_path,
+                 response_key, save_turn, ingestion_notice, error_frame, startup_checks)
+
+# Sesión de aiohttp con Ollama, compartida por todos los /chat
+OLLAMA_SESSION = web.AppKey('ollama', aiohttp.ClientSession)
+
+executor = ThreadPoolExecutor(max_workers=app.config['ASYNC_WORKER_THREADS'], thread_name_prefix='async-server')
+# Las preguntas sobre todo el PDF esperan a Ollama durante todo el map-reduce:
+# un pool aparte para que no dejen sin hilos al resto de las rutas
+document_threads = ThreadPoolExecutor(max_workers=app.config['ASYNC_DOCUMENT_THREADS'],
+                                      thread_name_prefix='async-document')
+
+
+async def iterate_in_thread(iterator, pool):
+    """Recorre iterator en un hilo de pool y entrega sus elementos a medida
+    que llegan, sin bloquear el bucle de eventos."""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def run():
+        try:
+            for item in iterator:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    task = loop.run_in_executor(pool, run)
+    while (item := await queue.get()) is not None:
+        yield item
+    await task  # Propaga la excepción del iterador
+
+
+async def render(stream, texts=(), flush=False):
+    """Pasa los textos por stream (y con flush, envía lo agrupado) en el pool
+    de hilos: renderizar el markdown a HTML es trabajo de CPU y no debe frenar
+    el bucle de eventos. Devuelve las líneas que hay que enviar."""
+    def run():
+        frames = [stream.push(text) for text in texts]
+        if flush:
+            frames.append(stream.flush())
+        return [frame for frame in frames if frame]
+
+    return await asyncio.get_running_loop().run_in_executor(executor, run)
+
+
+async def wait_for_turn(ticket, thinking_frame, generation, send):
+    """Como app.wait_for_turn, sin ocupar un hilo mientras se espera."""
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    ollama_scheduler.on_ready(ticket, lambda: loop.call_soon_threadsafe(ready.set_result, True))
+    position = ollama_scheduler.position(ticket)
+    if position:
+        thinking_frame['queue'] = {'position': position, 'model': ticket.model}
+    await send(json.dumps(thinking_frame) + '\n')
+    deadline = time.time() + app.config['OLLAMA_QUEUE_TIMEOUT']
+    while True:
+        try:
+            await asyncio.wait_for(asyncio.shield(ready), 1)
+            return True
+        except asyncio.TimeoutError:
+            if time.time() > deadline or generation.cancelled.is_set():
+                return False
+        current = ollama_scheduler.position(ticket)
+        if current != position:
+            position = current
+            await send(json.dumps({'thinking': thinking_frame['thinking'],
+                                   'queue': {'position': position, 'model': ticket.model}}) + '\n')
+
+
+async def stream_shared(key, payload, thinking_frame, ingestion, generation, stream_mode, send):
+    """Como app.stream_shared, esperando los textos sin ocupar un hilo."""
+    loop = asyncio.get_running_loop()
+    stream = ResponseStream(
+        stream_mode,
+        flush_interval=app.config['STREAM_FLUSH_INTERVAL'],
+        flush_tokens=app.config['STREAM_FLUSH_TOKENS']
+    )
+    generation.stream = stream
+    notice = ingestion_notice(ingestion) if ingestion else ''
+
+    answer = response_broker.cache.get(key)
+    if answer is not None:
+        generation.mode = 'cached'
+        generation.sent = time.perf_counter()
+        generation.observe({'response': answer})
+        await send(json.dumps(thinking_frame) + '\n')
+        await send(json.dumps({'clear_thinking': True}) + '\n')
+        for frame in await render(stream, [notice + answer], flush=True):
+            await send(frame)
+        return
+
+    shared, created = response_broker.join(key, payload)
+    if shared is None:
+        await send(error_frame(OLLAMA_BUSY_MESSAGE))
+        return
+    if not created:
+        generation.mode = 'coalesced'
+    changed = asyncio.Event()
+    listener = lambda: loop.call_soon_threadsafe(changed.set)  # noqa: E731
+    shared.add_listener(listener)
+    generation.closer = listener
+    joined = time.perf_counter()
+    try:
+        admitted = await wait_for_turn(shared.ticket, thinking_frame, generation, send)
+        generation.mark('queue')
+        if generation.cancelled.is_set():
+            return
+        if not admitted:
+            await send(error_frame(OLLAMA_BUSY_MESSAGE))
+            return
+
+        index = 0
+        started = False
+        while True:
+            changed.clear()
+            parts, done = shared.wait(index)
+            if generation.cancelled.is_set():
+                return
+            texts = list(parts)
+            if not started and parts:
+                # Limpiar mensaje de "pensando" y comenzar a mostrar la respuesta
+                started = True
+                generation.sent = max(shared.sent or joined, joined)
+                await send(json.dumps({'clear_thinking': True}) + '\n')
+                if notice:
+                    texts.insert(0, notice)
+            for text in parts:
+                generation.observe({'response': text})
+            if texts:
+                for frame in await render(stream, texts):
+                    await send(frame)
+            index += len(parts)
+            if done:
+                break
+            if not parts:
+                # Esperar el siguiente texto, como mucho hasta que venza lo agrupado
+                try:
+                    await asyncio.wait_for(changed.wait(), stream.flush_due())
+                except asyncio.TimeoutError:
+                    for frame in await render(stream, flush=True):
+                        await send(frame)
+
+        generation.prompt_eval = shared.prompt_eval if created else 0
+        if created:
+            generation.ollama_stats = shared.ollama_stats
+        if shared.error:
+            await send(error_frame(shared.error))
+            return
+        # Enviar los tokens que quedaron agrupados
+        for frame in await render(stream, flush=True):
+            await send(frame)
+    finally:
+        shared.remove_listener(listener)
+        response_broker.leave(shared)
+
+
+async def chat(request):
+    """Misma respuesta NDJSON que la ruta /chat de Flask."""
+    data = await request.json()
+    loop = asyncio.get_running_loop()
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+    await response.prepare(request)
+
+    async def send(line):
+        await response.write(line.encode('utf-8'))
+
+    ticket = None
+    turn = None
+    request_id = str(data.get('request_id') or uuid.uuid4())[:64]
+    generation = generations.start(
+        request_id, lambda: request.transport is None or request.transport.is_closing()
+    )
+    try:
+        job = await loop.run_in_executor(executor, prepare_document_chat, data)
+        if job is None:
+            payload, thinking_frame, ingestion, turn = await loop.run_in_executor(executor, prepare_chat, data)
+        else:
+            thinking_frame, ingestion = job.thinking_frame, job.ingestion
+        generation.mark('prompt')
+        thinking_frame['request_id'] = request_id
+        if turn:
+            generation.mode = turn['mode']
+        if job is not None:
+            # Pregunta sobre todo el PDF: el map y el reduce esperan a Ollama en
+            # un hilo de document_threads; cada línea de avance se envía al llegar
+            generation.mode = 'document'
+            generation.closer = job.cancel
+            async for line in iterate_in_thread(job.run(generation), document_threads):
+                await send(line)
+            if generation.cancelled.is_set():
+                return response
+            if job.error:
+                await send(error_frame(job.error))
+                return response
+            payload = job.payload
+        # Pedidos deterministas: respuesta de la caché o compartida con los
+        # pedidos idénticos en curso
+        key = response_key(payload)
+        if key:
+            await stream_shared(key, payload, thinking_frame, ingestion, generation,
+                                data.get('stream_mode', 'snapshot'), send)
+            return response
+        ticket = ollama_scheduler.enqueue(payload['model'])
+        if ticket is None:
+            await send(error_frame(OLLAMA_BUSY_MESSAGE))
+            return response
+        # Enviar mensaje inicial de "pensando" con la cuenta de tokens (y la
+        # posición en la cola mientras se espera)
+        admitted = await wait_for_turn(ticket, thinking_frame, generation, send)
+        generation.mark('queue')
+        if generation.cancelled.is_set():
+            return response
+        if not admitted:
+            await send(error_frame(OLLAMA_BUSY_MESSAGE))
+            return response
+
+        try:
+            generation.sent = time.perf_counter()
+            upstream = await request.app[OLLAMA_SESSION].post(OLLAMA_BASE_URL + ollama_path(payload), json=payload)
+            generation.mark('connect')
+            # Al cancelar (desde otro hilo) se corta la conexión y Ollama deja de generar
+            generation.closer = lambda: loop.call_soon_threadsafe(upstream.close)
+            if generation.cancelled.is_set():
+                upstream.close()
+                return response
+        except asyncio.TimeoutError:
+            await send(error_frame(OLLAMA_TIMEOUT_MESSAGE))
+            return response
+        except aiohttp.ClientConnectionError:
+            ollama_monitor.wake()
+            await send(error_frame(OLLAMA_CONNECTION_MESSAGE))
+            return response
+
+        # Al salir (también si el navegador se desconecta) se cierra la conexión con Ollama
+        async with upstream:
+            if upstream.status != 200:
+                text = await upstream.text()
+                await send(error_frame(f"Error al conectar con Ollama API. Código de estado: {upstream.status}. Respuesta: {text}"))
+                return response
+
+            # Limpiar mensaje de "pensando" y comenzar a mostrar la respuesta
+            await send(json.dumps({'clear_thinking': True}) + '\n')
+
+            stream = ResponseStream(
+                data.get('stream_mode', 'snapshot'),
+                flush_interval=app.config['STREAM_FLUSH_INTERVAL'],
+                flush_tokens=app.config['STREAM_FLUSH_TOKENS']
+            )
+            generation.stream = stream
+            if ingestion:
+                for frame in await render(stream, [ingestion_notice(ingestion)]):
+                    await send(frame)
+
+            # Ollama envía una línea JSON por token; la última (con el contexto)
+            # puede ser muy larga, así que se separan las líneas a mano. Si
+            # Ollama hace una pausa, lo agrupado se envía al vencer su plazo
+            buffer = b''
+            read = None
+            try:
+                while True:
+                    read = read or asyncio.ensure_future(upstream.content.readany())
+                    done, _ = await asyncio.wait({read}, timeout=stream.flush_due())
+                    if not done:
+                        for frame in await render(stream, flush=True):
+                            await send(frame)
+                        continue
+                    block = read.result()
+                    read = None
+                    if not block:
+                        break
+                    buffer += block
+                    *lines, buffer = buffer.split(b'\n')
+                    texts = []
+                    for line in lines:
+                        if not line.strip():
+                            continue
+                        try:
+                            ai_response = generation.observe(json.loads(line))
+                        except json.JSONDecodeError as e:
+                            app.logger.error(f"Error al decodificar JSON: {str(e)} para la línea: {line}")
+                            continue
+                        if ai_response:
+                            texts.append(ai_response)
+                    # Los tokens del mismo bloque se renderizan en una sola pasada por el pool
+                    if texts:
+                        for frame in await render(stream, texts):
+                            await send(frame)
+            finally:
+                if read is not None:
+                    read.cancel()
+
+            if generation.cancelled.is_set():
+                return response
+
+            # Enviar los tokens que quedaron agrupados
+            for frame in await render(stream, flush=True):
+                await send(frame)
+
+    except ConnectionResetError:
+        # Al salir del bloque async with ya se cerró la conexión con Ollama
+        generation.cancel('disconnect')
+    except asyncio.CancelledError:
+        # aiohttp cancela el handler si el navegador se desconecta
+        generation.cancel('disconnect')
+        raise
+    except Exception as e:
+        # Al cancelar, leer de la conexión cortada falla: no es un error
+        if not generation.cancelled.is_set():
+            await send(error_frame(f"Error de conexión: {str(e)}"))
+    finally:
+        if ticket is not None:
+            ollama_scheduler.release(ticket)
+        if turn and generation.answer:
+            await loop.run_in_executor(executor, save_turn, turn, ''.join(generation.answer))
+        generations.finish(generation)
+    return response
+
+
+class RequestBody(io.RawIOBase):
+    """wsgi.input que Flask lee desde un hilo del pool: cada lectura espera en
+    el bucle de eventos el siguiente bloque del cuerpo de la solicitud. Así
+    una subida pasa por los límites y el archivo temporal de UploadBuffer a
+    medida que llega, en lugar de leerse entera en memoria antes de llamar a
+    Flask."""
+
+    def __init__(self, content, loop):
+        self.content = content
+        self.loop = loop
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = asyncio.run_coroutine_threadsafe(self.content.read(len(buffer)), self.loop).result()
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def wsgi_environ(request, body):
+    """Entorno WSGI equivalente a la solicitud de aiohttp; body es el
+    wsgi.input (ver RequestBody)."""
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': request.path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': request.query_string,
+        'SERVER_NAME': request.host.split(':')[0],
+        'SERVER_PORT': str(request.url.port or 80),
+        'SERVER_PROTOCOL': f'HTTP/{request.version.major}.{request.version.minor}',
+        'REMOTE_ADDR': request.remote or '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.scheme,
+        'wsgi.input': body,
+        # aiohttp entrega el cuerpo ya delimitado (también con chunked): Flask
+        # lo lee hasta el final, con MAX_CONTENT_LENGTH como tope
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in request.headers.items():
+        key = name.upper().replace('-', '_')
+        if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[key] = value
+        else:
+            key = f'HTTP_{key}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def flask_route(request):
+    """Atiende la solicitud con la aplicación Flask en el pool de hilos; las
+    respuestas en streaming (p. ej. ?stream=1) se envían a medida que llegan."""
+    loop = asyncio.get_running_loop()
+    environ = wsgi_environ(request, RequestBody(request.content, loop))
+    queue = asyncio.Queue()
+    disconnected = threading.Event()
+
+    def run():
+        # Llamar a Flask e iterar la respuesta en el mismo hilo: el contexto de
+        # la solicitud de Flask no puede pasar de un hilo a otro
+        def start_response(status, headers, exc_info=None):
+            loop.call_soon_threadsafe(queue.put_nowait, (int(status.split(' ', 1)[0]), headers))
+            return lambda data: None
+
+        try:
+            result = app.wsgi_app(environ, start_response)
+            try:
+                for block in result:
+                    if disconnected.is_set():
+                        break
+                    if block:
+                        loop.call_soon_threadsafe(queue.put_nowait, block)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    task = loop.run_in_executor(executor, run)
+    started = await queue.get()
+    if started is None:
+        await task  # Propaga la excepción de Flask
+        return web.Response(status=500)
+
+    status, headers = started
+    response = web.StreamResponse(status=status)
+    for name, value in headers:
+        if name.lower() not in ('content-length', 'transfer-encoding', 'connection'):
+            response.headers.add(name, value)
+    try:
+        await response.prepare(request)
+        while (block := await queue.get()) is not None:
+            await response.write(block)
+        await response.write_eof()
+    finally:
+        # Si el navegador se desconectó, dejar de iterar la respuesta de Flask
+        disconnected.set()
+    return response
+
+
+async def status_stream(request):
+    """/upload_progress y /ocr_status. Con ?stream=1 envía una línea NDJSON por
+    cada cambio, como app.stream_status, pero esperando con asyncio entre una
+    lectura y otra en lugar de ocupar un hilo hasta que termina."""
+    if not request.query.get('stream'):
+        return await flask_route(request)
+    if 'filename' in request.match_info:
+        key = ('ingestion', secure_filename(request.match_info['filename']))
+    else:
+        key = ('ocr_job', request.match_info['job_id'])
+    loop = asyncio.get_running_loop()
+    # Con STATE_BACKEND 'sqlite' cada lectura es una consulta: se hace en el pool
+    state = await loop.run_in_executor(executor, document_store.get_value, key)
+    if state is None:
+        return await flask_route(request)  # El 404 de Flask
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson; charset=utf-8'})
+    await response.prepare(request)
+    last = None
+    while state is not None:
+        current = dict(state)
+        if current != last:
+            await response.write((json.dumps(current) + '\n').encode('utf-8'))
+            last = current
+        if current['status'] not in ('queued', 'running'):
+            break
+        await asyncio.sleep(app.config['STATUS_POLL_INTERVAL'])
+        state = await loop.run_in_executor(executor, document_store.get_value, key)
+    await response.write_eof()
+    return response
+
+
+async def open_ollama_session(server):
+    connector = aiohttp.TCPConnector(limit=app.config['ASYNC_UPSTREAM_CONNECTIONS'])
+    # Mismos límites que el cliente de Ollama de app.py
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=app.config['OLLAMA_CONNECT_TIMEOUT'],
+                                    sock_read=app.config['REQUEST_TIMEOUT'])
+    server[OLLAMA_SESSION] = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+async def close_ollama_session(server):
+    await server[OLLAMA_SESSION].close()
+
+
+def create_app():
+    server = web.Application(client_max_size=app.config.get('MAX_CONTENT_LENGTH') or 1024 ** 3)
+    server.router.add_post('/chat', chat)
+    server.router.add_get('/upload_progress/{filename}', status_stream)
+    server.router.add_get('/ocr_status/{job_id}', status_stream)
+    server.router.add_route('*', '/{path:.*}', flask_route)
+    server.on_startup.append(open_ollama_session)
+    server.on_cleanup.append(close_ollama_session)
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Servidor asyncio del chat')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+    startup_checks()
+    print(f"✓ Servidor asyncio iniciando en: http://127.0.0.1:{args.port}")
+    web.run_app(create_app(), host=args.host, port=args.port)
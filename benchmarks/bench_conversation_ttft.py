@@ -0,0 +1,94 @@
+"""Benchmark del tiempo hasta el primer token en preguntas de seguimiento.
+
+Hace la misma serie de preguntas sobre un PDF dos veces: con pedidos sueltos a
+/api/generate (el comportamiento anterior) y en modo conversación con
+/api/chat (ver build_conversation). Por cada turno muestra el tiempo hasta el
+primer token y los tokens del prompt que Ollama tuvo que procesar
+(prompt_eval_count); en modo conversación los seguimientos solo deberían
+procesar el turno nuevo.
+
+Requiere Ollama en ejecución con el modelo indicado.
+
+Uso:
+    python benchmarks/bench_conversation_ttft.py documento.pdf [--model mistral] [--questions preguntas.txt]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import app  # noqa: E402
+
+DEFAULT_QUESTIONS = [
+    "¿De qué trata el documento?",
+    "¿Cuáles son los puntos más importantes?",
+    "¿Qué conclusiones presenta?",
+    "¿Hay fechas o cifras importantes?",
+    "Resume todo en tres oraciones.",
+]
+
+
+def load_pdf(path):
+    filename = os.path.basename(path)
+    chunks = app.iter_chunks([app.extract_text_from_pdf(path)], app.app.config['MAX_CHUNK_SIZE'])
+    for chunk in chunks:
+        app.document_store.append(('pdf', filename), chunk)
+    app.document_store.set_value(('ingestion', filename), {'status': 'done', 'upload_id': 'bench'})
+    return filename
+
+
+def ask(data):
+    """Envía un turno y devuelve (segundos hasta el primer token, prompt_eval_count)."""
+    payload, _, _, turn = app.prepare_chat(data)
+    generation = app.Generation('bench')
+    generation.sent = time.perf_counter()
+    response = app.ollama.post(app.ollama_path(payload), payload, stream=True)
+    response.raise_for_status()
+    try:
+        for line in response.iter_lines():
+            if line:
+                generation.observe(json.loads(line))
+    finally:
+        response.close()
+    if turn:
+        app.save_turn(turn, ''.join(generation.answer))
+    return generation.first_token - generation.sent, generation.prompt_eval
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('pdf', help='PDF sobre el que se pregunta')
+    parser.add_argument('--model', default='mistral', help='modelo de Ollama')
+    parser.add_argument('--questions', help='archivo con una pregunta por línea')
+    args = parser.parse_args()
+
+    questions = DEFAULT_QUESTIONS
+    if args.questions:
+        with open(args.questions, encoding='utf-8') as f:
+            questions = [line.strip() for line in f if line.strip()]
+    filename = load_pdf(args.pdf)
+
+    results = {}
+    for label, conversation in (('sin historial', False), ('conversación', True)):
+        print(f"{label}:")
+        results[label] = []
+        for turn, question in enumerate(questions, 1):
+            seconds, prompt_eval = ask({
+                'message': question, 'model': args.model, 'pdf_file': filename, 'isPdfChat': True,
+                'chat_id': f'bench-{conversation}', 'conversation': conversation
+            })
+            results[label].append(seconds)
+            print(f"  turno {turn}: primer token en {seconds * 1e3:.0f} ms, {prompt_eval} tokens procesados")
+
+    for label, times in results.items():
+        followups = times[1:] or times
+        print(f"Seguimientos {label}: {sum(followups) / len(followups) * 1e3:.0f} ms en promedio hasta el primer token")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""Microbenchmark de format_response.
+
+Compara el formateador de una sola pasada de app.py con la cascada de
+expresiones regulares original (copiada abajo tal como estaba) y comprueba
+que ambos producen exactamente el HTML guardado en benchmarks/golden.
+
+Uso:
+    python benchmarks/bench_format_response.py [--repeat 20] [--scale 20]
+"""
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+
+import markdown
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import app  # noqa: E402
+
+
+def legacy_clean_math_expressions(text):
+    replacements = {
+        r'\\begin\{align\*?\}': '',
+        r'\\end\{align\*?\}': '',
+        r'\\begin\{equation\*?\}': '',
+        r'\\end\{equation\*?\}': '',
+        r'\\ ': ' '
+    }
+    for pattern, replacement in replacements.items():
+        text = re.sub(pattern, replacement, text)
+    return text
+
+
+def legacy_format_math(text):
+    def process_math_content(match):
+        content = match.group(1).strip()
+        content = legacy_clean_math_expressions(content)
+        return f'$${content}$$'
+
+    text = re.sub(r'\\boxed\{\\text\{([^}]*)\}\}', r'<div class="boxed">\1</div>', text)
+    text = re.sub(r'\\boxed\{([^}]*)\}', r'<div class="boxed">\1</div>', text)
+    text = re.sub(r'\$\$(.*?)\$\$', lambda m: f'$${m.group(1)}$$', text, flags=re.DOTALL)
+    text = re.sub(r'\$(.*?)\$', lambda m: f'${m.group(1)}$', text)
+    text = re.sub(r'\\\[(.*?)\\\]', process_math_content, text, flags=re.DOTALL)
+    text = re.sub(r'\\\((.*?)\\\)', lambda m: f'${m.group(1)}$', text)
+    text = re.sub(r'\\times(?![a-zA-Z])', r'\\times', text)
+    text = re.sub(r'\\frac\{([^}]*)\}\{([^}]*)\}', r'\\frac{\1}{\2}', text)
+    text = re.sub(r'\\text\{([^}]*)\}', r'\1', text)
+    return text
+
+
+def legacy_format_code_blocks(text):
+    def replace_code_block(match):
+        language = match.group(1) or 'plaintext'
+        code = match.group(2).strip()
+        return f'```{language}\n{code}\n```'
+
+    return re.sub(r'```(\w*)\n(.*?)```', replace_code_block, text, flags=re.DOTALL)
+
+
+def legacy_format_response(text):
+    """Cascada original: ~12 pasadas de re.sub y un Markdown nuevo por llamada."""
+    text = legacy_format_math(text)
+    text = legacy_format_code_blocks(text)
+    math_blocks = []
+
+    def math_replace(match):
+        math_blocks.append(match.group(0))
+        return f'MATH_BLOCK_{len(math_blocks)-1}_'
+
+    text = re.sub(r'\$\$.*?\$\$|\$.*?\$', math_replace, text, flags=re.DOTALL)
+    md = markdown.Markdown(extensions=['fenced_code', 'tables'])
+    text = md.convert(text)
+    for i, block in enumerate(math_blocks):
+        text = text.replace(f'MATH_BLOCK_{i}_', block)
+    text = text.replace('</think>', '').replace('<think>', '')
+    text = re.sub(r'\n\s*\n', '\n\n', text)
+    text = re.sub(r'([.!?])\s*([A-Z])', r'\1\n\2', text)
+    return text.strip()
+
+
+def legacy_prepare(text):
+    """Solo la parte de expresiones regulares de la cascada, sin markdown."""
+    text = legacy_format_code_blocks(legacy_format_math(text))
+    return re.sub(r'\$\$.*?\$\$|\$.*?\$', 'MATH_BLOCK', text, flags=re.DOTALL)
+
+
+def load_corpus():
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(BENCH_DIR, 'golden', '*.md'))):
+        with open(path, encoding='utf-8') as f:
+            source = f.read()
+        with open(path[:-3] + '.html', encoding='utf-8') as f:
+            expected = f.read().rstrip('\n')
+        corpus.append((os.path.basename(path), source, expected))
+    return corpus
+
+
+def check_golden(corpus):
+    failures = 0
+    for name, source, expected in corpus:
+        for label, formatter in (('format_response', app.format_response), ('cascada', legacy_format_response)):
+            if formatter(source) != expected:
+                print(f"ERROR: {label} no coincide con golden/{name}")
+                failures += 1
+    return failures
+
+
+def measure(formatter, texts, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            formatter(text)
+    return (time.perf_counter() - start) / (repeat * len(texts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=20, help='repeticiones por texto')
+    parser.add_argument('--scale', type=int, default=20, help='copias del corpus en el texto grande')
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    failures = check_golden(corpus)
+    print(f"Corpus golden: {len(corpus)} textos, {failures} diferencias")
+
+    texts = [source for _, source, _ in corpus]
+    large = '\n\n'.join(texts * args.scale)
+    for label, inputs, repeat in (('corpus', texts, args.repeat), (f'texto grande ({len(large)} caracteres)', [large], max(1, args.repeat // 10))):
+        legacy = measure(legacy_format_response, inputs, repeat)
+        current = measure(app.format_response, inputs, repeat)
+        print(f"{label}: cascada {legacy * 1e3:.3f} ms, una pasada {current * 1e3:.3f} ms, x{legacy / current:.2f}")
+        legacy = measure(legacy_prepare, inputs, repeat)
+        current = measure(app.prepare_markdown, inputs, repeat)
+        print(f"  sin markdown: cascada {legacy * 1e3:.3f} ms, una pasada {current * 1e3:.3f} ms, x{legacy / current:.2f}")
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""Microbenchmarks de format_response, chunk_text y extract_text_from_pdf.
+
+Mide las tres funciones con entradas generadas y grandes, para comparar
+versiones de app.py sin depender de archivos de prueba: respuestas de cada
+estilo de benchmarks/fake_ollama.py (texto, markdown, LaTeX, código y
+mezcla), un texto de varios MB para chunk_text y un PDF sintético (el de
+bench_pdf_extraction.py) para extract_text_from_pdf.
+
+Uso:
+    python benchmarks/bench_hot_paths.py [--answer-tokens 2000] [--text-mb 8] [--pages 300] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import app  # noqa: E402
+from bench_pdf_extraction import PARAGRAPH, build_pdf  # noqa: E402
+from fake_ollama import BLOCKS, build_answer  # noqa: E402
+
+
+def best_of(repeat, function, *args):
+    """Menor tiempo de repeat llamadas y el resultado de la última."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_format_response(answer_tokens, repeat):
+    print(f"format_response (respuestas de {answer_tokens} tokens):")
+    for style in sorted(BLOCKS):
+        text = ''.join(build_answer(style, answer_tokens))
+        seconds, html = best_of(repeat, app.format_response, text)
+        print(f"  {style:9} {len(text) / 1024:6.1f} KB -> {len(html) / 1024:6.1f} KB de HTML: "
+              f"{seconds * 1e3:8.2f} ms, {len(text) / seconds / 2**20:6.2f} MB/s")
+
+
+def bench_chunk_text(text_mb, repeat):
+    text = (PARAGRAPH + '\n') * (text_mb * 2**20 // (len(PARAGRAPH) + 1))
+    chunk_size = app.app.config['MAX_CHUNK_SIZE']
+    seconds, chunks = best_of(repeat, app.chunk_text, text, chunk_size)
+    print(f"chunk_text ({len(text) / 2**20:.1f} MB, fragmentos de {chunk_size} palabras): "
+          f"{len(chunks)} fragmentos en {seconds * 1e3:.1f} ms, {len(text) / seconds / 2**20:.1f} MB/s")
+
+
+def bench_extract_text_from_pdf(pages, repeat):
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'hot_paths.pdf')
+        build_pdf(path, pages)
+        size = os.path.getsize(path)
+        seconds, text = best_of(repeat, app.extract_text_from_pdf, path)
+    print(f"extract_text_from_pdf ({pages} páginas, {size / 2**20:.1f} MB): {seconds * 1e3:.1f} ms, "
+          f"{pages / seconds:.0f} páginas/s, {len(text) / 2**20:.1f} MB de texto")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--answer-tokens', type=int, default=2000, help='tokens de cada respuesta para format_response')
+    parser.add_argument('--text-mb', type=int, default=8, help='tamaño del texto para chunk_text')
+    parser.add_argument('--pages', type=int, default=300, help='páginas del PDF sintético')
+    parser.add_argument('--repeat', type=int, default=5, help='repeticiones (se informa la más rápida)')
+    args = parser.parse_args()
+
+    bench_format_response(args.answer_tokens, args.repeat)
+    bench_chunk_text(args.text_mb, args.repeat)
+    bench_extract_text_from_pdf(args.pages, args.repeat)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""Benchmark del preprocesado de imágenes antes de tesseract.
+
+Pasa por OCR las imágenes de static/uploads que tienen transcripción en
+benchmarks/ocr_truth, con y sin preprocess_for_ocr, y compara la latencia y
+la exactitud por caracteres (1 - distancia de edición / longitud del texto
+esperado, con los espacios normalizados). Con --scale las imágenes se amplían
+antes para simular fotos de teléfono, y con --rotate se inclinan unos grados.
+También compara el tamaño del original con el de la miniatura del chat.
+
+Requiere tesseract instalado con los idiomas de OCR_LANG.
+
+Uso:
+    python benchmarks/bench_ocr_preprocessing.py [--repeat 3] [--scale 3] [--rotate 2]
+"""
+import argparse
+import glob
+import os
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import app  # noqa: E402
+
+
+def normalize(text):
+    return ' '.join(text.split())
+
+
+def edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+def accuracy(text, truth):
+    text, truth = normalize(text), normalize(truth)
+    return max(0.0, 1 - edit_distance(text, truth) / max(1, len(truth)))
+
+
+def load_samples():
+    samples = []
+    for truth_path in sorted(glob.glob(os.path.join(BENCH_DIR, 'ocr_truth', '*.txt'))):
+        stem = os.path.splitext(os.path.basename(truth_path))[0]
+        images = glob.glob(os.path.join(app.app.config['STATIC_FOLDER'], stem + '.*'))
+        if not images:
+            print(f"Aviso: no hay imagen para ocr_truth/{stem}.txt")
+            continue
+        with open(truth_path, encoding='utf-8') as f:
+            samples.append((os.path.basename(images[0]), images[0], f.read()))
+    return samples
+
+
+def prepare_image(path, folder, scale, rotate):
+    """Copia la imagen ampliada y/o inclinada como JPEG, como llegaría de un teléfono."""
+    if scale == 1 and not rotate:
+        return path
+    image = Image.open(path).convert('RGB')
+    if scale != 1:
+        image = image.resize((round(image.width * scale), round(image.height * scale)), Image.LANCZOS)
+    if rotate:
+        image = image.rotate(rotate, resample=Image.BICUBIC, expand=True, fillcolor=(255, 255, 255))
+    target = os.path.join(folder, os.path.splitext(os.path.basename(path))[0] + '.jpg')
+    image.save(target, 'JPEG', quality=90)
+    return target
+
+
+def measure(path, repeat, **options):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        text = app.ocr_image(path, app.app.config['OCR_LANG'], **options)
+    return (time.perf_counter() - start) / repeat, text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3, help='repeticiones por imagen')
+    parser.add_argument('--scale', type=float, default=1, help='factor de ampliación de las imágenes')
+    parser.add_argument('--rotate', type=float, default=0, help='grados de inclinación de las imágenes')
+    args = parser.parse_args()
+
+    samples = load_samples()
+    if not samples:
+        print("No hay imágenes con transcripción")
+        return 1
+    options = {'max_side': app.app.config['OCR_MAX_SIDE'], 'min_side': app.app.config['OCR_MIN_SIDE']}
+    totals = {'original': [0.0, 0.0], 'preprocesada': [0.0, 0.0]}
+
+    with tempfile.TemporaryDirectory() as folder:
+        for name, path, truth in samples:
+            path = prepare_image(path, folder, args.scale, args.rotate)
+            with Image.open(path) as image:
+                size = image.size
+            thumb_path = os.path.join(folder, app.thumbnail_name(name, 'bench'))
+            app.save_thumbnail(path, thumb_path, app.app.config['THUMBNAIL_MAX_SIDE'], app.app.config['THUMBNAIL_QUALITY'])
+            print(f"{name} {size[0]}x{size[1]}: {os.path.getsize(path) / 1024:.0f} KB, "
+                  f"miniatura {os.path.getsize(thumb_path) / 1024:.0f} KB")
+            for label, kwargs in (('original', {}), ('preprocesada', options)):
+                seconds, text = measure(path, args.repeat, **kwargs)
+                score = accuracy(text, truth)
+                totals[label][0] += seconds
+                totals[label][1] += score
+                print(f"  {label}: {seconds * 1e3:.0f} ms, exactitud {score:.1%}")
+
+    for label, (seconds, score) in totals.items():
+        print(f"Total {label}: {seconds * 1e3:.0f} ms, exactitud media {score / len(samples):.1%}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
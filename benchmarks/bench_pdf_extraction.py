@@ -0,0 +1,92 @@
+"""Benchmark de extract_text_from_pdf.
+
+Genera un PDF sintético y compara la extracción original (página a página
+con text +=) con la de app.py en serie y en paralelo, en páginas por
+segundo. También comprueba que todas devuelven exactamente el mismo texto.
+
+Uso:
+    python benchmarks/bench_pdf_extraction.py [--pages 1500] [--workers 1 2 4]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import fitz
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import app  # noqa: E402
+
+PARAGRAPH = ("El contrato de arrendamiento establece que la fianza se devolverá al final del periodo. "
+             "The tenant shall pay the rent on the first business day of each month. ")
+
+
+def legacy_extract_text_from_pdf(file_path):
+    """extract_text_from_pdf tal como estaba antes de la extracción en paralelo."""
+    doc = fitz.open(file_path)
+    text = ""
+    for page in doc:
+        page_text = page.get_text()
+        text += page_text
+    doc.close()
+    return text
+
+
+def build_pdf(path, pages):
+    doc = fitz.open()
+    for page_num in range(pages):
+        page = doc.new_page()
+        body = f"Página {page_num + 1}\n" + PARAGRAPH * 12
+        page.insert_textbox(fitz.Rect(40, 40, 560, 800), body, fontsize=9)
+    doc.save(path)
+    doc.close()
+
+
+def measure(extract, path, pages, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        text = extract(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return text, pages / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, default=1500, help='páginas del PDF sintético')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='procesos a probar')
+    parser.add_argument('--repeat', type=int, default=3, help='repeticiones (se toma la mejor)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'bench.pdf')
+        build_pdf(path, args.pages)
+        print(f"PDF sintético: {args.pages} páginas, {os.path.getsize(path) // 1024} KB")
+
+        expected, rate = measure(legacy_extract_text_from_pdf, path, args.pages, args.repeat)
+        print(f"original (text +=): {rate:8.0f} páginas/s")
+
+        failures = 0
+        app.app.config['PDF_PARALLEL_MIN_PAGES'] = 1
+        for workers in args.workers:
+            app.app.config['PDF_EXTRACT_WORKERS'] = workers
+            app.discard_process_pool('pdf')
+            if workers > 1:
+                # Arrancar los procesos antes de medir; en el servidor el pool se reutiliza
+                app.extract_text_from_pdf(path)
+            text, rate = measure(app.extract_text_from_pdf, path, args.pages, args.repeat)
+            if text != expected:
+                print(f"ERROR: el texto extraído con {workers} procesos no coincide")
+                failures += 1
+            print(f"{workers} proceso(s):        {rate:8.0f} páginas/s")
+        app.discard_process_pool('pdf')
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
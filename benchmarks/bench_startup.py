@@ -0,0 +1,177 @@
+"""Benchmark del arranque: importar app.py y atender los primeros pedidos.
+
+Cada medición usa un proceso nuevo, como un worker recién creado. Mide el
+tiempo de importar app.py (y qué módulos pesados quedan cargados), el de
+warm_up(), los módulos que más tardan en importarse (python -X importtime)
+y, para cada servidor, cuánto tarda desde que se lanza el proceso hasta
+responder /health y cuánto tardan la primera y la segunda subida de un PDF
+(la primera carga PyMuPDF si warm_up no terminó antes).
+
+No necesita Ollama: el servidor inicia igual y lo revisa en segundo plano.
+
+Uso:
+    python benchmarks/bench_startup.py [--repeat 5] [--servers flask async] [--json]
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+import fitz
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+HEAVY_PACKAGES = ('fitz', 'pymupdf', 'numpy', 'markdown', 'PIL', 'pytesseract', 'tiktoken')
+
+IMPORT_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter() - started
+started = time.perf_counter()
+if {warm_up}:
+    app.warm_up()
+warmed = time.perf_counter() - started
+heavy = sorted({{name.split('.')[0] for name in sys.modules}} & set({heavy!r}))
+print(json.dumps({{'import': imported, 'warm_up': warmed, 'heavy': heavy}}))
+"""
+
+SERVERS = {
+    # Como python app.py, pero en otro puerto
+    'flask': "import app; app.startup_checks(); app.app.run(port={port}, threaded=True)",
+    'async': "import sys; sys.argv = ['async_server.py', '--port', '{port}']; import runpy; "
+             "runpy.run_path('async_server.py', run_name='__main__')",
+}
+
+
+def run_python(code):
+    return subprocess.run([sys.executable, '-c', code], cwd=ROOT_DIR, capture_output=True, text=True, check=True).stdout
+
+
+def measure_import(repeat, warm_up):
+    runs = [json.loads(run_python(IMPORT_SCRIPT.format(warm_up=warm_up, heavy=HEAVY_PACKAGES)).splitlines()[-1])
+            for _ in range(repeat)]
+    return {
+        'import_ms': statistics.median(run['import'] for run in runs) * 1e3,
+        'warm_up_ms': statistics.median(run['warm_up'] for run in runs) * 1e3,
+        'heavy': runs[-1]['heavy'],
+    }
+
+
+def slowest_imports(count):
+    """Módulos que app.py importa directamente y más tardan (con lo que ellos importan)."""
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=ROOT_DIR,
+                            capture_output=True, text=True, check=True).stderr
+    children = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or line.count('|') != 2:
+            continue
+        _, cumulative_us, name = line.split('|')
+        if not cumulative_us.strip().isdigit():
+            continue
+        # python -X importtime lista cada módulo después de los que importa, con más sangría
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        if level == 0:
+            if name.strip() == 'app':
+                break
+            children = []
+        elif level == 1:
+            children.append((name.strip(), int(cumulative_us)))
+    return sorted(children, key=lambda item: -item[1])[:count]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def build_pdf():
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((72, 72), f"Prueba de arranque {uuid.uuid4().hex}")
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def post_pdf(url):
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="arranque-{boundary[:8]}.pdf"\r\n'
+            'Content-Type: application/pdf\r\n\r\n').encode() + build_pdf() + f'\r\n--{boundary}--\r\n'.encode()
+    request = urllib.request.Request(url + '/upload', data=body, method='POST',
+                                     headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    started = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=60) as response:
+        result = json.loads(response.read())
+    if not result.get('success'):
+        raise RuntimeError(result.get('error'))
+    return time.perf_counter() - started
+
+
+def measure_server(kind, timeout=60):
+    port = free_port()
+    url = f'http://127.0.0.1:{port}'
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', SERVERS[kind].format(port=port)], cwd=ROOT_DIR,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                with urllib.request.urlopen(url + '/health', timeout=1):
+                    break
+            except (urllib.error.URLError, ConnectionError):
+                if process.poll() is not None or time.perf_counter() - started > timeout:
+                    raise RuntimeError(f"El servidor {kind} no respondió")
+                time.sleep(0.01)
+        ready = time.perf_counter() - started
+        first_upload = post_pdf(url)
+        second_upload = post_pdf(url)
+    finally:
+        process.terminate()
+        process.wait()
+    return {'ready_ms': ready * 1e3, 'first_upload_ms': first_upload * 1e3, 'second_upload_ms': second_upload * 1e3}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='procesos por medición (se informa la mediana)')
+    parser.add_argument('--servers', nargs='*', choices=sorted(SERVERS), default=sorted(SERVERS))
+    parser.add_argument('--json', action='store_true', help='mostrar los resultados como JSON, para guardarlos y compararlos')
+    args = parser.parse_args()
+
+    results = {
+        'import': measure_import(args.repeat, warm_up=False),
+        'import_warm_up': measure_import(args.repeat, warm_up=True),
+        'slowest_imports_ms': {name: us / 1e3 for name, us in slowest_imports(8)},
+    }
+    for kind in args.servers:
+        runs = [measure_server(kind) for _ in range(args.repeat)]
+        results[kind] = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+    print(f"import app: {results['import']['import_ms']:.0f} ms, módulos pesados cargados: "
+          f"{', '.join(results['import']['heavy']) or 'ninguno'}")
+    print(f"warm_up(): {results['import_warm_up']['warm_up_ms']:.0f} ms, cargados después: "
+          f"{', '.join(results['import_warm_up']['heavy'])}")
+    print("Importaciones más lentas de app.py: "
+          + ', '.join(f"{name} {ms:.0f} ms" for name, ms in results['slowest_imports_ms'].items()))
+    for kind in args.servers:
+        server = results[kind]
+        print(f"{kind}: responde en {server['ready_ms']:.0f} ms, primera subida {server['first_upload_ms']:.0f} ms, "
+              f"segunda {server['second_upload_ms']:.0f} ms")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
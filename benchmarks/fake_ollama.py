@@ -0,0 +1,211 @@
+"""Servidor que imita a Ollama para medir la aplicación sin un modelo real.
+
+Atiende /api/tags, /api/generate y /api/chat (con stream o sin él) y
+genera las respuestas a un ritmo fijo de tokens por segundo, después de una
+latencia que simula la lectura del prompt. La última línea trae las cuentas
+y los tiempos que informa Ollama (prompt_eval_count, eval_count, ...). Las
+respuestas pueden ser texto simple, markdown, LaTeX, código o una mezcla,
+para que el render de la aplicación trabaje como con respuestas reales.
+
+Escucha en el puerto de Ollama, así app.py y async_server.py lo usan sin
+cambios (detén Ollama antes o usa otro --port y cambia OLLAMA_BASE_URL).
+
+Uso:
+    python benchmarks/fake_ollama.py [--tokens-per-second 40] [--latency 0.3] [--answer-tokens 300] [--style mixed]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+DEFAULT_MODELS = ['mistral', 'tinyllama']
+
+# Bloques con los que se arman las respuestas de cada estilo
+BLOCKS = {
+    'plain': [
+        "El documento describe el procedimiento para solicitar una beca y los plazos de cada etapa. ",
+        "La respuesta corta es que sí, siempre que se cumplan los requisitos indicados en la sección dos. ",
+        "En resumen, el texto compara tres alternativas y recomienda la segunda por su menor costo. ",
+    ],
+    'markdown': [
+        "## Puntos principales\n\n",
+        "- **Plazo**: la solicitud se presenta antes del *15 de marzo*.\n",
+        "- **Requisitos**: promedio mínimo de 8 y constancia de inscripción.\n",
+        "1. Reunir los documentos\n2. Completar el formulario\n3. Esperar la resolución\n\n",
+        "| Etapa | Duración |\n|-------|----------|\n| Revisión | 2 semanas |\n| Entrevista | 1 día |\n\n",
+        "> Nota: los documentos deben estar firmados.\n\n",
+    ],
+    'latex': [
+        "La solución de la ecuación es \\(x = \\frac{-b \\pm \\sqrt{b^2 - 4ac}}{2a}\\). ",
+        "\\[\n\\int_0^1 x^2 \\, dx = \\frac{1}{3}\n\\]\n\n",
+        "Por lo tanto $$E = mc^2$$ y el resultado final es \\boxed{42}. ",
+        "\\begin{align*} a^2 + b^2 &= c^2 \\\\ c &= \\sqrt{a^2 + b^2} \\end{align*}\n\n",
+    ],
+    'code': [
+        "```python\ndef fibonacci(n):\n    a, b = 0, 1\n    for _ in range(n):\n        a, b = b, a + b\n    return a\n```\n\n",
+        "```bash\nfor f in *.pdf; do echo \"$f\"; done\n```\n\n",
+        "Usa `sorted(items, key=len)` para ordenar por longitud.\n\n",
+        "```javascript\nconst total = items.reduce((sum, item) => sum + item.price, 0);\n```\n\n",
+    ],
+}
+BLOCKS['mixed'] = BLOCKS['plain'] + BLOCKS['markdown'] + BLOCKS['latex'] + BLOCKS['code']
+
+TOKEN_SEPARATORS = (' ', '\n')
+
+
+def split_tokens(text):
+    """Parte el texto en piezas del tamaño aproximado de un token (palabras
+    con el espacio que las precede)."""
+    tokens = []
+    current = ''
+    for char in text:
+        if char in TOKEN_SEPARATORS and current.strip():
+            tokens.append(current)
+            current = ''
+        current += char
+    if current:
+        tokens.append(current)
+    return tokens
+
+
+def build_answer(style, answer_tokens, seed=0):
+    """Tokens de una respuesta de aproximadamente answer_tokens tokens."""
+    rng = random.Random(seed)
+    tokens = ["<think>Reviso el contexto antes de responder.</think>\n\n"] if style == 'mixed' else []
+    while len(tokens) < answer_tokens:
+        tokens.extend(split_tokens(rng.choice(BLOCKS[style])))
+    return tokens[:answer_tokens]
+
+
+class FakeOllama:
+    """Respuestas con el formato y el ritmo de Ollama."""
+
+    def __init__(self, models, tokens_per_second, latency, answer_tokens, style, load_time=0.0):
+        self.models = models
+        self.tokens_per_second = tokens_per_second
+        self.latency = latency
+        self.answer_tokens = answer_tokens
+        self.style = style
+        self.load_time = load_time
+        self.loaded = set()
+        self.counter = itertools.count()
+        self.requests = 0
+        self.cancelled = 0
+        self.active = Counter()  # Respuestas en curso por modelo
+        self.peak = Counter()  # Máximo de respuestas simultáneas por modelo
+
+    async def tags(self, request):
+        return web.json_response({'models': [
+            {'name': name, 'model': name, 'size': 4_000_000_000, 'details': {'family': 'llama'}}
+            for name in self.models
+        ]})
+
+    async def generate(self, request):
+        return await self.respond(request, chat=False)
+
+    async def chat(self, request):
+        return await self.respond(request, chat=True)
+
+    async def respond(self, request, chat):
+        payload = await request.json()
+        model = payload.get('model', self.models[0])
+        if model not in self.models:
+            return web.json_response({'error': f"model '{model}' not found"}, status=404)
+        self.requests += 1
+        self.active[model] += 1
+        self.peak[model] = max(self.peak[model], self.active[model])
+        try:
+            return await self.generate_answer(request, payload, model, chat)
+        finally:
+            self.active[model] -= 1
+
+    async def generate_answer(self, request, payload, model, chat):
+        prompt = json.dumps(payload['messages']) if chat else payload.get('prompt', '')
+        prompt_tokens = max(1, len(prompt) // 4)
+        tokens = build_answer(self.style, self.answer_tokens, seed=next(self.counter))
+        started = time.perf_counter()
+
+        load = 0.0
+        if model not in self.loaded:
+            load = self.load_time
+            self.loaded.add(model)
+        await asyncio.sleep(load + self.latency)
+        prompt_done = time.perf_counter()
+
+        def line(text, done=False):
+            body = {'model': model, 'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'done': done}
+            if chat:
+                body['message'] = {'role': 'assistant', 'content': text}
+            else:
+                body['response'] = text
+            if done:
+                finished = time.perf_counter()
+                body.update({
+                    'done_reason': 'stop',
+                    'total_duration': int((finished - started) * 1e9),
+                    'load_duration': int(load * 1e9),
+                    'prompt_eval_count': prompt_tokens,
+                    'prompt_eval_duration': int(self.latency * 1e9),
+                    'eval_count': len(tokens),
+                    'eval_duration': int((finished - prompt_done) * 1e9),
+                })
+            return body
+
+        if not payload.get('stream', True):
+            await asyncio.sleep(len(tokens) / self.tokens_per_second)
+            return web.json_response(line(''.join(tokens), done=True))
+
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        try:
+            for index, token in enumerate(tokens):
+                # Ritmo fijo respecto del comienzo, para no acumular el retraso de cada sleep
+                delay = prompt_done + index / self.tokens_per_second - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await response.write((json.dumps(line(token)) + '\n').encode('utf-8'))
+            await response.write((json.dumps(line('', done=True)) + '\n').encode('utf-8'))
+        except (ConnectionResetError, asyncio.CancelledError):
+            # La aplicación cortó la conexión: como Ollama, se deja de generar
+            self.cancelled += 1
+            raise
+        return response
+
+    def create_app(self):
+        server = web.Application()
+        server.router.add_get('/api/tags', self.tags)
+        server.router.add_post('/api/generate', self.generate)
+        server.router.add_post('/api/chat', self.chat)
+        server.on_shutdown.append(self.report)
+        return server
+
+    async def report(self, server):
+        print(f"Pedidos atendidos: {self.requests}, cortados por la aplicación: {self.cancelled}, "
+              f"simultáneos por modelo: {dict(self.peak)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11434)
+    parser.add_argument('--models', nargs='+', default=DEFAULT_MODELS, help='modelos que informa /api/tags')
+    parser.add_argument('--tokens-per-second', type=float, default=40, help='ritmo de generación por respuesta')
+    parser.add_argument('--latency', type=float, default=0.3, help='segundos antes del primer token')
+    parser.add_argument('--load-time', type=float, default=0.0, help='segundos extra la primera vez que se usa cada modelo')
+    parser.add_argument('--answer-tokens', type=int, default=300, help='tokens de cada respuesta')
+    parser.add_argument('--style', choices=sorted(BLOCKS), default='mixed', help='tipo de respuesta')
+    args = parser.parse_args()
+
+    fake = FakeOllama(args.models, args.tokens_per_second, args.latency, args.answer_tokens, args.style, args.load_time)
+    print(f"Ollama simulado en http://{args.host}:{args.port}: {args.tokens_per_second:g} tokens/s, "
+          f"{args.latency:g} s de latencia, respuestas {args.style} de {args.answer_tokens} tokens")
+    web.run_app(fake.create_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
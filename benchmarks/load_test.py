@@ -0,0 +1,254 @@
+"""Prueba de carga de /chat, /upload y /upload_image.
+
+Lanza pedidos con la concurrencia indicada contra un servidor en ejecución
+(app.py o async_server.py) y muestra, por tipo de pedido, los percentiles
+50/95/99 del tiempo hasta la primera respuesta (el primer texto de /chat o
+la respuesta de las subidas) y hasta terminar (la ingesta del PDF o el OCR),
+los pedidos por segundo y los bytes recibidos. Con /metrics activo también
+muestra los tokens por segundo y el tiempo de CPU del servidor por token.
+
+Para medir sin un modelo real, inicia antes benchmarks/fake_ollama.py. Las
+imágenes necesitan tesseract en el servidor.
+
+Uso:
+    python benchmarks/load_test.py [--url http://127.0.0.1:5000] [--scenario chat] [--concurrency 20] [--requests 200]
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import re
+import time
+import uuid
+
+import aiohttp
+import fitz
+from PIL import Image, ImageDraw
+
+SCENARIOS = {
+    'chat': ['chat'],
+    'upload': ['upload'],
+    'image': ['image'],
+    # De cada diez pedidos: ocho mensajes, un PDF y una imagen
+    'mix': ['chat'] * 8 + ['upload', 'image'],
+}
+
+METRIC_RE = re.compile(r'^(\w+)(?:\{([^}]*)\})? (\S+)$')
+
+
+def percentile(values, q):
+    """Percentil q (0-100) por el método del rango más cercano."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+def build_pdf(index, pages):
+    doc = fitz.open()
+    for page_num in range(pages):
+        page = doc.new_page()
+        body = (f"Documento {index}, página {page_num + 1}. "
+                "El informe analiza el presupuesto anual, los plazos del proyecto y los riesgos identificados. ") * 10
+        page.insert_textbox(fitz.Rect(40, 40, 560, 800), body, fontsize=10)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def build_image(index):
+    image = Image.new('RGB', (1200, 400), 'white')
+    draw = ImageDraw.Draw(image)
+    for line in range(6):
+        draw.text((40, 40 + line * 55), f"Factura {index} - renglon {line + 1}: total 1.234,56", fill='black')
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+async def read_status(session, url, timings, started):
+    """Lee un estado NDJSON (ver stream_status) hasta que termina; devuelve el último."""
+    status = None
+    async with session.get(url + '?stream=1') as response:
+        async for line in response.content:
+            timings['bytes'] += len(line)
+            if line.strip():
+                status = json.loads(line)
+    timings['done'] = time.perf_counter() - started
+    return status
+
+
+async def run_chat(session, base_url, index, args):
+    message = args.message or f"Pregunta {index}: ¿cuáles son los puntos más importantes del tema {index}?"
+    timings = {'first': None, 'done': None, 'bytes': 0, 'error': None}
+    started = time.perf_counter()
+    async with session.post(base_url + '/chat', json={
+        'message': message, 'model': args.model, 'chat_id': f'carga-{index}',
+        'request_id': uuid.uuid4().hex, 'stream_mode': args.stream_mode
+    }) as response:
+        async for line in response.content:
+            timings['bytes'] += len(line)
+            if not line.strip():
+                continue
+            frame = json.loads(line)
+            if 'error' in frame:
+                timings['error'] = frame['error']
+            elif timings['first'] is None and ('response' in frame or 'append' in frame or 'tail' in frame):
+                timings['first'] = time.perf_counter() - started
+    timings['done'] = time.perf_counter() - started
+    return timings
+
+
+async def run_upload(session, base_url, index, args):
+    filename = f'carga-{index}.pdf'
+    form = aiohttp.FormData()
+    form.add_field('file', args.pdfs[index], filename=filename, content_type='application/pdf')
+    timings = {'first': None, 'done': None, 'bytes': 0, 'error': None}
+    started = time.perf_counter()
+    async with session.post(base_url + '/upload', data=form) as response:
+        body = await response.read()
+    timings['first'] = time.perf_counter() - started
+    timings['bytes'] += len(body)
+    result = json.loads(body)
+    if not result.get('success'):
+        timings['error'] = result.get('error')
+        return timings
+    status = await read_status(session, f"{base_url}/upload_progress/{result['filename']}", timings, started)
+    if status and status['status'] == 'error':
+        timings['error'] = status['error']
+    return timings
+
+
+async def run_image(session, base_url, index, args):
+    form = aiohttp.FormData()
+    form.add_field('file', args.images[index], filename=f'carga-{index}.png', content_type='image/png')
+    form.add_field('chat_id', f'carga-{index}')
+    timings = {'first': None, 'done': None, 'bytes': 0, 'error': None}
+    started = time.perf_counter()
+    async with session.post(base_url + '/upload_image', data=form) as response:
+        body = await response.read()
+    timings['first'] = time.perf_counter() - started
+    timings['bytes'] += len(body)
+    result = json.loads(body)
+    if not result.get('success'):
+        timings['error'] = result.get('error')
+        return timings
+    status = await read_status(session, f"{base_url}/ocr_status/{result['job_id']}", timings, started)
+    if status and status['status'] == 'error':
+        timings['error'] = status['error']
+    return timings
+
+
+RUNNERS = {'chat': run_chat, 'upload': run_upload, 'image': run_image}
+
+
+async def scrape_metrics(session, base_url):
+    """CPU del proceso y tokens generados según /metrics, o None si no está activo."""
+    try:
+        async with session.get(base_url + '/metrics') as response:
+            if response.status != 200:
+                return None
+            text = await response.text()
+    except aiohttp.ClientError:
+        return None
+    cpu = tokens = 0.0
+    for line in text.splitlines():
+        match = METRIC_RE.match(line)
+        if not match:
+            continue
+        name, labels, value = match.groups()
+        if name == 'process_cpu_seconds_total':
+            cpu = float(value)
+        elif name == 'libreai_ollama_tokens_sum' and 'kind="eval"' in labels:
+            tokens += float(value)
+    return cpu, tokens
+
+
+def ms(seconds):
+    return '-' if seconds is None else f'{seconds * 1e3:.0f}'
+
+
+def report(kind, results, elapsed):
+    first = [timings['first'] for timings in results if timings['first'] is not None and not timings['error']]
+    done = [timings['done'] for timings in results if timings['done'] is not None and not timings['error']]
+    errors = [timings['error'] for timings in results if timings['error']]
+    total_bytes = sum(timings['bytes'] for timings in results)
+    print(f"{kind}: {len(results)} pedidos, {len(errors)} errores, {len(results) / elapsed:.1f} pedidos/s, "
+          f"{total_bytes / 1024:.0f} KB recibidos ({total_bytes / max(1, len(results)) / 1024:.1f} KB por pedido)")
+    print(f"  primera respuesta ms: p50 {ms(percentile(first, 50))}, p95 {ms(percentile(first, 95))}, "
+          f"p99 {ms(percentile(first, 99))}")
+    print(f"  completo ms:          p50 {ms(percentile(done, 50))}, p95 {ms(percentile(done, 95))}, "
+          f"p99 {ms(percentile(done, 99))}")
+    for error in sorted(set(errors))[:3]:
+        print(f"  error: {error[:200]}")
+
+
+async def run(args):
+    kinds = SCENARIOS[args.scenario]
+    base_url = args.url.rstrip('/')
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        async with session.get(base_url + '/models') as response:
+            models = await response.json()
+        if args.model not in [model['name'] for model in models.get('models', [])]:
+            print(f"Aviso: el servidor no informa el modelo {args.model}")
+
+        before = await scrape_metrics(session, base_url)
+        results = {kind: [] for kind in RUNNERS}
+        counter = itertools.count()
+
+        async def worker():
+            for index in counter:
+                if index >= args.requests:
+                    return
+                kind = kinds[index % len(kinds)]
+                try:
+                    timings = await RUNNERS[kind](session, base_url, index, args)
+                except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError) as e:
+                    timings = {'first': None, 'done': None, 'bytes': 0, 'error': f'{type(e).__name__}: {e}'}
+                results[kind].append(timings)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - started
+        after = await scrape_metrics(session, base_url)
+
+    print(f"{args.requests} pedidos con concurrencia {args.concurrency} en {elapsed:.1f} s")
+    for kind, kind_results in results.items():
+        if kind_results:
+            report(kind, kind_results, elapsed)
+    if before and after:
+        cpu = after[0] - before[0]
+        tokens = after[1] - before[1]
+        print(f"Servidor: {tokens:.0f} tokens generados ({tokens / elapsed:.0f} tokens/s), {cpu:.2f} s de CPU"
+              + (f", {cpu / tokens * 1e3:.3f} ms de CPU por token" if tokens else ''))
+    else:
+        print("Servidor: /metrics no disponible (METRICS_ENABLED), sin datos de CPU ni de tokens")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='dirección del servidor')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='chat', help='tipo de pedidos')
+    parser.add_argument('--concurrency', type=int, default=20, help='pedidos simultáneos')
+    parser.add_argument('--requests', type=int, default=200, help='pedidos en total')
+    parser.add_argument('--model', default='mistral', help='modelo de Ollama')
+    parser.add_argument('--message', help='mismo mensaje en todos los chats (por omisión cada uno es distinto)')
+    parser.add_argument('--stream-mode', choices=['delta', 'snapshot'], default='delta', help='formato de /chat')
+    parser.add_argument('--pdf-pages', type=int, default=20, help='páginas de cada PDF')
+    parser.add_argument('--timeout', type=float, default=600, help='segundos máximos por pedido')
+    args = parser.parse_args()
+
+    # Archivos distintos (para no medir la caché de resultados), generados antes de medir
+    kinds = SCENARIOS[args.scenario]
+    indexes = {kind: [index for index in range(args.requests) if kinds[index % len(kinds)] == kind] for kind in RUNNERS}
+    args.pdfs = {index: build_pdf(index, args.pdf_pages) for index in indexes['upload']}
+    args.images = {index: build_image(index) for index in indexes['image']}
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
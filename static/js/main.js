@@ -3,9 +3,12 @@ let chats = [];
         let messageHistory = {};
         let currentPdfFile = null;  // Variable para almacenar el nombre del PDF actual
         let currentChunkIndex = 0;  // Índice del fragmento actual
+        let chunkIndexPinned = false;  // Si el usuario fijó el fragmento con las flechas
+        let pdfIngestion = null;  // Avance del procesamiento del PDF actual
         let totalChunks = 0;  // Total de fragmentos disponibles
         let pdfChats = new Set();  // Conjunto para rastrear chats que usan PDF
         let currentController = null;
+        let currentRequestId = null;  // Identificador de la respuesta en curso, para cancelarla en el servidor
         let isGenerating = false; // Variable para controlar si estamos generando una respuesta
 
         function toggleSidebar() {
@@ -68,6 +71,7 @@ let chats = [];
             if (!pdfChats.has(chatId)) {
                 currentPdfFile = null;
                 currentChunkIndex = 0;
+                chunkIndexPinned = false;
                 totalChunks = 0;
                 updatePdfInfo();
             }
@@ -105,15 +109,18 @@ let chats = [];
                 if (pdfMessage) {
                     currentPdfFile = pdfMessage.pdfFile;
                     currentChunkIndex = pdfMessage.chunkIndex || 0;
+                    chunkIndexPinned = false;
                     totalChunks = pdfMessage.totalChunks || 0;
                 } else {
                     currentPdfFile = null;
                     currentChunkIndex = 0;
+                    chunkIndexPinned = false;
                     totalChunks = 0;
                 }
             } else {
                 currentPdfFile = null;
                 currentChunkIndex = 0;
+                chunkIndexPinned = false;
                 totalChunks = 0;
             }
             
@@ -411,8 +418,20 @@ let chats = [];
             }
         });
 
+        // Pedir al servidor que deje de generar la respuesta en curso
+        function cancelRequest() {
+            if (currentRequestId) {
+                navigator.sendBeacon(`/cancel_chat/${encodeURIComponent(currentRequestId)}`);
+                currentRequestId = null;
+            }
+        }
+
+        // Al cerrar la pestaña también se detiene la generación
+        window.addEventListener('pagehide', cancelRequest);
+
         function stopGeneration() {
             if (currentController) {
+                cancelRequest();
                 currentController.abort();
                 currentController = null;
                 toggleSendButton(false);
@@ -578,16 +597,23 @@ let chats = [];
             if (currentPdfFile && totalChunks > 0) {
                 pdfInfo.style.display = 'block';
                 status.textContent = `PDF activo: ${currentPdfFile}`;
+                if (pdfIngestion && pdfIngestion.filename === currentPdfFile && pdfIngestion.status === 'running') {
+                    status.textContent += ` (procesando: ${pdfIngestion.pages_processed} de ${pdfIngestion.pages_total} páginas)`;
+                }
                 indicator.textContent = `Fragmento ${currentChunkIndex + 1} de ${totalChunks}`;
                 
                 // Actualizar el contexto
                 let contextText = 'Analizando fragmentos: ';
-                if (currentChunkIndex > 0) {
-                    contextText += `${currentChunkIndex}, `;
-                }
-                contextText += `${currentChunkIndex + 1}`;
-                if (currentChunkIndex < totalChunks - 1) {
-                    contextText += `, ${currentChunkIndex + 2}`;
+                if (!chunkIndexPinned) {
+                    contextText = 'Analizando los fragmentos más relevantes para cada pregunta';
+                } else {
+                    if (currentChunkIndex > 0) {
+                        contextText += `${currentChunkIndex}, `;
+                    }
+                    contextText += `${currentChunkIndex + 1}`;
+                    if (currentChunkIndex < totalChunks - 1) {
+                        contextText += `, ${currentChunkIndex + 2}`;
+                    }
                 }
                 context.textContent = contextText;
                 
@@ -598,9 +624,79 @@ let chats = [];
             }
         }
 
+        function readStatusStream(url, onStatus) {
+            // Leer un estado enviado como NDJSON (una línea por cambio);
+            // la promesa se resuelve con el último estado recibido
+            return fetch(url)
+            .then(response => {
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                let status = null;
+
+                function processStatus({ done, value }) {
+                    if (done) {
+                        return status;
+                    }
+
+                    buffer += decoder.decode(value, { stream: true });
+                    const lines = buffer.split('\n');
+                    buffer = lines.pop();
+
+                    lines.forEach(line => {
+                        if (!line) return;
+                        status = JSON.parse(line);
+                        onStatus(status);
+                    });
+
+                    return reader.read().then(processStatus);
+                }
+
+                return reader.read().then(processStatus);
+            });
+        }
+
+        function followPdfIngestion(filename, pdfMessage) {
+            readStatusStream(`/upload_progress/${encodeURIComponent(filename)}?stream=1`, progress => {
+                pdfMessage.totalChunks = progress.chunks;
+                if (currentPdfFile === filename) {
+                    pdfIngestion = { ...progress, filename };
+                    totalChunks = progress.chunks;
+                    updatePdfInfo();
+                }
+            })
+            .then(progress => {
+                if (currentPdfFile !== filename || !progress) return;
+                if (progress.status === 'done') {
+                    appendMessageToUI(pdfMessage.content, false);
+                } else if (progress.status === 'error') {
+                    appendMessageToUI(`Error al procesar el PDF: ${progress.error}`, false);
+                }
+            })
+            .catch(error => {
+                console.error('Error al leer el avance del PDF:', error);
+            });
+        }
+
+        function followOcrJob(jobId, chatId) {
+            readStatusStream(`/ocr_status/${jobId}?stream=1`, () => {})
+            .then(job => {
+                if (!job || currentChatId !== chatId) return;
+                if (job.status === 'done') {
+                    appendMessageToUI('¡Imagen procesada exitosamente! Ahora puedes hacer preguntas sobre su contenido.', false);
+                } else if (job.status === 'error') {
+                    appendMessageToUI(job.error, false);
+                }
+            })
+            .catch(error => {
+                console.error('Error al leer el estado del OCR:', error);
+            });
+        }
+
         function prevChunk() {
             if (currentChunkIndex > 0) {
                 currentChunkIndex--;
+                chunkIndexPinned = true;
                 updatePdfInfo();
             }
         }
@@ -608,11 +704,12 @@ let chats = [];
         function nextChunk() {
             if (currentChunkIndex < totalChunks - 1) {
                 currentChunkIndex++;
+                chunkIndexPinned = true;
                 updatePdfInfo();
             }
         }
 
-        function appendThinkingMessage(message) {
+        function appendThinkingMessage(message, queue, documentProgress) {
             const container = document.getElementById('chat-container');
             let thinkingDiv = document.getElementById('thinking-message');
             
@@ -624,7 +721,16 @@ let chats = [];
             const isNearBottom = container.scrollHeight - container.scrollTop - container.clientHeight < 100;
             
             // Seleccionar un mensaje aleatorio de thinking en el idioma correcto
-            const randomThinkingMessage = t.thinking[Math.floor(Math.random() * t.thinking.length)];
+            // (o la posición en la cola si el modelo está ocupado, o el avance
+            // de la lectura de todo el PDF)
+            let randomThinkingMessage = t.thinking[Math.floor(Math.random() * t.thinking.length)];
+            if (queue && queue.position > 0) {
+                randomThinkingMessage = t.queued.replace('%s', queue.position);
+            } else if (documentProgress && documentProgress.stage === 'map') {
+                randomThinkingMessage = t.documentMap.replace('%s', documentProgress.done).replace('%s', documentProgress.total);
+            } else if (documentProgress && documentProgress.stage === 'reduce') {
+                randomThinkingMessage = t.documentReduce.replace('%s', documentProgress.done).replace('%s', documentProgress.total);
+            }
             
             if (!thinkingDiv) {
                 thinkingDiv = document.createElement('div');
@@ -672,6 +778,9 @@ let chats = [];
             // Crear un AbortController para poder cancelar la solicitud
             currentController = new AbortController();
             const signal = currentController.signal;
+            currentRequestId = window.crypto && crypto.randomUUID
+                ? crypto.randomUUID()
+                : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
 
             // Enviar mensaje al servidor
             fetch('/chat', {
@@ -683,9 +792,11 @@ let chats = [];
                     message: message,
                     model: selectedModel,
                     pdf_file: currentPdfFile,
-                    chunk_index: currentChunkIndex,
+                    chunk_index: chunkIndexPinned ? currentChunkIndex : null,
                     isPdfChat: pdfChats.has(currentChatId),
-                    chat_id: currentChatId  // Agregar el ID del chat actual
+                    chat_id: currentChatId,  // Agregar el ID del chat actual
+                    request_id: currentRequestId,
+                    stream_mode: 'delta'  // Recibir solo los cambios de la respuesta
                 }),
                 signal: signal // Agregar la señal para poder abortar
             })
@@ -693,9 +804,12 @@ let chats = [];
                 const reader = response.body.getReader();
                 let decoder = new TextDecoder();
                 let buffer = '';
+                // Estado de la respuesta recibida en modo 'delta'
+                const stream = { seq: 0, done: '', tail: '', doneDiv: null, tailDiv: null };
 
                 function processStream({ done, value }) {
                     if (done) {
+                        currentRequestId = null;
                         toggleSendButton(false);
                         return;
                     }
@@ -711,10 +825,16 @@ let chats = [];
                                 
                                 if (data.thinking) {
                                     // Mostrar mensaje de "pensando"
-                                    appendThinkingMessage(data.thinking);
+                                    appendThinkingMessage(data.thinking, data.queue, data.document);
+                                    if (data.tokens) {
+                                        console.debug('Tokens del prompt:', data.tokens);
+                                    }
                                 } else if (data.clear_thinking) {
                                     // Limpiar mensaje de "pensando"
                                     clearThinkingMessage();
+                                } else if (data.seq) {
+                                    // Aplicar los cambios de la respuesta del asistente
+                                    applyAssistantDelta(data, stream, wasNearBottom);
                                 } else if (data.response) {
                                     // Actualizar la respuesta del asistente
                                     updateOrAppendAssistantMessage(data.response, wasNearBottom);
@@ -752,6 +872,89 @@ let chats = [];
             }
         }
 
+        function applyAssistantDelta(data, stream, wasNearBottom) {
+            if (data.seq !== stream.seq + 1) {
+                console.warn(`Secuencia inesperada: ${data.seq} después de ${stream.seq}`);
+            }
+            stream.seq = data.seq;
+
+            const appended = data.append || '';
+            if (data.reset) {
+                stream.done = '';
+            }
+            stream.done += appended;
+            stream.tail = data.tail || '';
+            const message = stream.done + stream.tail;
+
+            if (!stream.doneDiv || !stream.doneDiv.isConnected) {
+                // Primera línea: crear el mensaje y separarlo en la parte terminada y la abierta
+                updateOrAppendAssistantMessage(message, wasNearBottom);
+                const container = document.getElementById('chat-container');
+                const contentDiv = container.lastElementChild.querySelector('.assistant-message:last-child .message-content');
+                if (!contentDiv) return;
+
+                stream.doneDiv = document.createElement('div');
+                stream.doneDiv.style.display = 'contents';
+                stream.doneDiv.innerHTML = stream.done;
+                stream.tailDiv = document.createElement('div');
+                stream.tailDiv.style.display = 'contents';
+                stream.tailDiv.innerHTML = stream.tail;
+                contentDiv.replaceChildren(stream.doneDiv, stream.tailDiv);
+                renderStreamedContent(contentDiv);
+                return;
+            }
+
+            // Solo se analiza el HTML nuevo: los bloques terminados no se vuelven a tocar
+            if (data.reset) {
+                stream.doneDiv.innerHTML = stream.done;
+                renderStreamedContent(stream.doneDiv);
+            } else if (appended) {
+                const fragment = document.createElement('template');
+                fragment.innerHTML = appended;
+                const newNodes = Array.from(fragment.content.childNodes);
+                stream.doneDiv.append(fragment.content);
+                newNodes.forEach(node => {
+                    if (node.nodeType === Node.ELEMENT_NODE) renderStreamedContent(node);
+                });
+            }
+            stream.tailDiv.innerHTML = stream.tail;
+            renderStreamedContent(stream.tailDiv);
+
+            const container = document.getElementById('chat-container');
+            if (wasNearBottom) {
+                container.scrollTop = container.scrollHeight;
+            }
+
+            // Actualizar el último mensaje en el historial
+            if (currentChatId && messageHistory[currentChatId]) {
+                const lastHistoryMessage = messageHistory[currentChatId].findLast(msg => !msg.isUser);
+                if (lastHistoryMessage) {
+                    lastHistoryMessage.content = message;
+                }
+            }
+        }
+
+        function renderStreamedContent(element) {
+            // Renderizar matemáticas y código solo dentro del elemento actualizado
+            try {
+                renderMathInElement(element, {
+                    delimiters: [
+                        {left: "$$", right: "$$", display: true},
+                        {left: "$", right: "$", display: false},
+                        {left: "\\[", right: "\\]", display: true},
+                        {left: "\\(", right: "\\)", display: false}
+                    ],
+                    throwOnError: false,
+                    output: 'html',
+                    strict: false
+                });
+            } catch (error) {
+                console.error('Error rendering math:', error);
+            }
+            const codeBlocks = element.matches('pre code') ? [element] : element.querySelectorAll('pre code');
+            codeBlocks.forEach(block => hljs.highlightElement(block));
+        }
+
         function updateOrAppendAssistantMessage(message, wasNearBottom) {
             const container = document.getElementById('chat-container');
             const lastGroup = container.lastElementChild;
@@ -866,16 +1069,29 @@ let chats = [];
             document.getElementById('configModal').classList.remove('show');
         }
 
+        // Reintento pendiente de loadAvailableModels
+        let modelsRetryTimer = null;
+
         async function loadAvailableModels() {
+            clearTimeout(modelsRetryTimer);
+            // Get current language
+            const currentLang = localStorage.getItem('selectedLanguage') || 'en';
+            const t = translations[currentLang];
             try {
-                const response = await fetch('http://localhost:11434/api/tags');
+                // El servidor guarda la lista de modelos de Ollama
+                const response = await fetch('/models');
                 const data = await response.json();
+                if (!data.success) {
+                    throw new Error(data.error || 'Ollama no responde');
+                }
                 const modelList = document.getElementById('modelList');
+                if (data.pending) {
+                    // Todavía no se consultó a Ollama: volver a pedir la lista en un momento
+                    modelList.innerHTML = `<p>${t.loadingModels}</p>`;
+                    modelsRetryTimer = setTimeout(loadAvailableModels, 1000);
+                    return;
+                }
                 modelList.innerHTML = '';
-                
-                // Get current language
-                const currentLang = localStorage.getItem('selectedLanguage') || 'en';
-                const t = translations[currentLang];
 
                 // Si hay modelos disponibles y ninguno está seleccionado, seleccionar el primero
                 if (data.models.length > 0 && !localStorage.getItem('selectedModel')) {
@@ -898,6 +1114,8 @@ let chats = [];
                 console.error('Error loading models:', error);
                 const modelList = document.getElementById('modelList');
                 modelList.innerHTML = '<p style="color: #ff4444;">Error loading models. Make sure Ollama is running.</p>';
+                // La lista aparece sola en cuanto Ollama responda
+                modelsRetryTimer = setTimeout(loadAvailableModels, 5000);
             }
         }
 
@@ -951,6 +1169,9 @@ let chats = [];
                     "Thinking...",
                     "Working on it..."
                 ],
+                queued: "Waiting in line (position %s)...",
+                documentMap: "Reading the whole document (%s of %s parts)...",
+                documentReduce: "Combining the notes (%s of %s)...",
                 delete: "Delete",
                 copy: "Copy",
                 download: "Download",
@@ -958,6 +1179,7 @@ let chats = [];
                 close: "Close",
                 select: "Select",
                 size: "Size",
+                loadingModels: "Connecting to Ollama...",
                 noModelSelected: "not selected",
                 modelSelected: "Model %s selected successfully",
                 theme: "Theme",
@@ -978,6 +1200,9 @@ let chats = [];
                     "Pensando...",
                     "Trabajando en ello..."
                 ],
+                queued: "En cola (posición %s)...",
+                documentMap: "Leyendo todo el documento (%s de %s partes)...",
+                documentReduce: "Combinando las notas (%s de %s)...",
                 delete: "Eliminar",
                 copy: "Copiar",
                 download: "Descargar",
@@ -985,6 +1210,7 @@ let chats = [];
                 close: "Cerrar",
                 select: "Seleccionar",
                 size: "Tamaño",
+                loadingModels: "Conectando con Ollama...",
                 noModelSelected: "no seleccionado",
                 modelSelected: "Modelo %s seleccionado correctamente",
                 theme: "Tema",
@@ -1111,23 +1337,32 @@ let chats = [];
                     currentPdfFile = data.filename;
                     totalChunks = data.num_chunks;
                     currentChunkIndex = 0;
+                    chunkIndexPinned = false;
+                    pdfIngestion = null;
                     // Marcar este chat como uno que usa PDF
                     pdfChats.add(currentChatId);
                     updatePdfInfo();
                     
                     // Guardar información del PDF en el historial del chat
+                    const pdfMessage = {
+                        content: `PDF "${data.filename}" procesado exitosamente.  Ahora puedes hacer preguntas sobre su contenido.`,
+                        isUser: false,
+                        timestamp: Date.now(),
+                        pdfFile: data.filename,
+                        totalChunks: data.num_chunks,
+                        chunkIndex: 0
+                    };
                     if (messageHistory[currentChatId]) {
-                        messageHistory[currentChatId].push({
-                            content: `PDF "${data.filename}" procesado exitosamente.  Ahora puedes hacer preguntas sobre su contenido.`,
-                            isUser: false,
-                            timestamp: Date.now(),
-                            pdfFile: data.filename,
-                            totalChunks: data.num_chunks,
-                            chunkIndex: 0
-                        });
+                        messageHistory[currentChatId].push(pdfMessage);
                     }
                     
-                    appendMessageToUI(`PDF "${data.filename}" procesado exitosamente.  Ahora puedes hacer preguntas sobre su contenido.`, false);
+                    if (data.ingesting) {
+                        // El PDF se procesa en segundo plano; se puede preguntar desde ya
+                        appendMessageToUI(`PDF "${data.filename}" recibido (${data.total_pages} páginas). Puedes hacer preguntas mientras se procesa.`, false);
+                        followPdfIngestion(data.filename, pdfMessage);
+                    } else {
+                        appendMessageToUI(pdfMessage.content, false);
+                    }
                 } else {
                     appendMessageToUI(`Error al procesar el PDF: ${data.error}`, false);
                 }
@@ -1186,6 +1421,11 @@ let chats = [];
                     }
                     
                     appendMessageToUI(message, false);
+                    
+                    // El texto se extrae en segundo plano
+                    if (data.job_id) {
+                        followOcrJob(data.job_id, currentChatId);
+                    }
                 } else {
                     appendMessageToUI(`Error al procesar la imagen: ${data.error}`, false);
                 }
@@ -0,0 +1,48 @@
+import asyncio
+import os
+import sys
+import threading
+
+import pytest
+
+# Las pruebas importan app.py desde la raíz del repositorio
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+
+@pytest.fixture
+def fake_ollama(monkeypatch):
+    """Función que inicia benchmarks/fake_ollama.py en un hilo, en un puerto
+    libre, y apunta app.py y async_server.py a él. Los argumentos cambian los
+    de FakeOllama (por omisión, respuestas de 10 s)."""
+    from aiohttp import web
+    from fake_ollama import FakeOllama
+
+    import app
+    import async_server
+
+    servers = []
+
+    def start(**options):
+        fake = FakeOllama(**{'models': ['mistral'], 'tokens_per_second': 20, 'latency': 0.05,
+                             'answer_tokens': 200, 'style': 'plain', **options})
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(fake.create_app())
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', 0).start())
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        servers.append((loop, thread, runner))
+
+        base_url = f'http://127.0.0.1:{runner.addresses[0][1]}'
+        monkeypatch.setattr(app.ollama, 'base_url', base_url)
+        monkeypatch.setattr(async_server, 'OLLAMA_BASE_URL', base_url)
+        return fake
+
+    yield start
+    for loop, thread, runner in servers:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
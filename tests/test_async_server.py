@@ -0,0 +1,123 @@
+"""Rutas de async_server.py que no son /chat."""
+import asyncio
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import app
+import async_server
+
+
+async def read_lines(response):
+    return [json.loads(line) for line in (await response.text()).splitlines() if line.strip()]
+
+
+def test_status_streams_do_not_hold_worker_threads(monkeypatch):
+    # Un solo hilo para las rutas de Flask: si cada stream ocupara uno, el
+    # pedido normal de abajo no se atendería hasta que terminaran
+    monkeypatch.setattr(async_server, 'executor', ThreadPoolExecutor(max_workers=1))
+    monkeypatch.setitem(app.app.config, 'STATUS_POLL_INTERVAL', 0.02)
+    key = ('ingestion', 'stream.pdf')
+    app.document_store.set_value(key, {'status': 'running', 'chunks': 0})
+    app.document_store.set_value(('ocr_job', 'trabajo'), {'status': 'queued', 'text': None})
+
+    async def scenario():
+        async with TestClient(TestServer(async_server.create_app())) as client:
+            streams = [asyncio.ensure_future(client.get('/upload_progress/stream.pdf?stream=1')),
+                       asyncio.ensure_future(client.get('/ocr_status/trabajo?stream=1'))]
+            await asyncio.sleep(0.1)
+
+            response = await asyncio.wait_for(client.get('/upload_progress/stream.pdf'), 5)
+            assert (await response.json())['status'] == 'running'
+
+            app.document_store.set_value(key, {'status': 'running', 'chunks': 3})
+            await asyncio.sleep(0.1)
+            app.document_store.set_value(key, {'status': 'done', 'chunks': 5})
+            app.document_store.set_value(('ocr_job', 'trabajo'), {'status': 'done', 'text': 'hola'})
+            responses = [await stream for stream in streams]
+            assert all(r.content_type == 'application/x-ndjson' for r in responses)
+            progress, job = [await read_lines(response) for response in responses]
+
+            missing = await client.get('/ocr_status/no-existe?stream=1')
+            return progress, job, missing.status
+
+    try:
+        progress, job, missing_status = asyncio.run(scenario())
+    finally:
+        app.document_store.pop_value(key)
+        app.document_store.pop_value(('ocr_job', 'trabajo'))
+    assert [line['chunks'] for line in progress] == [0, 3, 5]
+    assert progress[-1]['status'] == 'done'
+    assert [line['status'] for line in job] == ['queued', 'done']
+    assert missing_status == 404
+
+
+def pdf_upload(filename):
+    """Cuerpo multipart de la subida de un PDF de unos KB, partido en dos."""
+    doc = app.fitz.open()
+    for page in range(20):
+        doc.new_page().insert_text((72, 72), f"Página {page + 1} del documento {uuid.uuid4().hex}")
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    boundary = uuid.uuid4().hex
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f'Content-Type: application/pdf\r\n\r\n').encode('utf-8')
+    body = head + pdf_bytes + f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    half = len(head) + len(pdf_bytes) // 2
+    return body[:half], body[half:], f'multipart/form-data; boundary={boundary}'
+
+
+def test_uploads_are_streamed_into_flask(monkeypatch):
+    monkeypatch.setitem(app.app.config, 'UPLOAD_SPOOL_MAX_BYTES', 1024)
+    writes = []
+    original_write = app.UploadBuffer.write
+    def recording_write(self, data):
+        written = original_write(self, data)
+        writes.append(self.path is not None)
+        return written
+    monkeypatch.setattr(app.UploadBuffer, 'write', recording_write)
+    first, rest, content_type = pdf_upload('en-partes.pdf')
+
+    async def scenario():
+        async with TestClient(TestServer(async_server.create_app())) as client:
+            async def body():
+                yield first
+                # La segunda mitad sale recién cuando Flask ya escribió la primera
+                while not writes:
+                    await asyncio.sleep(0.01)
+                yield rest
+            response = await asyncio.wait_for(
+                client.post('/upload', data=body(), headers={'Content-Type': content_type}), 10)
+            return response.status, await response.json()
+
+    try:
+        status, result = asyncio.run(scenario())
+        assert status == 200 and result['success']
+        # Pasó de memoria a un archivo temporal al superar UPLOAD_SPOOL_MAX_BYTES
+        assert writes[-1]
+        for _ in range(200):
+            if app.document_store.get_value(('ingestion', 'en-partes.pdf'))['status'] != 'running':
+                break
+            time.sleep(0.05)
+        assert app.document_store.get_value(('ingestion', 'en-partes.pdf'))['status'] == 'done'
+    finally:
+        app.document_store.pop(('pdf', 'en-partes.pdf'))
+        app.document_store.pop_value(('ingestion', 'en-partes.pdf'))
+
+
+def test_oversized_pdf_gets_413(monkeypatch):
+    monkeypatch.setitem(app.app.config, 'PDF_MAX_BYTES', 2048)
+    first, rest, content_type = pdf_upload('grande.pdf')
+
+    async def scenario():
+        async with TestClient(TestServer(async_server.create_app())) as client:
+            response = await client.post('/upload', data=first + rest, headers={'Content-Type': content_type})
+            return response.status, await response.json()
+
+    status, result = asyncio.run(scenario())
+    assert status == 413
+    assert not result['success'] and 'MB' in result['error']
+    assert app.document_store.get_value(('ingestion', 'grande.pdf')) is None
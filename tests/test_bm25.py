@@ -0,0 +1,50 @@
+"""Búsqueda BM25 sobre los fragmentos de un PDF (BM25Index)."""
+import app
+
+CHUNKS = [
+    "El calendario académico fija el inicio de clases en marzo y el fin en diciembre.",
+    "Las becas se solicitan en la secretaría. El plazo para solicitar la beca vence el 15 de marzo.",
+    "La biblioteca abre de lunes a viernes. La biblioteca presta libros por dos semanas.",
+    "Requisitos de la beca: promedio mínimo de ocho y constancia de inscripción.",
+]
+
+
+def test_ranks_the_chunks_that_match_the_question():
+    index = app.BM25Index(CHUNKS)
+    assert index.search('¿Cuál es el plazo de la beca?', 2) == [1, 3]
+    assert index.search('horario de la biblioteca', 1) == [2]
+
+
+def test_accents_and_plurals_match():
+    index = app.BM25Index(CHUNKS)
+    assert index.search('CALENDARIO ACADEMICO', 1) == [0]
+    # "becas" y "beca" son el mismo término
+    assert set(index.search('becas', 4)) == {1, 3}
+
+
+def test_rare_terms_weigh_more_than_common_ones():
+    chunks = [
+        "reglamento reglamento reglamento del estudiante",
+        "reglamento de sanciones disciplinarias",
+        "reglamento general",
+    ]
+    # "reglamento" aparece en todos; "sanciones" solo en uno y decide el orden
+    assert app.BM25Index(chunks).search('reglamento de sanciones', 1) == [1]
+
+
+def test_shorter_chunks_rank_higher_for_the_same_matches():
+    chunks = ["tesis " + "relleno " * 60, "tesis final"]
+    assert app.BM25Index(chunks).search('tesis', 2) == [1, 0]
+
+
+def test_chunks_added_after_a_search_are_found():
+    index = app.BM25Index(CHUNKS[:2])
+    assert index.search('biblioteca', 3) == []
+    for chunk in CHUNKS[2:]:
+        index.add(chunk)
+    assert index.search('biblioteca', 3) == [2]
+    assert index.search('plazo beca', 1) == [1]
+
+
+def test_stopwords_alone_find_nothing():
+    assert app.BM25Index(CHUNKS).search('de la el en', 3) == []
@@ -0,0 +1,92 @@
+"""Cancelación de respuestas en curso (botón de detener y desconexión del
+navegador) contra benchmarks/fake_ollama.py, que cuenta los pedidos que la
+aplicación corta a mitad de la generación."""
+import asyncio
+import json
+import time
+import uuid
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import app
+import async_server
+
+
+@pytest.fixture
+def fake(fake_ollama):
+    """FakeOllama lento (10 s por respuesta)."""
+    return fake_ollama()
+
+
+def chat_request():
+    request_id = f'cancelar-{uuid.uuid4().hex}'
+    return request_id, {'message': 'Cuéntame una historia larga', 'model': 'mistral',
+                        'request_id': request_id, 'stream_mode': 'delta'}
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "no se cumplió a tiempo"
+        time.sleep(0.02)
+
+
+def cancelled(reason):
+    return app.generations.stats()['cancelled'].get(reason, 0)
+
+
+def test_cancel_chat_stops_ollama_in_flask(fake):
+    client = app.app.test_client()
+    request_id, data = chat_request()
+    before = cancelled('cancel')
+
+    response = client.post('/chat', json=data, buffered=False)
+    lines = iter(response.response)
+    # Esperar a que Ollama esté generando
+    for line in lines:
+        if 'seq' in json.loads(line):
+            break
+    assert client.post(f'/cancel_chat/{request_id}').get_json()['active']
+    started = time.time()
+    for _ in lines:
+        pass
+    response.close()
+
+    assert time.time() - started < 3
+    wait_until(lambda: fake.cancelled == 1)
+    assert cancelled('cancel') == before + 1
+
+
+async def read_until_answer(response):
+    while True:
+        line = await response.content.readline()
+        assert line, "la respuesta terminó sin texto"
+        if 'seq' in json.loads(line):
+            return
+
+
+def test_cancel_chat_and_disconnect_stop_ollama_in_async_server(fake):
+    before_cancel, before_disconnect = cancelled('cancel'), cancelled('disconnect')
+
+    async def scenario():
+        async with TestClient(TestServer(async_server.create_app())) as client:
+            # Botón de detener: la respuesta termina y se corta el pedido a Ollama
+            request_id, data = chat_request()
+            response = await client.post('/chat', json=data)
+            await read_until_answer(response)
+            cancel = await client.post(f'/cancel_chat/{request_id}')
+            assert (await cancel.json())['active']
+            await asyncio.wait_for(response.read(), 3)
+            await asyncio.to_thread(wait_until, lambda: fake.cancelled == 1)
+
+            # El navegador cierra la conexión a mitad de la respuesta
+            _, data = chat_request()
+            response = await client.post('/chat', json=data)
+            await read_until_answer(response)
+            response.close()
+            await asyncio.to_thread(wait_until, lambda: fake.cancelled == 2)
+            await asyncio.to_thread(wait_until, lambda: cancelled('disconnect') == before_disconnect + 1)
+
+    asyncio.run(scenario())
+    assert cancelled('cancel') == before_cancel + 1
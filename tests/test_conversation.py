@@ -0,0 +1,53 @@
+"""Modo conversación (build_conversation) en los chats con imágenes."""
+import uuid
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def chat_id():
+    chat_id = f'chat-{uuid.uuid4().hex}'
+    for text in ('factura de la luz', 'horario de clases', 'receta de pan'):
+        app.document_store.append(('images', chat_id), text)
+    yield chat_id
+    app.document_store.pop(('images', chat_id))
+    app.document_store.pop_value(('conversation', chat_id))
+
+
+def ask(chat_id, message):
+    payload, _, _, turn = app.prepare_chat({'message': message, 'model': 'mistral', 'chat_id': chat_id,
+                                            'conversation': True})
+    assert turn is not None
+    return payload['messages'], turn
+
+
+def test_this_image_targets_the_last_image(chat_id):
+    messages, turn = ask(chat_id, '¿Qué dice esta imagen?')
+    # Todas las imágenes quedan en el mensaje de sistema, que no cambia en la conversación
+    assert all(text in messages[0]['content'] for text in ('factura', 'horario', 'receta'))
+    user = messages[-1]['content']
+    assert 'receta de pan' in user
+    assert 'factura' not in user and 'horario' not in user
+    assert user.startswith('La pregunta se refiere a esta imagen')
+    app.save_turn(turn, 'Es una receta.')
+
+    # Ya está en la conversación, pero la pregunta la menciona otra vez
+    messages, turn = ask(chat_id, '¿Cuánta harina pide la imagen?')
+    assert len(messages) == 4
+    assert 'receta de pan' in messages[-1]['content']
+    assert turn['mode'] == 'chat_followup'
+    app.save_turn(turn, 'Medio kilo.')
+
+    # Sin mencionar una imagen solo va la pregunta
+    messages, _ = ask(chat_id, '¿Y cuál era la primera?')
+    assert messages[-1]['content'] == '¿Y cuál era la primera?'
+
+
+def test_off_by_default(chat_id):
+    payload, _, _, turn = app.prepare_chat({'message': '¿Qué dice esta imagen?', 'model': 'mistral',
+                                            'chat_id': chat_id})
+    assert turn is None
+    assert 'messages' not in payload and 'receta de pan' in payload['prompt']
+    assert app.ollama_path(payload) == '/api/generate'
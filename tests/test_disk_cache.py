@@ -0,0 +1,62 @@
+"""Caché de resultados en disco (DiskCache): límite en bytes y descarte de
+las entradas usadas hace más tiempo."""
+import json
+import os
+
+import app
+
+
+def value(size):
+    """Valor que ocupa exactamente size bytes como JSON."""
+    return {'text': 'x' * (size - len(json.dumps({'text': ''})))}
+
+
+def stored(folder):
+    return sorted(name[:-5] for name in os.listdir(folder) if name.endswith('.json'))
+
+
+def test_evicts_least_recently_used_entries_by_bytes(tmp_path):
+    cache = app.DiskCache(str(tmp_path), 2500)
+    cache.put('a', value(1000))
+    cache.put('b', value(1000))
+    assert cache.get('ocr', 'a') == value(1000)  # 'a' pasa a ser la más usada
+    cache.put('c', value(1000))
+    assert stored(tmp_path) == ['a', 'c']
+    assert cache.get('ocr', 'b') is None
+    assert cache.stats() == {'hits': {'ocr': 1}, 'misses': {'ocr': 1}, 'entries': 2, 'bytes': 2000}
+
+    # Una entrada grande puede desalojar varias
+    cache.put('d', value(2000))
+    assert stored(tmp_path) == ['d']
+    assert cache.stats()['bytes'] == 2000
+
+
+def test_replacing_an_entry_counts_only_its_new_size(tmp_path):
+    cache = app.DiskCache(str(tmp_path), 2500)
+    cache.put('a', value(1000))
+    cache.put('a', value(1200))
+    cache.put('b', value(1000))
+    assert stored(tmp_path) == ['a', 'b']
+    assert cache.stats()['bytes'] == 2200
+
+
+def test_entry_larger_than_the_limit_is_kept_alone(tmp_path):
+    cache = app.DiskCache(str(tmp_path), 500)
+    cache.put('a', value(100))
+    cache.put('grande', value(800))
+    assert stored(tmp_path) == ['grande']
+    assert cache.get('pdf', 'grande') == value(800)
+
+
+def test_existing_entries_are_ordered_by_last_use_after_a_restart(tmp_path):
+    cache = app.DiskCache(str(tmp_path), 3500)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, value(1000))
+    # Fecha de último uso: 'b' la más antigua, 'a' la más reciente
+    for key, mtime in (('b', 1000), ('c', 2000), ('a', 3000)):
+        os.utime(tmp_path / f'{key}.json', (mtime, mtime))
+
+    restarted = app.DiskCache(str(tmp_path), 3500)
+    assert restarted.stats()['bytes'] == 3000
+    restarted.put('d', value(1000))
+    assert stored(tmp_path) == ['a', 'c', 'd']
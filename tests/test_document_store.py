@@ -0,0 +1,94 @@
+"""Presupuesto de memoria de DocumentStore, incluidos los índices de los PDFs."""
+import multiprocessing
+import os
+
+import app
+
+
+def make_store(tmp_path, max_bytes, spilled):
+    return app.DocumentStore(str(tmp_path), max_bytes, ttl=3600, compress_after=3600,
+                             spill_max_bytes=10 * 1024 * 1024, on_spill=spilled.append)
+
+
+def test_charged_bytes_count_against_the_budget(tmp_path):
+    spilled = []
+    store = make_store(tmp_path, 10000, spilled)
+    # Textos que zlib no reduce a casi nada, para que comprimir no alcance
+    text_a, text_b = os.urandom(1000).hex(), os.urandom(1000).hex()
+    store.put(('pdf', 'a.pdf'), app.ChunkedText([text_a]))
+    store.put(('pdf', 'b.pdf'), app.ChunkedText([text_b]))
+    assert spilled == []
+
+    # El índice de b.pdf no entra junto con los dos textos: a.pdf pasa a disco
+    store.charge(('pdf', 'b.pdf'), 7000)
+    assert spilled == [('pdf', 'a.pdf')]
+    assert store.stats()['derived_bytes'] == 7000
+    assert store.memory_bytes() <= 10000
+
+    # Al volver a cargar a.pdf es b.pdf el que sale, y con él lo anotado
+    assert store.get(('pdf', 'a.pdf'))[0] == text_a
+    assert spilled[-1] == ('pdf', 'b.pdf')
+    assert store.stats()['derived_bytes'] == 0
+
+
+def test_charge_ignores_documents_not_in_memory(tmp_path):
+    store = make_store(tmp_path, 10000, [])
+    store.charge(('pdf', 'nada.pdf'), 5000)
+    assert store.memory_bytes() == 0
+
+
+def test_pdf_index_is_charged_and_dropped_on_spill(tmp_path, monkeypatch):
+    store = app.DocumentStore(str(tmp_path), 1024 * 1024, ttl=3600, compress_after=3600,
+                              spill_max_bytes=10 * 1024 * 1024, on_spill=app.drop_derived_data)
+    monkeypatch.setattr(app, 'document_store', store)
+    monkeypatch.setitem(app.app.config, 'pdf_index', {})
+
+    chunks = store.put(('pdf', 'doc.pdf'), app.ChunkedText())
+    for i in range(50):
+        chunks = store.append(('pdf', 'doc.pdf'), f"fragmento {i} con términos distintos palabra{i}")
+        index = app.get_pdf_index('doc.pdf', chunks, 'subida')
+    assert index.nbytes > 0
+    assert store.stats()['derived_bytes'] == index.nbytes
+
+    store.spill(('pdf', 'doc.pdf'))
+    assert 'doc.pdf' not in app.app.config['pdf_index']
+    assert store.stats()['derived_bytes'] == 0
+
+
+def test_sqlite_store_releases_least_used_indexes(tmp_path):
+    spilled = []
+    store = app.SQLiteDocumentStore(str(tmp_path / 'state.db'), 1000, on_spill=spilled.append)
+    store.charge(('pdf', 'a.pdf'), 600)
+    store.charge(('pdf', 'b.pdf'), 300)
+    store.charge(('pdf', 'a.pdf'), 600)
+    store.charge(('pdf', 'c.pdf'), 300)
+    assert spilled == [('pdf', 'b.pdf')]
+
+
+def open_store(folder):
+    """Lo que hace un proceso del pool (spawn) al importar app.py."""
+    make_store(folder, 10000, [])
+
+
+def test_pool_processes_keep_the_documents_on_disk(tmp_path):
+    store = make_store(tmp_path, 10000, [])
+    text = os.urandom(1000).hex()
+    store.put(('pdf', 'a.pdf'), app.ChunkedText([text]))
+    store.spill(('pdf', 'a.pdf'))
+
+    process = multiprocessing.get_context('spawn').Process(target=open_store, args=(tmp_path,))
+    process.start()
+    process.join(60)
+    assert process.exitcode == 0
+    assert store.get(('pdf', 'a.pdf'))[0] == text
+
+
+def test_missing_spill_file_is_a_miss(tmp_path):
+    store = make_store(tmp_path, 10000, [])
+    store.put(('pdf', 'a.pdf'), app.ChunkedText(['texto']))
+    store.spill(('pdf', 'a.pdf'))
+    os.remove(store.path(('pdf', 'a.pdf')))
+
+    assert store.get(('pdf', 'a.pdf')) is None
+    assert ('pdf', 'a.pdf') not in store
+    assert store.stats()['lost'] == 1
@@ -0,0 +1,69 @@
+"""Armado del prompt dentro de la ventana del modelo (fit_context, prepare_chat)."""
+import pytest
+
+import app
+
+
+def text_of(tokens):
+    """Texto de aproximadamente tokens tokens (con tiktoken o con la estimación)."""
+    return app.truncate_to_tokens(' '.join(f'palabra{i}' for i in range(tokens * 2)), tokens)
+
+
+def test_everything_fits():
+    items = [(2, text_of(20)), (0, text_of(30))]
+    kept, accounting = app.fit_context(items, 200)
+    assert kept == items
+    assert accounting == {'context': sum(app.count_tokens(text) + 1 for _, text in items),
+                          'included': 2, 'truncated': 0, 'dropped': 0}
+
+
+def test_first_item_that_does_not_fit_is_truncated_and_the_rest_dropped():
+    items = [(0, text_of(100)), (1, text_of(300)), (2, text_of(10))]
+    kept, accounting = app.fit_context(items, 250)
+    assert [position for position, _ in kept] == [0, 1]
+    assert items[1][1].startswith(kept[1][1])
+    assert len(kept[1][1]) < len(items[1][1])
+    assert accounting['context'] <= 250
+    assert accounting['truncated'] == 1 and accounting['dropped'] == 1
+
+
+def test_no_truncation_below_min_tokens():
+    items = [(0, text_of(100)), (1, text_of(100))]
+    kept, accounting = app.fit_context(items, 130, min_tokens=64)
+    assert [position for position, _ in kept] == [0]
+    assert accounting['truncated'] == 0 and accounting['dropped'] == 1
+
+
+@pytest.mark.parametrize('budget', [0, -50])
+def test_no_budget_keeps_nothing(budget):
+    kept, accounting = app.fit_context([(0, text_of(10))], budget)
+    assert kept == [] and accounting['context'] == 0 and accounting['dropped'] == 1
+
+
+@pytest.fixture
+def small_pdf(monkeypatch):
+    monkeypatch.setitem(app.app.config, 'MODEL_CONTEXT_WINDOWS', {'pequeño': 600})
+    monkeypatch.setitem(app.app.config, 'RESPONSE_TOKENS', 200)
+    chunks = [f"Fragmento {i}: " + text_of(150) for i in range(6)]
+    app.document_store.put(('pdf', 'presupuesto.pdf'), app.ChunkedText(chunks))
+    yield {'model': 'pequeño', 'pdf_file': 'presupuesto.pdf', 'isPdfChat': True,
+           'retrieval': 'bm25', 'conversation': False}
+    app.document_store.pop(('pdf', 'presupuesto.pdf'))
+
+
+def test_prompt_stays_within_the_budget(small_pdf):
+    payload, thinking_frame, _, _ = app.prepare_chat({**small_pdf, 'message': '¿Qué dice el fragmento?'})
+    tokens = thinking_frame['tokens']
+    assert tokens['budget'] == 400
+    assert 0 < tokens['included'] < 6
+    assert tokens['prompt'] <= tokens['budget']
+    assert tokens['prompt'] == app.count_tokens(payload['prompt'])
+
+
+def test_question_larger_than_the_budget_is_sent_whole_without_context(small_pdf):
+    question = text_of(500)
+    payload, thinking_frame, _, _ = app.prepare_chat({**small_pdf, 'message': question})
+    tokens = thinking_frame['tokens']
+    assert question in payload['prompt']
+    assert tokens['included'] == 0 and tokens['dropped'] > 0
+    assert tokens['prompt'] > tokens['budget']
@@ -0,0 +1,83 @@
+"""Ingesta en segundo plano de los PDFs (ingest_pdf): subir de nuevo el mismo
+archivo mientras se procesa."""
+import io
+import time
+import uuid
+
+import app
+
+
+def build_pdf(label, pages):
+    doc = app.fitz.open()
+    for page in range(pages):
+        doc.new_page().insert_text((72, 72), f"Documento {label} página {page + 1}")
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def test_reupload_during_ingestion_stops_the_previous_one(monkeypatch):
+    original_iter_pdf_text = app.iter_pdf_text
+    original_ingest_pdf = app.ingest_pdf
+
+    def slow_iter_pdf_text(source, ocr_stats):
+        for item in original_iter_pdf_text(source, ocr_stats):
+            time.sleep(0.05)
+            yield item
+
+    finished = []
+    def tracked_ingest_pdf(*args):
+        original_ingest_pdf(*args)
+        finished.append(args[3])
+
+    cached = []
+    original_put = app.result_cache.put
+    monkeypatch.setattr(app, 'iter_pdf_text', slow_iter_pdf_text)
+    monkeypatch.setattr(app, 'ingest_pdf', tracked_ingest_pdf)
+    monkeypatch.setattr(app.result_cache, 'put', lambda key, value: cached.append(value) or original_put(key, value))
+    monkeypatch.setitem(app.app.config, 'MAX_CHUNK_SIZE', 40)
+
+    client = app.app.test_client()
+    # Textos únicos, para no reutilizar la caché de otra ejecución
+    first, second = f'A{uuid.uuid4().hex[:8]}', f'B{uuid.uuid4().hex[:8]}'
+
+    def upload(label, pages):
+        response = client.post('/upload', data={'file': (io.BytesIO(build_pdf(label, pages)), 'repetido.pdf')},
+                               content_type='multipart/form-data')
+        assert response.get_json()['success']
+
+    upload(first, 20)
+    time.sleep(0.3)
+    first_id = client.get('/upload_progress/repetido.pdf').get_json()['upload_id']
+    upload(second, 2)
+
+    deadline = time.time() + 10
+    while len(finished) < 2:
+        assert time.time() < deadline, "las ingestas no terminaron"
+        time.sleep(0.05)
+
+    progress = client.get('/upload_progress/repetido.pdf').get_json()
+    assert progress['upload_id'] != first_id
+    assert progress['status'] == 'done' and progress['pages_processed'] == 2
+    chunks = list(app.document_store.get(('pdf', 'repetido.pdf')))
+    assert chunks and all(first not in chunk for chunk in chunks)
+    assert all(second in chunk for chunk in chunks)
+    assert len(chunks) == progress['chunks']
+    # Solo se guardó en la caché el segundo PDF, sin mezclar
+    assert [all(second in chunk for chunk in value['chunks']) for value in cached] == [True]
+    app.document_store.pop(('pdf', 'repetido.pdf'))
+    app.document_store.pop_value(('ingestion', 'repetido.pdf'))
+
+
+def test_fenced_writes_are_rejected(tmp_path):
+    stores = [app.DocumentStore(str(tmp_path / 'documents'), 1024 * 1024, 3600, 3600, 1024 * 1024),
+              app.SQLiteDocumentStore(str(tmp_path / 'state.sqlite3'))]
+    for store in stores:
+        store.set_value(('ingestion', 'x.pdf'), {'upload_id': 'nueva'})
+        old = (('ingestion', 'x.pdf'), 'vieja')
+        new = (('ingestion', 'x.pdf'), 'nueva')
+        assert store.append(('pdf', 'x.pdf'), 'texto viejo', fence=old) is None
+        assert store.set_value(('ingestion', 'x.pdf'), {'upload_id': 'vieja'}, fence=old) is False
+        assert list(store.append(('pdf', 'x.pdf'), 'texto nuevo', fence=new)) == ['texto nuevo']
+        assert store.set_value(('ingestion', 'x.pdf'), {'upload_id': 'nueva', 'status': 'done'}, fence=new)
+        assert store.get_value(('ingestion', 'x.pdf'))['status'] == 'done'
@@ -0,0 +1,92 @@
+"""Formato de texto de Prometheus de /metrics después de una respuesta de
+benchmarks/fake_ollama.py."""
+import math
+import re
+from collections import defaultdict
+
+import app
+
+SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{((?:[a-zA-Z_][a-zA-Z0-9_]*="[^"]*",?)*)\})? (\S+)$')
+LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="([^"]*)"')
+
+
+def parse(text):
+    """{familia: {'type': ..., 'samples': [(nombre, etiquetas, valor)]}}, validando cada línea."""
+    families = {}
+    current = None
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            current = line.split()[2]
+            assert current not in families, f"familia repetida: {current}"
+            families[current] = {'type': None, 'samples': []}
+        elif line.startswith('# TYPE '):
+            _, _, name, kind = line.split()
+            assert name == current and kind in ('counter', 'gauge', 'histogram')
+            families[name]['type'] = kind
+        else:
+            match = SAMPLE_RE.match(line)
+            assert match, f"línea inválida: {line!r}"
+            name, labels, value = match.groups()
+            assert name == current or name.rsplit('_', 1)[0] == current, f"{name} fuera de su familia"
+            families[current]['samples'].append((name, dict(LABEL_RE.findall(labels or '')), float(value)))
+    return families
+
+
+def check_histogram(name, samples):
+    series = defaultdict(dict)
+    for sample, labels, value in samples:
+        le = labels.pop('le', None)
+        key = tuple(sorted(labels.items()))
+        if sample == name + '_bucket':
+            series[key][float('inf') if le == '+Inf' else float(le)] = value
+        else:
+            assert sample in (name + '_sum', name + '_count') and le is None
+            series[key][sample[len(name):]] = value
+    for key, values in series.items():
+        buckets = sorted((bound, count) for bound, count in values.items() if not isinstance(bound, str))
+        counts = [count for _, count in buckets]
+        assert counts == sorted(counts), f"{name}{key}: buckets no acumulados"
+        assert buckets[-1][0] == math.inf and counts[-1] == values['_count']
+        assert values['_sum'] >= 0
+    return series
+
+
+def test_metrics_after_a_chat(fake_ollama, monkeypatch):
+    fake_ollama(tokens_per_second=100, answer_tokens=20)
+    monkeypatch.setitem(app.app.config, 'OLLAMA_OPTIONS', {})
+    client = app.app.test_client()
+
+    def total_chats():
+        families = parse(client.get('/metrics').get_data(as_text=True))
+        series = check_histogram('libreai_chat_stage_seconds', families['libreai_chat_stage_seconds']['samples'])
+        return sum(values['_count'] for key, values in series.items() if ('stage', 'total') in key)
+
+    before = total_chats()
+    body = client.post('/chat', json={'message': 'Hola', 'model': 'mistral', 'stream_mode': 'delta'}).get_data(as_text=True)
+    assert '"error"' not in body
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert 'version=0.0.4' in response.headers['Content-Type']
+    families = parse(response.get_data(as_text=True))
+    for name, family in families.items():
+        assert family['type'], f"{name} sin # TYPE"
+        if family['type'] == 'histogram':
+            check_histogram(name, family['samples'])
+        if family['type'] == 'counter':
+            assert all(value >= 0 for _, _, value in family['samples'])
+    assert total_chats() == before + 1
+    # Lo que informa Ollama en la última línea
+    eval_tokens = [value for sample, labels, value in families['libreai_ollama_tokens']['samples']
+                   if sample == 'libreai_ollama_tokens_count' and labels['kind'] == 'eval']
+    assert sum(eval_tokens) >= 1
+    assert families['libreai_ollama_up']['samples'][0][2] in (-1, 0, 1)
+
+
+def test_metrics_disabled(monkeypatch):
+    monkeypatch.setitem(app.app.config, 'METRICS_ENABLED', False)
+    histogram = app.Histogram('prueba_seconds', 'Prueba', app.LATENCY_BUCKETS)
+    histogram.observe(0.2)
+    assert histogram.series == {}
+    assert app.app.test_client().get('/metrics').status_code == 404
@@ -0,0 +1,30 @@
+"""Lista de modelos (/models) según el estado de ollama_monitor."""
+import pytest
+
+import app
+
+
+@pytest.fixture
+def monitor_state(monkeypatch):
+    monkeypatch.setattr(app.ollama_monitor, 'start', lambda: None)
+    state = {'healthy': None, 'models': [], 'error': None, 'checked': None}
+    monkeypatch.setattr(app.ollama_monitor, 'state', state)
+    return state
+
+
+def test_models_are_pending_before_the_first_check(monitor_state):
+    data = app.app.test_client().get('/models').get_json()
+    assert data['success'] and data['pending']
+    assert data['models'] == []
+
+
+def test_models_after_the_check(monitor_state):
+    client = app.app.test_client()
+    monitor_state.update(healthy=True, models=[{'name': 'mistral', 'size': 1}], checked=1.0)
+    data = client.get('/models').get_json()
+    assert data['success'] and not data['pending']
+    assert [model['name'] for model in data['models']] == ['mistral']
+
+    monitor_state.update(healthy=False, models=[], error='sin conexión')
+    data = client.get('/models').get_json()
+    assert not data['success'] and not data['pending']
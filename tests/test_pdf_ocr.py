@@ -0,0 +1,84 @@
+"""OCR de las páginas escaneadas de un PDF (iter_pdf_text), con un pool de hilos
+y un OCR simulado en lugar de tesseract."""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+
+
+class CountingPool(ThreadPoolExecutor):
+    """Pool que registra cuántas páginas llegó a tener sin terminar a la vez."""
+
+    def __init__(self, max_workers):
+        super().__init__(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self.max_outstanding = 0
+
+    def submit(self, function, *args):
+        with self.lock:
+            self.outstanding += 1
+            self.max_outstanding = max(self.max_outstanding, self.outstanding)
+        future = super().submit(function, *args)
+        future.add_done_callback(self.finished)
+        return future
+
+    def finished(self, future):
+        with self.lock:
+            self.outstanding -= 1
+
+
+def fake_ocr_page(file_path, page_num, dpi, lang):
+    time.sleep(0.01)
+    return f"texto escaneado {page_num + 1}", 0.01
+
+
+def build_pdf(pages):
+    """PDF con páginas escaneadas (sin texto) salvo las de pages con texto."""
+    doc = app.fitz.open()
+    for text in pages:
+        page = doc.new_page()
+        if text:
+            page.insert_text((72, 72), text)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def test_scanned_pages_keep_at_most_ocr_workers_in_the_pool(monkeypatch):
+    pool = CountingPool(max_workers=4)
+    monkeypatch.setattr(app, 'get_process_pool', lambda name, workers: pool)
+    monkeypatch.setattr(app, 'ocr_pdf_page', fake_ocr_page)
+    monkeypatch.setitem(app.app.config, 'OCR_WORKERS', 2)
+    monkeypatch.setitem(app.app.config, 'PDF_EXTRACT_WORKERS', 1)
+    pages = [None] * 12 + ["página con texto"] + [None] * 5
+
+    try:
+        ocr_stats = {}
+        result = list(app.iter_pdf_text(build_pdf(pages), ocr_stats))
+    finally:
+        pool.shutdown()
+
+    assert [page for page, _ in result] == list(range(1, len(pages) + 1))
+    assert result[0][1] == "texto escaneado 1\n"
+    assert result[12][1].strip() == "página con texto"
+    assert result[-1][1] == f"texto escaneado {len(pages)}\n"
+    assert ocr_stats['pages'] == 17
+    assert pool.max_outstanding <= 2
+
+
+def test_pages_over_the_limit_are_skipped(monkeypatch):
+    pool = CountingPool(max_workers=2)
+    monkeypatch.setattr(app, 'get_process_pool', lambda name, workers: pool)
+    monkeypatch.setattr(app, 'ocr_pdf_page', fake_ocr_page)
+    monkeypatch.setitem(app.app.config, 'PDF_OCR_MAX_PAGES', 3)
+
+    try:
+        ocr_stats = {}
+        result = list(app.iter_pdf_text(build_pdf([None] * 5), ocr_stats))
+    finally:
+        pool.shutdown()
+
+    assert [text for _, text in result] == ["texto escaneado 1\n", "texto escaneado 2\n", "texto escaneado 3\n", '', '']
+    assert ocr_stats['pages'] == 3 and ocr_stats['skipped'] == 2
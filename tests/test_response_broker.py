@@ -0,0 +1,83 @@
+"""Pedidos deterministas idénticos (response_broker): una sola generación en
+Ollama para todos los /chat que llegan a la vez, y la caché para los que
+llegan después."""
+import asyncio
+import json
+import threading
+import uuid
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import app
+import async_server
+
+
+@pytest.fixture
+def fake(fake_ollama, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'OLLAMA_OPTIONS', {'temperature': 0})
+    return fake_ollama(tokens_per_second=40, answer_tokens=20)
+
+
+def question():
+    # Única en cada prueba, para no encontrarla en la caché de otra
+    return {'message': f'¿Qué es la mitosis? ({uuid.uuid4().hex[:8]})', 'model': 'mistral',
+            'stream_mode': 'snapshot'}
+
+
+def answer(lines):
+    frames = [json.loads(line) for line in lines if line.strip()]
+    assert not any('error' in frame for frame in frames)
+    return [frame['response'] for frame in frames if 'response' in frame][-1]
+
+
+def test_identical_requests_share_one_generation_in_async_server(fake):
+    data = question()
+    before = app.response_broker.stats()
+
+    async def scenario():
+        async with TestClient(TestServer(async_server.create_app())) as client:
+            async def ask():
+                return answer((await (await client.post('/chat', json=data)).text()).splitlines())
+            answers = await asyncio.gather(*[ask() for _ in range(3)])
+            return answers, await ask()
+
+    answers, later = asyncio.run(scenario())
+    assert fake.requests == 1
+    assert len(set(answers)) == 1 and answers[0]
+    assert later == answers[0]
+    stats = app.response_broker.stats()
+    assert stats['coalesced'] == before['coalesced'] + 2
+    assert stats['cache']['hits'] == before['cache']['hits'] + 1
+
+
+def test_identical_requests_share_one_generation_in_flask(fake):
+    data = question()
+    client = app.app.test_client()
+    answers = []
+    before = app.response_broker.stats()
+
+    def ask():
+        answers.append(answer(client.post('/chat', json=data).get_data(as_text=True).splitlines()))
+
+    threads = [threading.Thread(target=ask) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ask()
+    assert fake.requests == 1
+    assert len(answers) == 4 and len(set(answers)) == 1
+    assert app.response_broker.stats()['coalesced'] == before['coalesced'] + 2
+
+
+def test_sampled_requests_are_not_shared(fake, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'OLLAMA_OPTIONS', {'temperature': 0.7})
+    data = question()
+
+    async def scenario():
+        async with TestClient(TestServer(async_server.create_app())) as client:
+            return await asyncio.gather(*[(await client.post('/chat', json=data)).text() for _ in range(2)])
+
+    asyncio.run(scenario())
+    assert fake.requests == 2
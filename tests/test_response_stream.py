@@ -0,0 +1,176 @@
+"""Protocolo 'delta' de ResponseStream: las líneas que recibe el navegador
+reconstruyen el mismo HTML que decorate_message(texto completo)."""
+import asyncio
+import json
+import threading
+import time
+import uuid
+
+from aiohttp import web
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import app
+import async_server
+
+ANSWER = """## Requisitos
+
+1. Promedio mínimo de **8**
+2. Constancia de *inscripción*
+
+| Etapa | Duración |
+|-------|----------|
+| Revisión | 2 semanas |
+
+La fórmula es $$x = \\frac{a}{b}$$ y el código:
+
+```python
+print("hola")
+```
+
+> Nota: firmar todo.
+
+Fin del texto."""
+
+
+def tokens(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class Browser:
+    """Lo que hace main.js con cada línea del modo 'delta'."""
+
+    def __init__(self):
+        self.stable = ''
+        self.tail = ''
+        self.seq = 0
+
+    def apply(self, line):
+        frame = json.loads(line)
+        assert frame['seq'] == self.seq + 1
+        self.seq = frame['seq']
+        if frame.get('reset'):
+            self.stable = ''
+        self.stable += frame.get('append', '')
+        self.tail = frame['tail']
+        return self.stable + self.tail
+
+
+def replay(text, size, **options):
+    stream = app.ResponseStream('delta', **options)
+    browser = Browser()
+    received = ''
+    html = None
+    for token in tokens(text, size):
+        received += token
+        frame = stream.push(token)
+        if frame:
+            html = browser.apply(frame)
+            # Cada línea muestra lo mismo que renderizar lo recibido hasta ahí
+            assert html == app.decorate_message(received)
+    frame = stream.flush()
+    if frame:
+        html = browser.apply(frame)
+    return html
+
+
+def test_delta_frames_rebuild_the_full_answer():
+    for size in (1, 3, 17):
+        assert replay(ANSWER, size, flush_interval=0, flush_tokens=1) == app.decorate_message(ANSWER)
+        assert replay(ANSWER, size, flush_interval=60, flush_tokens=5) == app.decorate_message(ANSWER)
+
+
+def test_reference_definition_resets_the_client():
+    text = ANSWER + "\n\nVer [el reglamento][r].\n\n[r]: https://example.com/reglamento\n"
+    stream = app.ResponseStream('delta', flush_interval=0, flush_tokens=1)
+    frames = [stream.push(token) for token in tokens(text, 4)] + [stream.flush()]
+    assert any(json.loads(frame).get('reset') for frame in frames if frame)
+    assert replay(text, 4, flush_interval=0, flush_tokens=1) == app.decorate_message(text)
+
+
+def test_flush_due():
+    stream = app.ResponseStream('delta', flush_interval=0.5, flush_tokens=32)
+    assert stream.flush_due() is None
+    stream.push('a')  # El primero sale enseguida
+    assert stream.flush_due() is None
+    assert stream.push('b') is None
+    assert 0 < stream.flush_due() <= 0.5
+    stream.last_flush -= 1
+    assert stream.flush_due() == 0
+
+
+async def paused_ollama(request):
+    """Dos tokens seguidos y una pausa larga antes del resto."""
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    for token in ('Hola', ' mundo'):
+        await response.write((json.dumps({'response': token, 'done': False}) + '\n').encode('utf-8'))
+    await asyncio.sleep(1.5)
+    await response.write((json.dumps({'response': '.', 'done': False}) + '\n').encode('utf-8'))
+    await response.write((json.dumps({'response': '', 'done': True}) + '\n').encode('utf-8'))
+    return response
+
+
+def test_pending_tokens_are_flushed_during_an_upstream_pause(monkeypatch):
+    upstream = web.Application()
+    upstream.router.add_post('/api/generate', paused_ollama)
+    upstream.router.add_post('/api/chat', paused_ollama)
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(upstream)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', 0).start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(async_server, 'OLLAMA_BASE_URL', f'http://127.0.0.1:{runner.addresses[0][1]}')
+    monkeypatch.setitem(app.app.config, 'STREAM_FLUSH_INTERVAL', 0.2)
+
+    async def scenario():
+        async with TestClient(TestServer(async_server.create_app())) as client:
+            response = await client.post('/chat', json={'message': 'hola', 'model': 'pausa', 'stream_mode': 'delta'})
+            started = time.perf_counter()
+            browser = Browser()
+            while True:
+                line = await response.content.readline()
+                assert line
+                if 'seq' in json.loads(line) and 'mundo' in browser.apply(line):
+                    return time.perf_counter() - started
+
+    try:
+        # " mundo" llega agrupado y sale al vencer STREAM_FLUSH_INTERVAL, no tras la pausa
+        assert asyncio.run(scenario()) < 1.0
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+
+@pytest.mark.parametrize('options', [{}, {'temperature': 0}])
+def test_async_server_renders_outside_the_event_loop(fake_ollama, monkeypatch, options):
+    fake_ollama(tokens_per_second=200, answer_tokens=40, style='markdown')
+    monkeypatch.setitem(app.app.config, 'OLLAMA_OPTIONS', options)
+    threads = set()
+    original_push, original_flush = app.ResponseStream.push, app.ResponseStream.flush
+    def push(self, text):
+        threads.add(threading.current_thread())
+        return original_push(self, text)
+    def flush(self):
+        threads.add(threading.current_thread())
+        return original_flush(self)
+    monkeypatch.setattr(app.ResponseStream, 'push', push)
+    monkeypatch.setattr(app.ResponseStream, 'flush', flush)
+
+    async def scenario():
+        async with TestClient(TestServer(async_server.create_app())) as client:
+            response = await client.post('/chat', json={'message': f'Hola {uuid.uuid4().hex}', 'model': 'mistral',
+                                                        'stream_mode': 'delta'})
+            browser = Browser()
+            html = None
+            for line in (await response.text()).splitlines():
+                if 'seq' in json.loads(line):
+                    html = browser.apply(line)
+            return html, threading.current_thread()
+
+    html, loop_thread = asyncio.run(scenario())
+    assert html and '<' in html
+    assert threads and loop_thread not in threads
@@ -0,0 +1,87 @@
+"""Admisión de pedidos por modelo (ModelScheduler) en /chat de async_server.py,
+contra benchmarks/fake_ollama.py, que cuenta las respuestas simultáneas."""
+import asyncio
+import json
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import app
+import async_server
+
+
+@pytest.fixture
+def fake(fake_ollama, monkeypatch):
+    """Respuestas cortas (unos 0,3 s) y un pedido a la vez por modelo."""
+    monkeypatch.setattr(app.ollama_scheduler, 'per_model', 1)
+    monkeypatch.setattr(app.ollama_scheduler, 'max_models', 1)
+    return fake_ollama(models=['mistral', 'tinyllama'], tokens_per_second=40, answer_tokens=10)
+
+
+async def read_frames(response):
+    return [json.loads(line) for line in (await response.text()).splitlines() if line.strip()]
+
+
+async def wait_until(condition, timeout=5):
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+
+def chat(client, model):
+    return client.post('/chat', json={'message': 'Explica la fotosíntesis', 'model': model, 'stream_mode': 'delta'})
+
+
+def test_same_model_requests_run_one_at_a_time(fake):
+    async def scenario():
+        async with TestClient(TestServer(async_server.create_app())) as client:
+            return await asyncio.gather(*[read_frames(await chat(client, 'mistral')) for _ in range(3)])
+
+    for frames in asyncio.run(scenario()):
+        assert not any('error' in frame for frame in frames)
+        assert frames[-1].get('seq')
+    assert fake.requests == 3
+    assert fake.peak['mistral'] == 1
+
+
+def test_full_queue_rejects_new_requests(fake, monkeypatch):
+    monkeypatch.setattr(app.ollama_scheduler, 'queue_limit', 1)
+
+    async def scenario():
+        async with TestClient(TestServer(async_server.create_app())) as client:
+            running = await chat(client, 'mistral')
+            await wait_until(lambda: fake.active['mistral'] == 1)
+            waiting = await chat(client, 'mistral')
+            # El primer mensaje del que espera trae su lugar en la cola
+            assert json.loads(await waiting.content.readline())['queue'] == {'position': 1, 'model': 'mistral'}
+            rejected = await read_frames(await chat(client, 'mistral'))
+            return await read_frames(running), await read_frames(waiting), rejected
+
+    running, waiting, rejected = asyncio.run(scenario())
+    assert running[-1].get('seq') and waiting[-1].get('seq')
+    assert len(rejected) == 1 and 'demasiadas solicitudes' in rejected[0]['error']
+    assert fake.requests == 2
+
+
+def test_loaded_model_goes_before_an_earlier_request_for_another(fake):
+    async def scenario():
+        async with TestClient(TestServer(async_server.create_app())) as client:
+            finished = []
+
+            async def send(model, name):
+                frames = await read_frames(await chat(client, model))
+                assert frames[-1].get('seq')
+                finished.append(name)
+
+            first = asyncio.ensure_future(send('mistral', 'primero'))
+            await wait_until(lambda: fake.active['mistral'] == 1)
+            other = asyncio.ensure_future(send('tinyllama', 'otro modelo'))
+            await wait_until(lambda: app.ollama_scheduler.stats()['waiting']['tinyllama'] == 1)
+            same = asyncio.ensure_future(send('mistral', 'mismo modelo'))
+            await asyncio.gather(first, other, same)
+            return finished
+
+    # "mismo modelo" llegó después pero no obliga a cambiar de modelo
+    assert asyncio.run(scenario()) == ['primero', 'mismo modelo', 'otro modelo']
+    assert fake.peak == {'mistral': 1, 'tinyllama': 1}
@@ -0,0 +1,93 @@
+"""Estado compartido con STATE_BACKEND 'sqlite': varios procesos (como los
+workers de gunicorn) sobre la misma base de datos."""
+import io
+import multiprocessing
+import time
+
+import pytest
+
+import app
+
+# Procesos nuevos, que importan app.py por su cuenta como haría cada worker
+context = multiprocessing.get_context('spawn')
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Base de datos compartida; los procesos nuevos heredan las variables de entorno."""
+    database = str(tmp_path / 'state.sqlite3')
+    monkeypatch.setenv('STATE_BACKEND', 'sqlite')
+    monkeypatch.setenv('STATE_DATABASE', database)
+    return database
+
+
+def upload_worker(filename, pdf_bytes, results):
+    assert isinstance(app.document_store, app.SQLiteDocumentStore)
+    client = app.app.test_client()
+    response = client.post('/upload', data={'file': (io.BytesIO(pdf_bytes), filename)},
+                           content_type='multipart/form-data')
+    assert response.get_json()['success']
+    # La ingesta sigue en un hilo de este proceso: esperar a que termine
+    for _ in range(200):
+        progress = client.get(f'/upload_progress/{filename}').get_json()
+        if progress['status'] != 'running':
+            break
+        time.sleep(0.05)
+    results.put(progress)
+
+
+def read_worker(filename, results):
+    client = app.app.test_client()
+    progress = client.get(f'/upload_progress/{filename}').get_json()
+    chunks = app.document_store.get(('pdf', filename))
+    best = app.get_pdf_index(filename, chunks, progress['upload_id']).search('cebollas', 1)
+    results.put((progress, list(chunks), chunks[best[0]]))
+
+
+def append_worker(name, count, results):
+    for i in range(count):
+        app.document_store.append(('images', 'chat-compartido'), f'{name} {i}')
+    results.put(name)
+
+
+def run(target, *args):
+    process = context.Process(target=target, args=args)
+    process.start()
+    return process
+
+
+def test_upload_in_one_process_is_read_in_the_others(database):
+    doc = app.fitz.open()
+    doc.new_page().insert_text((72, 72), f"Receta de sopa de cebollas {time.time()}")
+    doc.new_page().insert_text((72, 72), "Horario de trenes de la tarde")
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    results = context.Queue()
+
+    writer = run(upload_worker, 'compartido.pdf', pdf_bytes, results)
+    uploaded = results.get(timeout=60)
+    writer.join(timeout=60)
+    assert uploaded['status'] == 'done' and uploaded['chunks'] > 0
+
+    readers = [run(read_worker, 'compartido.pdf', results) for _ in range(2)]
+    for _ in readers:
+        progress, chunks, best = results.get(timeout=60)
+        assert progress['status'] == 'done'
+        assert progress['upload_id'] == uploaded['upload_id']
+        assert len(chunks) == uploaded['chunks']
+        assert 'cebollas' in best
+    for reader in readers:
+        reader.join(timeout=60)
+
+
+def test_concurrent_appends_keep_every_text(database):
+    results = context.Queue()
+    writers = [run(append_worker, name, 40, results) for name in ('a', 'b', 'c')]
+    for _ in writers:
+        results.get(timeout=60)
+    for writer in writers:
+        writer.join(timeout=60)
+
+    store = app.SQLiteDocumentStore(database)
+    texts = list(store.get(('images', 'chat-compartido')))
+    assert sorted(texts) == sorted(f'{name} {i}' for name in 'abc' for i in range(40))
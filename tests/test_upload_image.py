@@ -0,0 +1,118 @@
+"""Miniaturas de /upload_image, con un pool de hilos y un OCR simulado en
+lugar de tesseract."""
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from PIL import Image
+
+import app
+
+
+def fake_ocr_image(source, lang, **options):
+    with app.open_image(source) as image:
+        if image.getpixel((0, 0))[0] > 200:
+            raise RuntimeError("imagen ilegible")
+        return f"texto de una imagen de {image.size[0]} px"
+
+
+def image_bytes(color, width, image_format):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, 40), color).save(buffer, image_format)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    pool = ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(app, 'get_process_pool', lambda name, workers: pool)
+    monkeypatch.setattr(app, 'ocr_image', fake_ocr_image)
+    # Sin caché, para que cada prueba pase por el OCR
+    monkeypatch.setattr(app.result_cache, 'get', lambda kind, key: None)
+    yield app.app.test_client()
+    pool.shutdown()
+
+
+def upload(client, chat_id, data, filename):
+    response = client.post('/upload_image', data={'file': (io.BytesIO(data), filename), 'chat_id': chat_id},
+                           content_type='multipart/form-data')
+    assert response.status_code == 202
+    return response.get_json()
+
+
+def wait_job(client, job_id):
+    for _ in range(200):
+        job = client.get(f'/ocr_status/{job_id}').get_json()
+        if job['status'] in ('done', 'error'):
+            return job
+        time.sleep(0.01)
+    raise AssertionError("el OCR no terminó")
+
+
+def thumbnail_path(result):
+    return os.path.join(app.app.config['STATIC_FOLDER'], os.path.basename(result['image_url']))
+
+
+def test_same_name_and_same_stem_get_their_own_thumbnail(client):
+    results = [
+        upload(client, 'miniaturas', image_bytes('navy', 100, 'PNG'), 'a.png'),
+        upload(client, 'miniaturas', image_bytes('navy', 120, 'JPEG'), 'a.jpg'),
+        upload(client, 'miniaturas', image_bytes('navy', 140, 'PNG'), 'a.png'),
+    ]
+    try:
+        paths = [thumbnail_path(result) for result in results]
+        assert len(set(paths)) == 3
+        for result in results:
+            assert wait_job(client, result['job_id'])['status'] == 'done'
+        assert [Image.open(path).size[0] for path in paths] == [100, 120, 140]
+    finally:
+        for result in results:
+            if os.path.exists(thumbnail_path(result)):
+                os.remove(thumbnail_path(result))
+
+
+def test_failed_job_removes_only_its_own_thumbnail(client):
+    good = upload(client, 'miniaturas-error', image_bytes('navy', 100, 'PNG'), 'foto.png')
+    bad = upload(client, 'miniaturas-error', image_bytes('white', 100, 'PNG'), 'foto.png')
+    try:
+        assert wait_job(client, bad['job_id'])['status'] == 'error'
+        assert wait_job(client, good['job_id'])['status'] == 'done'
+        assert not os.path.exists(thumbnail_path(bad))
+        assert os.path.exists(thumbnail_path(good))
+    finally:
+        if os.path.exists(thumbnail_path(good)):
+            os.remove(thumbnail_path(good))
+
+
+def test_full_queue_answers_429_until_a_job_finishes(client, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'OCR_QUEUE_LIMIT', 1)
+    release = threading.Event()
+    def slow_ocr_image(source, lang, **options):
+        release.wait(5)
+        return fake_ocr_image(source, lang, **options)
+    monkeypatch.setattr(app, 'ocr_image', slow_ocr_image)
+
+    results = [upload(client, 'cola-llena', image_bytes('navy', 100, 'PNG'), 'uno.png')]
+    try:
+        thumbnails = set(os.listdir(app.app.config['STATIC_FOLDER']))
+        response = client.post('/upload_image', data={'file': (io.BytesIO(image_bytes('navy', 110, 'PNG')), 'dos.png'),
+                                                      'chat_id': 'cola-llena'},
+                               content_type='multipart/form-data')
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == '5'
+        assert not response.get_json()['success']
+        # La imagen rechazada no deja miniatura
+        assert set(os.listdir(app.app.config['STATIC_FOLDER'])) == thumbnails
+
+        release.set()
+        assert wait_job(client, results[0]['job_id'])['status'] == 'done'
+        results.append(upload(client, 'cola-llena', image_bytes('navy', 110, 'PNG'), 'dos.png'))
+        assert wait_job(client, results[1]['job_id'])['status'] == 'done'
+    finally:
+        release.set()
+        for result in results:
+            if os.path.exists(thumbnail_path(result)):
+                os.remove(thumbnail_path(result))
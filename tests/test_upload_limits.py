@@ -0,0 +1,134 @@
+"""Límites de tamaño de las subidas y paso a disco de las grandes (UploadBuffer)."""
+import io
+import os
+import time
+import uuid
+
+import pytest
+from PIL import Image
+from werkzeug.exceptions import RequestEntityTooLarge
+
+import app
+
+
+def temporary_files():
+    return {name for name in os.listdir(app.app.config['UPLOAD_FOLDER']) if name.startswith('tmp')}
+
+
+def pdf_bytes(pages):
+    doc = app.fitz.open()
+    for page in range(pages):
+        doc.new_page().insert_text((72, 72), f"Página {page + 1} {uuid.uuid4().hex}")
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def png_bytes(width):
+    buffer = io.BytesIO()
+    # Ruido, para que el PNG no quede diminuto al comprimirse
+    Image.frombytes('RGB', (width, width), os.urandom(width * width * 3)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def test_small_uploads_stay_in_memory(tmp_path):
+    upload = app.UploadBuffer(1000, 100, str(tmp_path), '.pdf')
+    upload.write(b'a' * 60)
+    upload.write(b'b' * 40)
+    assert upload.detach() == b'a' * 60 + b'b' * 40
+    upload.close()
+    assert os.listdir(tmp_path) == []
+
+
+def test_large_uploads_spill_to_a_temporary_file(tmp_path):
+    upload = app.UploadBuffer(1000, 100, str(tmp_path), '.pdf')
+    upload.write(b'a' * 60)
+    upload.write(b'b' * 60)
+    path = upload.detach()
+    upload.close()
+    # Quien procesa el archivo lo borra después (discard_upload)
+    assert os.path.dirname(path) == str(tmp_path) and path.endswith('.pdf')
+    with open(path, 'rb') as f:
+        assert f.read() == b'a' * 60 + b'b' * 60
+    app.discard_upload(path)
+    assert os.listdir(tmp_path) == []
+
+
+def test_temporary_file_is_removed_if_not_detached(tmp_path):
+    upload = app.UploadBuffer(1000, 100, str(tmp_path))
+    upload.write(b'a' * 500)
+    assert len(os.listdir(tmp_path)) == 1
+    upload.close()
+    assert os.listdir(tmp_path) == []
+
+
+def test_over_the_limit_raises_413_and_cleans_up(tmp_path):
+    upload = app.UploadBuffer(1000, 100, str(tmp_path))
+    upload.write(b'a' * 900)
+    with pytest.raises(RequestEntityTooLarge):
+        upload.write(b'b' * 200)
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize('route, field, data, limit', [
+    ('/upload', 'documento.pdf', lambda: pdf_bytes(40), 'PDF_MAX_BYTES'),
+    ('/upload_image', 'foto.png', lambda: png_bytes(200), 'IMAGE_MAX_BYTES'),
+])
+def test_oversized_files_get_413(monkeypatch, route, field, data, limit):
+    content = data()
+    monkeypatch.setitem(app.app.config, limit, len(content) // 2)
+    monkeypatch.setitem(app.app.config, 'UPLOAD_SPOOL_MAX_BYTES', len(content) // 4)
+    before = temporary_files()
+    response = app.app.test_client().post(route, data={'file': (io.BytesIO(content), field), 'chat_id': 'limites'},
+                                          content_type='multipart/form-data')
+    assert response.status_code == 413
+    body = response.get_json()
+    assert not body['success'] and 'MB' in body['error']
+    # El temporal de lo que llegó a recibirse se borra
+    assert temporary_files() == before
+
+
+def wait_ingestion(filename):
+    for _ in range(200):
+        progress = app.document_store.get_value(('ingestion', filename))
+        if progress is None or progress['status'] != 'running':
+            break
+        time.sleep(0.05)
+    app.document_store.pop(('pdf', filename))
+    app.document_store.pop_value(('ingestion', filename))
+    return progress
+
+
+def test_each_type_has_its_own_limit(monkeypatch):
+    content = pdf_bytes(40)
+    monkeypatch.setitem(app.app.config, 'IMAGE_MAX_BYTES', len(content) // 2)
+    response = app.app.test_client().post('/upload', data={'file': (io.BytesIO(content), 'permitido.pdf')},
+                                          content_type='multipart/form-data')
+    try:
+        assert response.status_code == 200 and response.get_json()['success']
+    finally:
+        wait_ingestion('permitido.pdf')
+
+
+def test_spooled_pdf_is_ingested_and_its_temporary_file_removed(monkeypatch):
+    content = pdf_bytes(40)
+    monkeypatch.setitem(app.app.config, 'UPLOAD_SPOOL_MAX_BYTES', len(content) // 4)
+    sources = []
+    original_ingest_pdf = app.ingest_pdf
+    def recording_ingest_pdf(filename, source, *args):
+        sources.append(source)
+        return original_ingest_pdf(filename, source, *args)
+    monkeypatch.setattr(app, 'ingest_pdf', recording_ingest_pdf)
+
+    response = app.app.test_client().post('/upload', data={'file': (io.BytesIO(content), 'en-disco.pdf')},
+                                          content_type='multipart/form-data')
+    assert response.get_json()['success']
+    progress = wait_ingestion('en-disco.pdf')
+    assert progress['status'] == 'done' and progress['pages_processed'] == 40
+    # Se procesó desde el temporal, que se borra al terminar
+    assert isinstance(sources[0], str) and os.path.dirname(sources[0]) == app.app.config['UPLOAD_FOLDER']
+    for _ in range(100):
+        if not os.path.exists(sources[0]):
+            break
+        time.sleep(0.01)
+    assert not os.path.exists(sources[0])
@@ -0,0 +1,117 @@
+"""Índice semántico (VectorIndex) con un embedder determinista en lugar de Ollama."""
+import hashlib
+import io
+import os
+import time
+
+import app
+
+DIMENSIONS = 64
+
+
+def fake_embed(texts):
+    """Bolsa de palabras con hashing: textos con palabras en común quedan cerca."""
+    vectors = []
+    for text in texts:
+        vector = [0.0] * DIMENSIONS
+        for word in text.lower().split():
+            vector[int(hashlib.md5(word.encode('utf-8')).hexdigest(), 16) % DIMENSIONS] += 1.0
+        vectors.append(vector)
+    return vectors
+
+
+CHUNKS = [
+    "el presupuesto anual del proyecto asciende a dos millones de pesos",
+    "los plazos de entrega vencen el quince de marzo sin prórroga",
+    "la receta lleva harina huevos azúcar y manteca derretida",
+]
+
+
+def build_index(tmp_path, chunks=CHUNKS, embed=fake_embed):
+    index = app.VectorIndex(os.path.join(tmp_path, 'doc.pdf.vectors'), list(chunks), embed=embed)
+    index.build()
+    return index
+
+
+def test_build_and_search(tmp_path):
+    index = build_index(tmp_path)
+    assert index.ready.is_set() and index.error is None
+    assert os.path.exists(index.path + '.npy') and os.path.exists(index.path + '.json')
+    assert index.search(fake_embed(["harina y azúcar"])[0], 1) == [2]
+    assert index.search(fake_embed(["plazos de entrega"])[0], 2)[0] == 1
+    assert sorted(index.search(fake_embed(["presupuesto"])[0], 10)) == [0, 1, 2]
+
+
+def test_passages_map_back_to_their_chunk(tmp_path, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'EMBEDDING_PASSAGE_SIZE', 3)
+    chunks = ["uno dos tres cuatro cinco seis siete ocho nueve diez", "gato perro loro"]
+    index = build_index(tmp_path, chunks)
+    assert list(index.starts) == [0, 4]
+    assert index.search(fake_embed(["siete ocho nueve"])[0], 1) == [0]
+    assert index.search(fake_embed(["loro"])[0], 1) == [1]
+
+
+def test_load_reuses_saved_index_without_embedding(tmp_path):
+    build_index(tmp_path)
+
+    def fail(texts):
+        raise AssertionError("no debería volver a embeber")
+
+    loaded = app.VectorIndex(os.path.join(tmp_path, 'doc.pdf.vectors'), list(CHUNKS), embed=fail)
+    assert loaded.load()
+    assert loaded.ready.is_set()
+    assert loaded.search(fake_embed(["harina"])[0], 1) == [2]
+
+
+def test_load_rejects_index_of_other_text_or_model(tmp_path, monkeypatch):
+    build_index(tmp_path)
+    path = os.path.join(tmp_path, 'doc.pdf.vectors')
+
+    changed = app.VectorIndex(path, CHUNKS[:2] + ["otro texto"], embed=fake_embed)
+    assert not changed.load()
+    assert not changed.ready.is_set()
+
+    monkeypatch.setitem(app.app.config, 'EMBEDDING_MODEL', 'otro-modelo')
+    assert not app.VectorIndex(path, list(CHUNKS), embed=fake_embed).load()
+
+
+def test_build_error_is_recorded(tmp_path):
+    def broken(texts):
+        raise RuntimeError("Ollama no responde")
+
+    index = build_index(tmp_path, embed=broken)
+    assert not index.ready.is_set()
+    assert "Ollama no responde" in index.error
+    assert not os.path.exists(index.path + '.npy')
+
+
+def upload_pdf(client, filename, text):
+    doc = app.fitz.open()
+    doc.new_page().insert_text((72, 72), text)
+    data = doc.tobytes()
+    doc.close()
+    response = client.post('/upload', data={'file': (io.BytesIO(data), filename)}, content_type='multipart/form-data')
+    assert response.get_json()['success']
+    for _ in range(100):
+        progress = client.get(f'/upload_progress/{filename}').get_json()
+        if progress['status'] != 'running':
+            return progress
+        time.sleep(0.05)
+    raise AssertionError("la ingesta no terminó")
+
+
+def test_upload_builds_index_only_for_semantic_retrieval(monkeypatch):
+    started = []
+    monkeypatch.setattr(app, 'start_vector_index', lambda filename, chunks: started.append(filename) or
+                        app.VectorIndex(os.devnull, list(chunks), embed=fake_embed))
+    client = app.app.test_client()
+
+    monkeypatch.setitem(app.app.config, 'RETRIEVAL_MODE', 'bm25')
+    progress = upload_pdf(client, 'indice-bm25.pdf', "texto para buscar con bm25")
+    assert progress['status'] == 'done' and progress['semantic_index'] is None
+    assert started == []
+
+    monkeypatch.setitem(app.app.config, 'RETRIEVAL_MODE', 'semantic')
+    progress = upload_pdf(client, 'indice-semantico.pdf', "texto para buscar por significado")
+    assert progress['status'] == 'done'
+    assert started == ['indice-semantico.pdf']
@@ -0,0 +1,43 @@
+"""Detección de las preguntas sobre todo el PDF (WHOLE_DOCUMENT_RE)."""
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize('question', [
+    'Resume el documento',
+    'resúmeme este pdf por favor',
+    'Haz un resumen del documento',
+    'Dame un resumen de todo el documento',
+    '¿Qué fechas aparecen en todo el pdf?',
+    'Lee el documento completo y dime los plazos',
+    'Summarize the document',
+    'Give me a summary of the whole PDF',
+    'What does the entire document say about grants?',
+])
+def test_whole_document_questions(question):
+    assert app.WHOLE_DOCUMENT_RE.search(question)
+
+
+@pytest.mark.parametrize('question', [
+    '¿Qué requisitos tienen todos los alumnos?',
+    'Explica cada una de las fórmulas de la página 3',
+    'Does every student need a form?',
+    '¿Qué dice el resumen ejecutivo?',
+    'Resume los requisitos de la beca',
+    'List all the deadlines in section 2',
+])
+def test_other_questions_use_retrieval(question):
+    assert not app.WHOLE_DOCUMENT_RE.search(question)
+
+
+def test_whole_document_flag_overrides_the_question():
+    app.document_store.put(('pdf', 'bandera.pdf'), app.ChunkedText(['Fragmento sobre becas.']))
+    data = {'message': '¿Qué requisitos tienen todos los alumnos?', 'pdf_file': 'bandera.pdf',
+            'isPdfChat': True, 'model': 'mistral'}
+    try:
+        assert app.prepare_document_chat(data) is None
+        assert isinstance(app.prepare_document_chat({**data, 'whole_document': True}), app.DocumentMapReduce)
+        assert app.prepare_document_chat({**data, 'message': 'Resume el documento', 'whole_document': False}) is None
+    finally:
+        app.document_store.pop(('pdf', 'bandera.pdf'))